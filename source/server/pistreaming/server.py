@@ -26,6 +26,9 @@ JSMPEG_MAGIC = b'jsmp'
 JSMPEG_HEADER = Struct('>4sHH')
 VFLIP = False
 HFLIP = False
+# Wait between reads while the camera returns no frame, and give up after this many
+CAPTURE_RETRY_DELAY = 0.05
+CAPTURE_MAX_FAILURES = 100
 
 ###########################################
 
@@ -167,11 +170,21 @@ class USBCamera(Thread):
         self.output = None
     
     def start_recording( self ):
+        frame = None
+        failures = 0
         while True:
-            # Capture frame-by-frame
-            ret, frame = self.cap.read()
+            # Capture frame-by-frame, reusing the same buffer every time
+            ret, frame = self.cap.read( frame )
+            if not ret:
+                failures += 1
+                if failures >= CAPTURE_MAX_FAILURES:
+                    print( 'The camera stopped returning frames' )
+                    break
+                sleep( CAPTURE_RETRY_DELAY )
+                continue
+            failures = 0
             # Our operations on the frame come here
-            self.output.write(frame.tostring())
+            self.output.write( memoryview( frame ).cast( 'B' ) )
             
     def run(self):
         self.start_recording()
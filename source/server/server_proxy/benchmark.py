@@ -0,0 +1,430 @@
+import os
+import json
+import argparse
+import asyncio
+import time
+import uuid
+import subprocess
+import threading
+import cv2
+
+import server_proxy
+from server_proxy import CV_THREAD_PREFIX, DEFAULT_RENDITION, ENCODER_BACKENDS, RENDITIONS, RoverHandler, \
+    VideoCaptureTreading, shared_cv_helper
+from control_encoding import control_codec, supported_encodings
+
+# Offline benchmarks of the proxy. Every subcommand prints, or writes with --output, a
+# JSON report so that runs on different builds can be compared.
+
+SAMPLE_INTERVAL = 0.1
+# How often a file source without demand checks whether it should stop, in seconds
+DEMAND_POLL_INTERVAL = 0.1
+
+# The messages the protocol benchmark encodes and decodes, as a client, the follow logic
+# and the rover send them
+PROTOCOL_MESSAGES = {
+    'client_move': {'client_id': str(uuid.uuid1()), 'rover_id': str(uuid.uuid1()), 'timestamp': 1700000000.123,
+                    'cmd': 'move', 'params': {'direction': ['forward', 'left']}},
+    'client_move_cam': {'client_id': str(uuid.uuid1()), 'rover_id': str(uuid.uuid1()), 'timestamp': 1700000000.123,
+                        'cmd': 'move_cam', 'params': {'direction': ['up', 'cw']}},
+    'follow_set_cam_speed': {'cmd': 'set_cam_speed', 'params': {'speed': [12.0, 4.0]}},
+    'follow_set_speed': {'cmd': 'set_speed', 'params': {'speed': 0.125}},
+    'follow_move_stop': {'cmd': 'move_stop', 'params': {'motors': ['wheels', 'camera']}},
+    'rover_ok': {'msg': 'ok'},
+    'rover_failed': {'msg': 'failed', 'info': 'blocked'},
+}
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+# A file source that starts over at the end. It decodes a frame only when the pipeline
+# waits for one, so it runs as fast as the pipeline takes frames, or paced at the frame
+# rate of the file as a camera would be.
+class FileVideoCapture(VideoCaptureTreading):
+    def __init__(self, src, stream_data, realtime=False):
+        super().__init__(src, stream_data)
+        self.realtime = realtime
+        self.period = 1.0 / (self.cap.get(cv2.CAP_PROP_FPS) or stream_data.framerate)
+        self.next_grab = time.time()
+        self.loops = 0
+        self.demand = threading.Event()
+
+    def wait_frame(self, after_seq=0, timeout=None):
+        self.demand.set()
+        return super().wait_frame(after_seq, timeout)
+
+    async def next_frame(self, after_seq=0):
+        self.demand.set()
+        return await super().next_frame(after_seq)
+
+    def grab(self):
+        if self.realtime:
+            self.next_grab += self.period
+            time.sleep(max(0.0, self.next_grab - time.time()))
+        else:
+            while self.started and not self.wanted():
+                self.demand.wait(DEMAND_POLL_INTERVAL)
+                self.demand.clear()
+
+        if self.cap.grab():
+            return True
+
+        self.loops += 1
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return self.cap.grab()
+
+
+# Stands in for a stream websocket, counting what the fan-out sends it
+class FakeViewer:
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+
+    async def send(self, data):
+        self.sent += 1
+        self.sent_bytes += len(data)
+
+
+# Stands in for the rover on the other side of the TCP link, answering every command
+class FakeRover:
+    def __init__(self):
+        self.commands = 0
+        self.server = None
+        self.writer = None
+        self.connected = asyncio.get_running_loop().create_future()
+        self.disconnected = asyncio.get_running_loop().create_future()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        await self.connected
+        return reader, self.writer
+
+    async def serve(self, reader, writer):
+        self.connected.set_result(True)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.commands += 1
+                writer.write(b'{"msg": "ok"}\n')
+                await writer.drain()
+        finally:
+            writer.close()
+            self.disconnected.set_result(True)
+
+    # Closes the link from the proxy side and waits for the rover side to wind down
+    async def stop(self):
+        self.server.close()
+        self.writer.close()
+        await self.disconnected
+        await self.server.wait_closed()
+
+
+def cpu_seconds(stat_path):
+    try:
+        with open(stat_path) as f:
+            # The command name may contain spaces, the fields count from its closing parenthesis
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError):
+        return 0.0
+
+
+# CPU time of a process and of all of its descendants still running
+def process_tree_cpu(pid):
+    total = cpu_seconds(f'/proc/{pid}/stat')
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = f.read().split()
+    except OSError:
+        children = []
+    return total + sum(map(lambda child: process_tree_cpu(int(child)), children))
+
+
+# CPU time of the threads of the CV pool, which every rover shares, by thread id
+def cv_threads_cpu():
+    return dict((thread.native_id, cpu_seconds(f'/proc/self/task/{thread.native_id}/stat'))
+                for thread in threading.enumerate() if thread.name.startswith(CV_THREAD_PREFIX))
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# One RoverHandler fed from a file, with its fake rover, its viewers and its samples
+class BenchmarkRover:
+    def __init__(self, video, viewers, renditions, encoder, tracking, follow, realtime):
+        self.video = video
+        self.renditions = renditions
+        self.encoder = encoder
+        self.tracking = tracking
+        self.follow = follow
+        self.realtime = realtime
+        self.viewers = list(FakeViewer() for i in range(viewers))
+        self.rover = None
+        self.handler = None
+        self.cap = None
+        self.conversion_task = None
+        self.responses_task = None
+
+        self.queue_depths = []
+        self.pipe_buffers = []
+        self.start_frames = 0
+        self.start_bytes = 0
+        self.start_cpu = 0.0
+
+    def hello_cmd(self):
+        cap = cv2.VideoCapture(self.video)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
+
+        rover_data = {'name': 'Benchmark', 'description': self.video, 'fov': 60,
+                      'stream_size': [width, height], 'mobility': ['gimbal', 'wheels']}
+        return {'rover_id': str(uuid.uuid1()), 'cmd': 'hello', 'rover_data': rover_data}
+
+    async def start(self):
+        self.rover = FakeRover()
+        reader, writer = await self.rover.start()
+
+        self.handler = RoverHandler(self.hello_cmd(), shared_cv_helper, reader, writer)
+        self.handler.encoder_backend = self.encoder
+        self.responses_task = asyncio.create_task(self.handler.read_responses())
+
+        # Set before the conversion starts, so the handler does not open its own capture
+        self.cap = FileVideoCapture(self.video, self.handler.stream_data, self.realtime)
+        self.handler.cap = self.cap.start()
+        self.conversion_task = asyncio.create_task(self.handler.start_conversion())
+
+        # Viewers are spread over the renditions in turn
+        for i, viewer in enumerate(self.viewers):
+            self.handler.add_stream_client(str(uuid.uuid1()), viewer, self.renditions[i % len(self.renditions)])
+
+        if self.tracking == 'faces':
+            await self.handler.cmd_track_faces({'params': {'targets': ['face']}})
+        elif self.tracking == 'custom':
+            width, height = self.handler.stream_data.width, self.handler.stream_data.height
+            await self.handler.cmd_track_custom({'params': {'roi': [width // 4, height // 4, width // 2, height // 2]}})
+
+        if self.follow:
+            await self.handler.cmd_follow({'params': {'wheels': True, 'cam': True}})
+
+    def converters(self):
+        return list(filter(lambda c: c is not None, map(lambda r: r.converter, self.handler.renditions.values())))
+
+    def sample(self):
+        self.queue_depths.append(sum(map(lambda r: len(r.encoder_in_flight), self.handler.renditions.values())))
+        self.pipe_buffers.append(sum(map(lambda c: c.stdin.transport.get_write_buffer_size(), self.converters())))
+
+    def cpu(self):
+        total = cpu_seconds(f'/proc/self/task/{self.cap.thread.native_id}/stat')
+        for rendition in self.handler.renditions.values():
+            if rendition.encoder is not None and rendition.encoder.thread_id is not None:
+                total += cpu_seconds(f'/proc/self/task/{rendition.encoder.thread_id}/stat')
+        return total + sum(map(lambda c: process_tree_cpu(c.pid), self.converters()))
+
+    def sent_bytes(self):
+        return sum(map(lambda viewer: viewer.sent_bytes, self.viewers))
+
+    # Called once the warmup is over
+    def mark(self):
+        self.queue_depths = []
+        self.pipe_buffers = []
+        self.start_frames = self.handler.encoded_frames
+        self.start_bytes = self.sent_bytes()
+        self.start_cpu = self.cpu()
+
+    def report(self, elapsed):
+        frames = self.handler.encoded_frames - self.start_frames
+        return {'rover_id': self.handler.rover_id,
+                'video': self.video,
+                'encoder': self.encoder,
+                'fps': frames / elapsed,
+                'cpu_percent': (self.cpu() - self.start_cpu) / elapsed * 100.0,
+                'encoder_queue_depth': {'avg': sum(self.queue_depths) / max(len(self.queue_depths), 1),
+                                        'max': max(self.queue_depths, default=0)},
+                'encoder_pipe_bytes': {'avg': sum(self.pipe_buffers) / max(len(self.pipe_buffers), 1),
+                                       'max': max(self.pipe_buffers, default=0)},
+                'viewers': len(self.viewers),
+                'fanout_bytes_per_second': (self.sent_bytes() - self.start_bytes) / elapsed,
+                'source_loops': self.cap.loops,
+                'rover_commands': self.rover.commands,
+                'stream_clients': self.handler.stream_stats(),
+                'renditions': self.handler.frame_stats()['encoders'],
+                'metrics': self.handler.metrics_stats()}
+
+    # The control loop is stopped too, one left behind would skew the timings of later runs
+    async def stop(self):
+        tasks = list(filter(None, (self.conversion_task, self.handler.control_task,
+                                   self.handler.command_channel.writer_task)))
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.cap.stop()
+        self.handler.kill_converters()
+
+        await self.rover.stop()
+        await self.responses_task
+
+
+async def sample_loop(rovers):
+    while True:
+        await asyncio.sleep(SAMPLE_INTERVAL)
+        for rover in rovers:
+            rover.sample()
+
+
+async def run_pipeline(args):
+    rovers = list(BenchmarkRover(args.videos[i % len(args.videos)], args.viewers, args.renditions, args.encoder,
+                                 args.tracking, args.follow, args.realtime) for i in range(args.rovers))
+    for rover in rovers:
+        await rover.start()
+
+    sampler = asyncio.create_task(sample_loop(rovers))
+
+    await asyncio.sleep(args.warmup)
+    for rover in rovers:
+        rover.mark()
+    start = time.time()
+    start_cpu = sum(os.times()[:4])
+    start_cv_cpu = cv_threads_cpu()
+
+    await asyncio.sleep(args.duration)
+    elapsed = time.time() - start
+    cv_cpu = sum(cpu - start_cv_cpu.get(thread_id, 0.0) for thread_id, cpu in cv_threads_cpu().items())
+
+    report = {'benchmark': 'pipeline',
+              'revision': git_revision(),
+              'config': vars(args),
+              'duration': elapsed,
+              'proxy_cpu_percent': (sum(os.times()[:4]) - start_cpu) / elapsed * 100.0,
+              # Detection and tracking of all rovers, not part of the cpu_percent of any
+              'cv_cpu_percent': cv_cpu / elapsed * 100.0,
+              'rovers': list(map(lambda rover: rover.report(elapsed), rovers))}
+    report['total_fps'] = sum(map(lambda r: r['fps'], report['rovers']))
+    report['total_fanout_bytes_per_second'] = sum(map(lambda r: r['fanout_bytes_per_second'], report['rovers']))
+
+    sampler.cancel()
+    for rover in rovers:
+        await rover.stop()
+    return report
+
+
+def time_per_call(function, argument, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        function(argument)
+    return (time.perf_counter() - start) / iterations
+
+
+# Encode and decode cost and encoded size of typical control messages, for every
+# encoding this build supports
+def run_protocol(args):
+    report = {'benchmark': 'protocol',
+              'revision': git_revision(),
+              'config': vars(args),
+              'encodings': {}}
+
+    for encoding in supported_encodings():
+        codec = control_codec(encoding)
+        results = {}
+        for name, message in PROTOCOL_MESSAGES.items():
+            data = codec.encode(message)
+            results[name] = {'bytes': len(data),
+                             'encode_us': time_per_call(codec.encode, message, args.iterations) * 1e6,
+                             'decode_us': time_per_call(codec.decode, data, args.iterations) * 1e6}
+
+        results['average'] = dict((key, sum(map(lambda r: r[key], results.values())) / len(results))
+                                  for key in ('bytes', 'encode_us', 'decode_us'))
+        report['encodings'][encoding] = results
+
+    return report
+
+
+# Runs the same pipeline benchmark once per encoder backend, one after the other
+async def run_encoders(args):
+    report = {'benchmark': 'encoders',
+              'revision': git_revision(),
+              'config': vars(args),
+              'encoders': {},
+              'runs': {}}
+
+    for encoder in ENCODER_BACKENDS:
+        run = await run_pipeline(argparse.Namespace(**dict(vars(args), encoder=encoder)))
+        stages = list(map(lambda r: r['metrics']['stages'], run['rovers']))
+        report['encoders'][encoder] = {
+            'total_fps': run['total_fps'],
+            'proxy_cpu_percent': run['proxy_cpu_percent'],
+            'cv_cpu_percent': run['cv_cpu_percent'],
+            'rover_cpu_percent': sum(map(lambda r: r['cpu_percent'], run['rovers'])),
+            'encoder_write': list(map(lambda s: s.get('encoder_write'), stages)),
+            'encoder_output': list(map(lambda s: s.get('encoder_output'), stages))}
+        report['runs'][encoder] = run
+
+        # Let the encoders of the finished run exit before the next one starts
+        await asyncio.sleep(1.0)
+
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark the proxy offline')
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of printing it')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    pipeline_options = argparse.ArgumentParser(add_help=False)
+    pipeline_options.add_argument('videos', nargs='+', help='The video files, assigned to the rovers in turn')
+    pipeline_options.add_argument('-r', '--rovers', default=1, type=int, help='How many rovers to run')
+    pipeline_options.add_argument('-v', '--viewers', default=1, type=int, help='How many viewers per rover')
+    pipeline_options.add_argument('-e', '--renditions', default=[DEFAULT_RENDITION], nargs='+',
+                                  choices=list(map(lambda r: r[0], RENDITIONS)),
+                                  help='The renditions the viewers of a rover watch, assigned to them in turn')
+    pipeline_options.add_argument('-m', '--tracking', default='none', choices=['none', 'faces', 'custom'],
+                                  help='The tracking mode of every rover')
+    pipeline_options.add_argument('--follow', action='store_true', help='Also run the follow logic')
+    pipeline_options.add_argument('--realtime', action='store_true',
+                                  help='Pace the files at their frame rate instead of decoding a frame whenever the '
+                                       'pipeline waits for one')
+    pipeline_options.add_argument('-d', '--duration', default=30.0, type=float,
+                                  help='How long to measure, in seconds')
+    pipeline_options.add_argument('-w', '--warmup', default=5.0, type=float, help='How long to run before measuring')
+
+    pipeline = subparsers.add_parser('pipeline', parents=[pipeline_options],
+                                     help='Drive rover pipelines from video files')
+    pipeline.add_argument('--encoder', default='ffmpeg', choices=ENCODER_BACKENDS, help='The encoder backend')
+
+    subparsers.add_parser('encoders', parents=[pipeline_options],
+                          help='Run the pipeline benchmark with every encoder backend and compare them')
+
+    protocol = subparsers.add_parser('protocol', help='Compare the encodings of the control protocol')
+    protocol.add_argument('-n', '--iterations', default=100000, type=int,
+                          help='How many times to encode and decode every message')
+
+    args = parser.parse_args()
+
+    pyav_needed = args.benchmark == 'encoders' or (args.benchmark == 'pipeline' and args.encoder == 'pyav')
+    if pyav_needed and server_proxy.av is None:
+        parser.error('the pyav encoder needs PyAV installed')
+
+    if args.benchmark == 'pipeline':
+        report = await run_pipeline(args)
+    elif args.benchmark == 'encoders':
+        report = await run_encoders(args)
+    elif args.benchmark == 'protocol':
+        report = run_protocol(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
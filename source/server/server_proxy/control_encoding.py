@@ -0,0 +1,173 @@
+import json
+import math
+import asyncio
+
+from struct import Struct, error as StructError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The encodings of the control messages between clients, the dispatcher and the rovers,
+# see docs/protocol. The dispatcher imports this module and the rover directory links
+# it, so that both ends of the link always speak the same format.
+
+# Frame types of the binary control encodings
+FRAME_MESSAGE = 0
+FRAME_MOVE = 1
+FRAME_MOVE_CAM = 2
+FRAME_SET_CAM_SPEED = 3
+FRAME_OK = 4
+FRAME_FAILED = 5
+
+# The direction lists of move and move_cam as bit masks, the first name is the lowest bit
+MOVE_DIRECTIONS = ('forward', 'back', 'left', 'right', 'cw', 'ccw')
+CAM_DIRECTIONS = ('up', 'down', 'cw', 'ccw')
+
+
+# Newline delimited JSON, the encoding every rover and client understands
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, message):
+        return (json.dumps(message) + '\n').encode()
+
+    def decode(self, data):
+        return json.loads(data)
+
+    # The next message, None at the end of the stream
+    async def read(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        return self.decode(line)
+
+
+# Length prefixed frames. move, move_cam and set_cam_speed have fixed layouts with the
+# directions as bit masks, they keep the timestamp and drop the ids, which the
+# connection implies. So do the plain ok and failed responses. Every fixed layout starts
+# with the sequence number, 0 for none. Every other message is a FRAME_MESSAGE with a
+# JSON payload, or a msgpack one for the msgpack encoding.
+class BinaryCodec:
+    frame_header = Struct('<BI')
+    seq_layout = Struct('<I')
+    move_layout = Struct('<IBd')
+    speed_layout = Struct('<Iddd')
+    hot_keys = {'cmd', 'params', 'timestamp', 'client_id', 'rover_id', 'seq'}
+
+    def __init__(self, name='struct'):
+        self.name = name
+
+    @staticmethod
+    def direction_mask(directions, names):
+        mask = 0
+        for direction in directions:
+            bit = 1 << names.index(direction)
+            if mask & bit:
+                raise ValueError(f'repeated direction {direction}')
+            mask |= bit
+        return mask
+
+    # The frame type and payload of a message with a fixed layout, None for the others
+    def pack_fixed(self, message):
+        seq = message.get('seq', 0)
+        if 'seq' in message and (type(seq) is not int or not 0 < seq <= 0xFFFFFFFF):
+            return None
+
+        if message.keys() - {'seq'} == {'msg'} and message['msg'] == 'ok':
+            return FRAME_OK, self.seq_layout.pack(seq)
+        if message.keys() - {'seq'} == {'msg', 'info'} and message['msg'] == 'failed' and \
+                isinstance(message['info'], str):
+            return FRAME_FAILED, self.seq_layout.pack(seq) + message['info'].encode()
+
+        params = message.get('params')
+        if not isinstance(params, dict) or not self.hot_keys.issuperset(message):
+            return None
+
+        try:
+            timestamp = float(message.get('timestamp', math.nan))
+            if message['cmd'] in ('move', 'move_cam') and params.keys() == {'direction'}:
+                names = MOVE_DIRECTIONS if message['cmd'] == 'move' else CAM_DIRECTIONS
+                frame_type = FRAME_MOVE if message['cmd'] == 'move' else FRAME_MOVE_CAM
+                mask = self.direction_mask(params['direction'], names)
+                return frame_type, self.move_layout.pack(seq, mask, timestamp)
+            if message['cmd'] == 'set_cam_speed' and params.keys() == {'speed'} and len(params['speed']) == 2:
+                speed = params['speed']
+                return FRAME_SET_CAM_SPEED, self.speed_layout.pack(seq, float(speed[0]), float(speed[1]), timestamp)
+        except (ValueError, TypeError):
+            pass
+        return None
+
+    def encode(self, message):
+        fixed = self.pack_fixed(message)
+        if fixed is not None:
+            frame_type, payload = fixed
+        elif self.name == 'msgpack':
+            frame_type, payload = FRAME_MESSAGE, msgpack.packb(message)
+        else:
+            frame_type, payload = FRAME_MESSAGE, json.dumps(message).encode()
+        return self.frame_header.pack(frame_type, len(payload)) + payload
+
+    def decode_frame(self, frame_type, payload):
+        if frame_type == FRAME_MESSAGE:
+            return msgpack.unpackb(payload) if self.name == 'msgpack' else json.loads(payload)
+
+        try:
+            return self.unpack_fixed(frame_type, payload)
+        except StructError as e:
+            raise ValueError(f'bad frame of type {frame_type}: {e}')
+
+    def unpack_fixed(self, frame_type, payload):
+        timestamp = math.nan
+        if frame_type == FRAME_OK:
+            seq, = self.seq_layout.unpack(payload)
+            message = {'msg': 'ok'}
+        elif frame_type == FRAME_FAILED:
+            seq, = self.seq_layout.unpack_from(payload)
+            message = {'msg': 'failed', 'info': bytes(payload[self.seq_layout.size:]).decode()}
+        elif frame_type in (FRAME_MOVE, FRAME_MOVE_CAM):
+            seq, mask, timestamp = self.move_layout.unpack(payload)
+            names = MOVE_DIRECTIONS if frame_type == FRAME_MOVE else CAM_DIRECTIONS
+            message = {'cmd': 'move' if frame_type == FRAME_MOVE else 'move_cam',
+                       'params': {'direction': list(n for i, n in enumerate(names) if mask & (1 << i))}}
+        elif frame_type == FRAME_SET_CAM_SPEED:
+            seq, pan, tilt, timestamp = self.speed_layout.unpack(payload)
+            message = {'cmd': 'set_cam_speed', 'params': {'speed': [pan, tilt]}}
+        else:
+            raise ValueError(f'unknown frame type {frame_type}')
+
+        if not math.isnan(timestamp):
+            message['timestamp'] = timestamp
+        if seq:
+            message['seq'] = seq
+        return message
+
+    def decode(self, data):
+        frame_type, length = self.frame_header.unpack_from(data)
+        start = self.frame_header.size
+        return self.decode_frame(frame_type, data[start:start + length])
+
+    async def read(self, reader):
+        try:
+            frame_type, length = self.frame_header.unpack(await reader.readexactly(self.frame_header.size))
+            return self.decode_frame(frame_type, await reader.readexactly(length))
+        except asyncio.IncompleteReadError:
+            return None
+
+
+# The encodings this side can speak, most compact first
+def supported_encodings():
+    return (['msgpack'] if msgpack is not None else []) + ['struct', 'json']
+
+
+# The first encoding offered by the peer that is supported here, JSON when none is
+def negotiate_encoding(offered):
+    for encoding in offered:
+        if encoding in supported_encodings():
+            return encoding
+    return 'json'
+
+
+def control_codec(encoding):
+    return JsonCodec() if encoding == 'json' else BinaryCodec(encoding)
@@ -0,0 +1,304 @@
+import os
+import json
+import argparse
+import asyncio
+import time
+import uuid
+import atexit
+import numpy as np
+import websockets
+import cv2
+
+from server_proxy import MPEG1_START_CODE, MPEG1_PICTURE_CODE
+
+# Measures glass to glass latency through a running proxy. A fake rover registers with
+# the proxy and streams rendered frames over RTP, encoded the way BroadcastOutput does.
+# Every frame carries its number as a row of black and white cells. A fake viewer
+# decodes the jsmpeg stream, reads the number back and matches it to the time the
+# frame was rendered.
+
+MARKER_BITS = 24
+MARKER_CHECK_BITS = 8
+MARKER_CELL = 16
+
+PICTURE_START_CODE = MPEG1_START_CODE + bytes([MPEG1_PICTURE_CODE])
+
+
+class HarnessData:
+    def __init__(self):
+        self.proxy_address = '127.0.0.1'
+        self.ctrl_port = 6666
+        self.e_ctrl_port = 8888
+        self.stream_port = 8889
+        self.rtp_port = 5004
+        self.width = 640
+        self.height = 480
+        self.fps = 30
+        self.duration = 30.0
+        self.warmup = 5.0
+
+
+harness_data = HarnessData()
+
+
+def marker_check(frame_no):
+    check = 0
+    for shift in range(0, MARKER_BITS, MARKER_CHECK_BITS):
+        check ^= (frame_no >> shift) & 0xFF
+    return check
+
+
+# Draws the frame number, and its check byte, as a row of cells along the top edge.
+# Cells are aligned to macroblocks so that the encoders keep them readable.
+def draw_marker(image, frame_no):
+    value = frame_no | (marker_check(frame_no) << MARKER_BITS)
+    for bit in range(MARKER_BITS + MARKER_CHECK_BITS):
+        colour = 255 if (value >> bit) & 1 else 0
+        image[0:MARKER_CELL, bit * MARKER_CELL:(bit + 1) * MARKER_CELL] = colour
+
+
+# Returns the frame number in the marker, None if the check byte does not match
+def read_marker(image):
+    value = 0
+    quarter = MARKER_CELL // 4
+    for bit in range(MARKER_BITS + MARKER_CHECK_BITS):
+        cell = image[quarter:MARKER_CELL - quarter,
+                     bit * MARKER_CELL + quarter:(bit + 1) * MARKER_CELL - quarter]
+        if cell.mean() > 127:
+            value |= 1 << bit
+
+    frame_no = value & ((1 << MARKER_BITS) - 1)
+    if value >> MARKER_BITS != marker_check(frame_no):
+        return None
+    return frame_no
+
+
+def render_frame(frame_no):
+    image = np.full((harness_data.height, harness_data.width, 3), 96, dtype=np.uint8)
+
+    # Something moving, so the encoders do not only see a still picture
+    x = (frame_no * 8) % harness_data.width
+    image[MARKER_CELL * 2:, x:x + 32] = (40, 160, 220)
+
+    cv2.putText(image, f'{frame_no} {time.time():.3f}', (20, harness_data.height // 2),
+                cv2.FONT_HERSHEY_SIMPLEX, 1.2, (255, 255, 255), 2)
+    draw_marker(image, frame_no)
+    return image
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+
+    values = np.array(values) * 1000.0
+    return {'count': len(values),
+            'p50_ms': float(np.percentile(values, 50)),
+            'p90_ms': float(np.percentile(values, 90)),
+            'p99_ms': float(np.percentile(values, 99)),
+            'max_ms': float(values.max())}
+
+
+class LatencyHarness:
+    def __init__(self):
+        self.rover_id = str(uuid.uuid1())
+        self.client_id = str(uuid.uuid1())
+        self.sdp_file = f'harness_{self.rover_id}.sdp'
+
+        # Frame number to the time it was handed to the rover side encoder
+        self.rendered = dict()
+        self.start_time = None
+
+        self.stages = {'rover_to_viewer': [], 'viewer_decode': [], 'glass_to_glass': []}
+        self.decoded = 0
+        self.unreadable = 0
+
+    def measuring(self):
+        return time.time() - self.start_time >= harness_data.warmup
+
+    async def start_source(self):
+        command = f'ffmpeg -loglevel error -f rawvideo -pix_fmt bgr24 \
+        -s {harness_data.width}x{harness_data.height} -r {harness_data.fps} -i - -an \
+        -vcodec mpeg2video -q:v 7 -threads 4 \
+        -sdp_file {self.sdp_file} \
+        -f rtp rtp://127.0.0.1:{harness_data.rtp_port}'
+
+        self.source = await asyncio.create_subprocess_shell(command, stdin=asyncio.subprocess.PIPE,
+                                                            close_fds=False, shell=True)
+        atexit.register(self.source.kill)
+
+    async def feed_source(self):
+        period = 1.0 / harness_data.fps
+        frame_no = 0
+        next_frame = time.time()
+
+        while time.time() - self.start_time < harness_data.duration:
+            image = render_frame(frame_no)
+            self.rendered[frame_no] = time.time()
+            self.source.stdin.write(image.tobytes())
+            await self.source.stdin.drain()
+
+            frame_no += 1
+            next_frame += period
+            await asyncio.sleep(max(0.0, next_frame - time.time()))
+
+        self.source.stdin.close()
+
+    # Registers with the proxy as a rover and answers every command it forwards
+    async def fake_rover(self):
+        reader, writer = await asyncio.open_connection(harness_data.proxy_address, harness_data.ctrl_port)
+
+        rover_data = {'name': 'Latency harness', 'description': 'Latency harness', 'fov': 60,
+                      'stream_size': [harness_data.width, harness_data.height], 'mobility': []}
+        writer.write((json.dumps({'rover_id': self.rover_id, 'cmd': 'hello', 'rover_data': rover_data}) + '\n').encode())
+
+        # ffmpeg writes the SDP once it has started
+        while not os.path.exists(self.sdp_file) or not os.path.getsize(self.sdp_file):
+            await asyncio.sleep(0.05)
+        with open(self.sdp_file) as f:
+            conf = f.read()
+        writer.write((json.dumps({'rover_id': self.rover_id, 'cmd': 'set_stream', 'conf': conf}) + '\n').encode())
+        await writer.drain()
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            writer.write(b'{"msg": "ok"}\n')
+            await writer.drain()
+
+    # Receives the stream like a jsmpeg page, the pictures go through ffmpeg to get the
+    # frames back in decode order
+    async def fake_viewer(self):
+        async with websockets.connect(f'ws://{harness_data.proxy_address}:{harness_data.stream_port}') as websocket:
+            await websocket.send(json.dumps({'client_id': self.client_id, 'rover_id': self.rover_id,
+                                             'cmd': 'connect'}))
+            await websocket.recv()
+            await websocket.send(json.dumps({'client_id': self.client_id, 'rover_id': self.rover_id,
+                                             'cmd': 'start'}))
+            await websocket.recv()
+
+            # Not -fflags nobuffer, it drops the pictures read while probing and the
+            # arrivals would no longer line up with the decoded frames
+            command = f'ffmpeg -loglevel error -probesize 32 -analyzeduration 0 -flags low_delay \
+            -f mpegvideo -i - -vsync 0 -f rawvideo -pix_fmt bgr24 -'
+
+            decoder = await asyncio.create_subprocess_shell(command, stdin=asyncio.subprocess.PIPE,
+                                                            stdout=asyncio.subprocess.PIPE,
+                                                            close_fds=False, shell=True)
+            atexit.register(decoder.kill)
+
+            # Arrival times of the pictures sent to the decoder, it outputs them in order.
+            # Every picture is stamped with the time its message came in, a message holds
+            # one picture, or the cached GOP when the stream starts.
+            arrivals = []
+            reader_task = asyncio.create_task(self.read_decoded(decoder, arrivals))
+
+            try:
+                while not reader_task.done():
+                    data = await asyncio.wait_for(websocket.recv(), timeout=5.0)
+                    arrivals.extend([time.time()] * data.count(PICTURE_START_CODE))
+                    decoder.stdin.write(data)
+                    await decoder.stdin.drain()
+            except (asyncio.TimeoutError, websockets.ConnectionClosed):
+                pass
+            finally:
+                decoder.stdin.close()
+                await reader_task
+
+    async def read_decoded(self, decoder, arrivals):
+        frame_size = harness_data.width * harness_data.height * 3
+
+        while time.time() - self.start_time < harness_data.duration:
+            try:
+                data = await decoder.stdout.readexactly(frame_size)
+            except asyncio.IncompleteReadError:
+                break
+
+            now = time.time()
+            arrival = arrivals.pop(0) if arrivals else now
+            image = np.frombuffer(data, dtype=np.uint8).reshape((harness_data.height, harness_data.width, 3))
+            frame_no = read_marker(image)
+
+            self.decoded += 1
+            if frame_no is None or frame_no not in self.rendered:
+                self.unreadable += 1
+                continue
+
+            if self.measuring():
+                rendered = self.rendered[frame_no]
+                self.stages['rover_to_viewer'].append(arrival - rendered)
+                self.stages['viewer_decode'].append(now - arrival)
+                self.stages['glass_to_glass'].append(now - rendered)
+
+    # The proxy side of the breakdown, from the metrics in the list response. The
+    # handshake is completed so that the proxy sees a client that simply left.
+    async def proxy_metrics(self):
+        async with websockets.connect(f'ws://{harness_data.proxy_address}:{harness_data.e_ctrl_port}') as websocket:
+            await websocket.send(json.dumps({'client_id': self.client_id, 'cmd': 'hello'}))
+            await websocket.recv()
+            await websocket.send(json.dumps({'client_id': self.client_id, 'cmd': 'list'}))
+            list_response = json.loads(await websocket.recv())
+            await websocket.send(json.dumps({'client_id': self.client_id, 'rover_id': self.rover_id,
+                                             'cmd': 'connect'}))
+            await websocket.recv()
+
+        for rover in list_response['rovers']:
+            if rover['rover_id'] == self.rover_id:
+                return rover.get('metrics', {}).get('stages', {})
+        return {}
+
+    async def run(self):
+        self.start_time = time.time()
+        await self.start_source()
+        source_task = asyncio.create_task(self.feed_source())
+        rover_task = asyncio.create_task(self.fake_rover())
+
+        # Give the proxy time to open the stream before the viewer connects
+        await asyncio.sleep(2.0)
+        await self.fake_viewer()
+
+        report = {'frames_rendered': len(self.rendered),
+                  'frames_decoded': self.decoded,
+                  'frames_unreadable': self.unreadable,
+                  'stages': {name: percentiles(values) for name, values in self.stages.items()},
+                  'proxy_stages': await self.proxy_metrics()}
+
+        source_task.cancel()
+        rover_task.cancel()
+        os.remove(self.sdp_file)
+        return report
+
+
+async def main():
+    global harness_data
+
+    parser = argparse.ArgumentParser(description='Measure glass to glass latency through a running proxy')
+    parser.add_argument('-a', '--proxy_address', default='127.0.0.1', help='The address of the proxy')
+    parser.add_argument('-c', '--control_port', default=6666, type=int, help='The internal ctrl port of the proxy')
+    parser.add_argument('-ctrl', '--external_control_port', default=8888, type=int,
+                        help='The external ctrl port of the proxy')
+    parser.add_argument('-t', '--stream_port', default=8889, type=int, help='The external stream port of the proxy')
+    parser.add_argument('-r', '--rtp_port', default=5004, type=int, help='The port the rendered stream is sent to')
+    parser.add_argument('-s', '--size', default=[640, 480], type=int, nargs=2, help='The size of the frames')
+    parser.add_argument('-f', '--fps', default=30, type=int, help='The frame rate of the rendered stream')
+    parser.add_argument('-d', '--duration', default=30.0, type=float, help='How long to stream, in seconds')
+    parser.add_argument('-w', '--warmup', default=5.0, type=float, help='How long to stream before measuring')
+
+    args = parser.parse_args()
+
+    harness_data.proxy_address = args.proxy_address
+    harness_data.ctrl_port = args.control_port
+    harness_data.e_ctrl_port = args.external_control_port
+    harness_data.stream_port = args.stream_port
+    harness_data.rtp_port = args.rtp_port
+    harness_data.width, harness_data.height = args.size
+    harness_data.fps = args.fps
+    harness_data.duration = args.duration
+    harness_data.warmup = args.warmup
+
+    report = await LatencyHarness().run()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
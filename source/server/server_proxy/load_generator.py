@@ -0,0 +1,306 @@
+import os
+import json
+import argparse
+import asyncio
+import time
+import uuid
+import atexit
+import websockets
+
+from server_proxy import DEFAULT_RENDITION, RENDITIONS, Mpeg1Packetizer
+from latency_harness import percentiles
+
+# Puts a proxy under a growing load of fake rovers, control clients and viewers. Rovers
+# are added one at a time, every one streaming a local file over RTP through ffmpeg,
+# together with their control clients and viewers. A timeline sample is taken every
+# second so that the point where viewers start to fall behind shows up.
+
+
+class LoadData:
+    def __init__(self):
+        self.proxy_address = '127.0.0.1'
+        self.ctrl_port = 6666
+        self.e_ctrl_port = 8888
+        self.stream_port = 8889
+        self.rtp_address = '127.0.0.1'
+        self.rtp_base_port = 5100
+        self.video = None
+        self.size = [640, 480]
+        self.command_rate = 5.0
+        self.renditions = [DEFAULT_RENDITION]
+
+
+load_data = LoadData()
+
+
+# Speaks the rover side of the protocol of RoverRequestHandler, answering every command
+class FakeFleetRover:
+    def __init__(self, index):
+        self.rover_id = str(uuid.uuid1())
+        self.rtp_port = load_data.rtp_base_port + 2 * index
+        self.sdp_file = f'load_{self.rover_id}.sdp'
+        self.source = None
+        self.commands = 0
+        self.setup_time = None
+
+    async def start(self):
+        command = f'ffmpeg -loglevel error -re -stream_loop -1 -i {load_data.video} -an \
+        -vcodec mpeg2video -q:v 7 -s {load_data.size[0]}x{load_data.size[1]} -threads 2 \
+        -sdp_file {self.sdp_file} \
+        -f rtp rtp://{load_data.rtp_address}:{self.rtp_port}'
+
+        self.source = await asyncio.create_subprocess_shell(command, close_fds=False, shell=True)
+        atexit.register(self.source.kill)
+
+        while not os.path.exists(self.sdp_file) or not os.path.getsize(self.sdp_file):
+            await asyncio.sleep(0.05)
+        with open(self.sdp_file) as f:
+            conf = f.read()
+
+        start = time.time()
+        reader, writer = await asyncio.open_connection(load_data.proxy_address, load_data.ctrl_port)
+
+        rover_data = {'name': 'Load generator', 'description': 'Load generator', 'fov': 60,
+                      'stream_size': load_data.size, 'mobility': ['gimbal', 'wheels']}
+        for message in ({'rover_id': self.rover_id, 'cmd': 'hello', 'rover_data': rover_data},
+                        {'rover_id': self.rover_id, 'cmd': 'set_stream', 'conf': conf}):
+            writer.write((json.dumps(message) + '\n').encode())
+        await writer.drain()
+        self.setup_time = time.time() - start
+
+        asyncio.create_task(self.serve(reader, writer))
+
+    async def serve(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            self.commands += 1
+            writer.write(b'{"msg": "ok"}\n')
+            await writer.drain()
+
+    def stop(self):
+        self.source.kill()
+        if os.path.exists(self.sdp_file):
+            os.remove(self.sdp_file)
+
+
+async def send_and_recv(websocket, message):
+    await websocket.send(json.dumps(message) + '\n')
+    return await websocket.recv()
+
+
+# Follows the handshake of test_client.py, then sends a speed setting at command_rate
+# and times the answer of the rover, which the proxy passes back
+class FakeControlClient:
+    def __init__(self, rover_id):
+        self.rover_id = rover_id
+        self.client_id = str(uuid.uuid1())
+        self.setup_time = None
+        self.ack_latencies = []
+        self.failures = 0
+
+    async def run(self):
+        start = time.time()
+        async with websockets.connect(f'ws://{load_data.proxy_address}:{load_data.e_ctrl_port}') as websocket:
+            await send_and_recv(websocket, {'client_id': self.client_id, 'cmd': 'hello'})
+            await send_and_recv(websocket, {'client_id': self.client_id, 'cmd': 'list'})
+            await send_and_recv(websocket, {'client_id': self.client_id, 'rover_id': self.rover_id,
+                                            'cmd': 'connect'})
+            self.setup_time = time.time() - start
+
+            speed = 0.3
+            while True:
+                speed = 0.6 if speed == 0.3 else 0.3
+                sent = time.time()
+                response = json.loads(await send_and_recv(websocket, {'cmd': 'set_speed', 'params': {'speed': speed}}))
+                self.ack_latencies.append(time.time() - sent)
+                if response.get('msg') != 'ok':
+                    self.failures += 1
+                await asyncio.sleep(1.0 / load_data.command_rate)
+
+
+# Receives a stream like the jsmpeg page, counting pictures and bytes
+class FakeStreamViewer:
+    def __init__(self, rover_id, rendition):
+        self.rover_id = rover_id
+        self.rendition = rendition
+        self.client_id = str(uuid.uuid1())
+        self.setup_time = None
+        self.first_picture_time = None
+        self.pictures = 0
+        self.received_bytes = 0
+        self.last_sample = (time.time(), 0, 0)
+        self.fps = 0.0
+        self.bitrate = 0.0
+
+    async def run(self):
+        start = time.time()
+        packetizer = Mpeg1Packetizer()
+
+        async with websockets.connect(f'ws://{load_data.proxy_address}:{load_data.stream_port}') as websocket:
+            await send_and_recv(websocket, {'client_id': self.client_id, 'rover_id': self.rover_id, 'cmd': 'connect',
+                                            'rendition': self.rendition})
+            await websocket.send(json.dumps({'client_id': self.client_id, 'rover_id': self.rover_id,
+                                             'cmd': 'start'}))
+            await websocket.recv()
+            self.setup_time = time.time() - start
+
+            while True:
+                data = await websocket.recv()
+                self.received_bytes += len(data)
+                self.pictures += len(packetizer.feed(data))
+                if self.first_picture_time is None and self.pictures:
+                    self.first_picture_time = time.time() - start
+
+    # The frame and bit rates since the last sample
+    def sample(self):
+        now = time.time()
+        last_time, last_pictures, last_bytes = self.last_sample
+        elapsed = now - last_time
+        self.fps = (self.pictures - last_pictures) / elapsed
+        self.bitrate = (self.received_bytes - last_bytes) * 8 / elapsed
+        self.last_sample = (now, self.pictures, self.received_bytes)
+
+
+class LoadGenerator:
+    def __init__(self, rovers, clients, viewers, ramp_interval, duration):
+        self.rover_count = rovers
+        self.client_count = clients
+        self.viewer_count = viewers
+        self.ramp_interval = ramp_interval
+        self.duration = duration
+
+        self.rovers = []
+        self.clients = []
+        self.viewers = []
+        self.tasks = []
+        self.timeline = []
+        self.start_time = None
+
+    async def add_rover(self, index):
+        rover = FakeFleetRover(index)
+        await rover.start()
+        self.rovers.append(rover)
+
+        # The proxy needs a moment to open the stream
+        await asyncio.sleep(1.0)
+
+        for i in range(self.client_count):
+            client = FakeControlClient(rover.rover_id)
+            self.clients.append(client)
+            self.tasks.append(asyncio.create_task(client.run()))
+
+        # Viewers are spread over the renditions in turn
+        for i in range(self.viewer_count):
+            viewer = FakeStreamViewer(rover.rover_id, load_data.renditions[i % len(load_data.renditions)])
+            self.viewers.append(viewer)
+            self.tasks.append(asyncio.create_task(viewer.run()))
+
+    def sample(self):
+        for viewer in self.viewers:
+            viewer.sample()
+
+        fps = list(map(lambda v: v.fps, self.viewers))
+        self.timeline.append({'time': time.time() - self.start_time,
+                              'rovers': len(self.rovers),
+                              'clients': len(self.clients),
+                              'viewers': len(self.viewers),
+                              'viewer_fps_avg': sum(fps) / max(len(fps), 1),
+                              'viewer_fps_min': min(fps, default=0.0),
+                              'total_bitrate': sum(map(lambda v: v.bitrate, self.viewers)),
+                              'ack_latency': percentiles(sum(map(lambda c: c.ack_latencies[-int(load_data.command_rate):],
+                                                                 self.clients), []))})
+
+    async def sample_loop(self):
+        while True:
+            await asyncio.sleep(1.0)
+            self.sample()
+
+    async def run(self):
+        self.start_time = time.time()
+        sampler = asyncio.create_task(self.sample_loop())
+
+        for index in range(self.rover_count):
+            await self.add_rover(index)
+            await asyncio.sleep(self.ramp_interval)
+
+        await asyncio.sleep(self.duration)
+        sampler.cancel()
+
+        for task in self.tasks:
+            task.cancel()
+        for rover in self.rovers:
+            rover.stop()
+
+        return self.report()
+
+    def report(self):
+        def setup_times(items, attribute):
+            return percentiles(list(filter(lambda t: t is not None, map(lambda i: getattr(i, attribute), items))))
+
+        return {'config': {'rovers': self.rover_count, 'clients_per_rover': self.client_count,
+                           'viewers_per_rover': self.viewer_count, 'ramp_interval': self.ramp_interval,
+                           'video': load_data.video, 'size': load_data.size,
+                           'command_rate': load_data.command_rate, 'renditions': load_data.renditions},
+                'rover_setup': setup_times(self.rovers, 'setup_time'),
+                'control_setup': setup_times(self.clients, 'setup_time'),
+                'viewer_setup': setup_times(self.viewers, 'setup_time'),
+                'viewer_first_picture': setup_times(self.viewers, 'first_picture_time'),
+                'ack_latency': percentiles(sum(map(lambda c: c.ack_latencies, self.clients), [])),
+                'ack_failures': sum(map(lambda c: c.failures, self.clients)),
+                'rover_commands': list(map(lambda r: r.commands, self.rovers)),
+                'viewers': list(map(lambda v: {'rover_id': v.rover_id, 'rendition': v.rendition, 'fps': v.fps,
+                                               'bitrate': v.bitrate, 'pictures': v.pictures}, self.viewers)),
+                'timeline': self.timeline}
+
+
+async def main():
+    global load_data
+
+    parser = argparse.ArgumentParser(description='Load a proxy with fake rovers, control clients and viewers')
+    parser.add_argument('video', help='The video file every fake rover streams in a loop')
+    parser.add_argument('-a', '--proxy_address', default='127.0.0.1', help='The address of the proxy')
+    parser.add_argument('-c', '--control_port', default=6666, type=int, help='The internal ctrl port of the proxy')
+    parser.add_argument('-ctrl', '--external_control_port', default=8888, type=int,
+                        help='The external ctrl port of the proxy')
+    parser.add_argument('-t', '--stream_port', default=8889, type=int, help='The external stream port of the proxy')
+    parser.add_argument('--rtp_address', default='127.0.0.1', help='The address the RTP streams are sent to')
+    parser.add_argument('--rtp_base_port', default=5100, type=int, help='The RTP port of the first rover')
+    parser.add_argument('-s', '--size', default=[640, 480], type=int, nargs=2, help='The size of the streams')
+    parser.add_argument('-n', '--rovers', default=4, type=int, help='How many rovers to add')
+    parser.add_argument('-m', '--clients', default=1, type=int, help='How many control clients per rover')
+    parser.add_argument('-v', '--viewers', default=2, type=int, help='How many viewers per rover')
+    parser.add_argument('-e', '--renditions', default=[DEFAULT_RENDITION], nargs='+',
+                        choices=list(map(lambda r: r[0], RENDITIONS)),
+                        help='The renditions the viewers of a rover watch, assigned to them in turn')
+    parser.add_argument('--command_rate', default=5.0, type=float,
+                        help='How many commands a second every control client sends')
+    parser.add_argument('--ramp_interval', default=10.0, type=float, help='Seconds between two rovers')
+    parser.add_argument('-d', '--duration', default=30.0, type=float, help='How long to hold the full load')
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of printing it')
+
+    args = parser.parse_args()
+
+    load_data.proxy_address = args.proxy_address
+    load_data.ctrl_port = args.control_port
+    load_data.e_ctrl_port = args.external_control_port
+    load_data.stream_port = args.stream_port
+    load_data.rtp_address = args.rtp_address
+    load_data.rtp_base_port = args.rtp_base_port
+    load_data.video = args.video
+    load_data.size = args.size
+    load_data.command_rate = args.command_rate
+    load_data.renditions = args.renditions
+
+    report = await LoadGenerator(args.rovers, args.clients, args.viewers, args.ramp_interval, args.duration).run()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -4,45 +4,164 @@ import argparse
 import asyncio
 import time
 import uuid
+import collections
 import atexit
 import math
 import numpy as np
 
 import websockets
 import threading
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 from struct import Struct
+from fractions import Fraction
 import cv2
 
-STREAM_BLOCKSIZE = 256
-
-
+try:
+    import av
+except ImportError:
+    av = None
+
+from control_encoding import JsonCodec, control_codec, negotiate_encoding
+
+STREAM_READ_SIZE = 65536
+FRAME_POOL_SIZE = 4
+STREAM_CLIENT_QUEUE_SIZE = 64
+GOP_CACHE_MAX_BYTES = 4 * 1024 * 1024
+WORKER_RING_SLOTS = 32
+WORKER_RING_SLOT_SIZE = 512 * 1024
+WORKER_STATE_INTERVAL = 1.0
+PASSTHROUGH_RESTART_DELAY = 1.0
+# Name prefix of the threads of the CV pool, which every rover shares
+CV_THREAD_PREFIX = 'cv'
+
+# 'ffmpeg' pipes raw frames to an ffmpeg process, 'pyav' encodes inside the proxy and
+# needs PyAV installed
+ENCODER_BACKENDS = ('ffmpeg', 'pyav')
+# Frames handed to an in-process encoder and not encoded yet before the pipeline waits
+AV_ENCODER_QUEUE_SIZE = 4
+# The frame rate ffmpeg assumes for rawvideo input, so both backends rate control alike
+AV_ENCODER_FRAMERATE = 25
+# The lambda per quantizer step libav expects in global_quality
+AV_QP2LAMBDA = 118
+
+# Commands where only the latest value matters, a queued one is overwritten by a newer one
+COALESCED_COMMANDS = {'set_speed', 'set_cam_speed'}
+
+# Gains of the follow controllers: kp, ki, kd and the exponent of the proportional term,
+# over the offset of the target from the frame centre as a fraction of the frame size, or
+# the change of its area for approach. The defaults keep the response curves the follow
+# logic always had: the camera at 90 * offset ** 1.2 degrees per second, the wheels at
+# 0.1 * (1 + area change) when approaching and at 0.005 * (1 + offset ** 3) when turning.
+FOLLOW_GAINS = {'camera': (90.0, 0.0, 0.0, 1.2), 'approach': (0.1, 0.0, 0.0, 1.0), 'turn': (0.005, 0.0, 0.0, 3.0)}
+# The most the camera turns, in degrees per second, and the base wheel speeds the
+# approach and turn outputs are added to
+FOLLOW_CAMERA_SPEED_LIMIT = 90.0
+FOLLOW_APPROACH_SPEED = 0.1
+FOLLOW_TURN_SPEED = 0.005
+
+# Speed quantization steps of the follow controller, per command
+FOLLOW_SPEED_STEPS = {'set_cam_speed': 1.0, 'set_speed': 0.005}
+FOLLOW_SPEED_HYSTERESIS = 0.25
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+LOOP_LAG_INTERVAL = 0.1
+CONTROL_IN_FLIGHT_MAX = 256
+# How long a client waits for the rover to answer a forwarded command, in seconds
+CONTROL_RESPONSE_TIMEOUT = 2.0
+# How often the rover is asked for its serial link and sensor state, in seconds
+STATUS_POLL_INTERVAL = 1.0
+
+# An observation older than this stops the motors the follow controller drives, in seconds
+CONTROL_TIMEOUT = 0.5
+
+MPEG1_START_CODE = b'\x00\x00\x01'
+MPEG1_PICTURE_CODE = 0x00
+MPEG1_SEQUENCE_HEADER_CODE = 0xB3
+MPEG1_GOP_CODE = 0xB8
+
+MPEG1_I_PICTURE = 1
+MPEG1_P_PICTURE = 2
+MPEG1_B_PICTURE = 3
+
+PACKET_TYPE_MASK = 0xFF
+PACKET_SEQUENCE_HEADER_FLAG = 0x100
+PACKET_RENDITION_SHIFT = 16
+
+# The output ladder of every rover: name, scale of the stream size and bitrate cap, no
+# cap encodes at constant quality. A viewer picks one when it connects, only renditions
+# somebody is watching are encoded.
+RENDITIONS = (('full', 1.0, None), ('half', 0.5, '800k'), ('quarter', 0.25, '300k'))
+DEFAULT_RENDITION = 'full'
+
+
+# A fixed size ring of floats in a preallocated numpy array, keeping the sum, mean and
+# variance of the window up to date on every append (sliding Welford update) so that
+# reading them allocates nothing. The running values are recomputed from the array
+# every recompute_interval appends to keep rounding errors from piling up.
 class RingBuffer(object):
-    def __init__(self, size, initializer=None):
+    def __init__(self, size, initializer=None, recompute_interval=1024):
         """Initialization"""
         self.index = 0
         self.size = size
-        self.data = list(initializer for i in range(self.size))
+        self.recompute_interval = recompute_interval
+        self.data = np.empty(size, dtype=np.float64)
+        self.set_all(initializer if initializer is not None else 0.0)
 
     def append(self, value):
         """Append an element"""
+        old = float(self.data[self.index])
         self.data[self.index] = value
         self.index = (self.index + 1) % self.size
 
+        self.appends += 1
+        if self.appends % self.recompute_interval == 0:
+            self.recompute()
+            return
+
+        value = float(value)
+        delta = value - old
+        old_mean = self.mean
+        self.total += delta
+        self.mean += delta / self.size
+        self.m2 = max(0.0, self.m2 + delta * (value - self.mean + old - old_mean))
+
     def set_all(self, value):
-        self.data = list(value for i in range(self.size))
+        self.data.fill(value)
         self.index = 0
+        self.appends = 0
+        self.total = float(value) * self.size
+        self.mean = float(value)
+        self.m2 = 0.0
+
+    def recompute(self):
+        self.total = float(self.data.sum())
+        self.mean = self.total / self.size
+        self.m2 = float(np.square(self.data - self.mean).sum())
+
+    @property
+    def variance(self):
+        """Population variance of the window"""
+        return self.m2 / self.size
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def __len__(self):
+        return self.size
 
     def __getitem__(self, key):
         """Get element by index, relative to the current index"""
-        if len(self.data) == self.size:
-            return self.data[(key + self.index) % self.size]
-        else:
-            return self.data[key]
+        return self.data[(key + self.index) % self.size]
 
     def __repr__(self):
         """Return string representation"""
-        return self.data.__repr__() + ' (' + str(len(self.data)) + ' items)'
+        return self.data.__repr__() + ' (' + str(self.size) + ' items)'
 
 
 class ServerData:
@@ -50,6 +169,16 @@ class ServerData:
         self.stream_port = 8889
         self.ctrl_port = 6666
         self.e_ctrl_port = 8888
+        self.detection_scale = 0.5
+        self.detection_window_padding = 0.5
+        self.rover_processes = False
+        self.control_rate = 20.0
+        self.follow_gains = dict(FOLLOW_GAINS)
+        # The local port of the /metrics endpoint, None to not serve it
+        self.metrics_port = None
+        self.passthrough = False
+        self.encoder = 'ffmpeg'
+        self.rover_encoders = dict()
 
 
 class StreamData:
@@ -64,11 +193,729 @@ class StreamData:
 server_data = ServerData()
 
 
+# One encoded picture, together with any sequence or GOP header preceding it
+class StreamPacket:
+    def __init__(self, data, picture_type, has_sequence_header):
+        self.data = data
+        self.picture_type = picture_type
+        self.has_sequence_header = has_sequence_header
+
+    @property
+    def keyframe(self):
+        return self.picture_type == MPEG1_I_PICTURE
+
+
+# Splits the MPEG-1 elementary stream coming out of the encoder on picture boundaries.
+# A packet starts at a sequence header, a GOP header or a picture start code and runs
+# until the next one of those that follows picture data, so slices always stay with
+# their picture. A picture is emitted as soon as the start of the next one is seen.
+class Mpeg1Packetizer:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.picture_type = None
+        self.has_sequence_header = False
+
+    def feed(self, data):
+        packets = []
+        buf = self.buffer
+        buf += data
+
+        pos = self.scan_pos
+        while True:
+            i = buf.find(MPEG1_START_CODE, pos)
+            # The code byte, and for pictures the coding type, must be in the buffer
+            if i < 0 or i + 5 >= len(buf):
+                break
+
+            code = buf[i + 3]
+            if code in (MPEG1_PICTURE_CODE, MPEG1_SEQUENCE_HEADER_CODE, MPEG1_GOP_CODE):
+                if self.picture_type is not None:
+                    packets.append(StreamPacket(bytes(buf[:i]), self.picture_type, self.has_sequence_header))
+                    del buf[:i]
+                    i = 0
+                    self.picture_type = None
+                    self.has_sequence_header = False
+
+                if code == MPEG1_SEQUENCE_HEADER_CODE:
+                    self.has_sequence_header = True
+                elif code == MPEG1_PICTURE_CODE:
+                    # 10 bits of temporal reference, then 3 bits of picture coding type
+                    self.picture_type = (buf[i + 5] >> 3) & 0x07
+
+            pos = i + 3
+
+        # Keep the last bytes in the scan window, a start code may straddle two reads
+        self.scan_pos = max(pos, len(buf) - 5, 0)
+        return packets
+
+    def flush(self):
+        packets = []
+        if self.buffer and self.picture_type is not None:
+            packets.append(StreamPacket(bytes(self.buffer), self.picture_type, self.has_sequence_header))
+        self.reset()
+        return packets
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.picture_type = None
+        self.has_sequence_header = False
+
+
+# Holds the packets from the most recent sequence header onwards, so that a new viewer
+# can be handed a decodable picture straight away instead of waiting for the next GOP
+class GopCache:
+    def __init__(self, max_bytes=GOP_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.packets = []
+        self.size = 0
+
+    def add(self, packet):
+        if packet.has_sequence_header:
+            self.packets = [packet]
+            self.size = len(packet.data)
+        elif self.packets:
+            if self.size + len(packet.data) > self.max_bytes:
+                # The GOP is too long to cache, wait for the next sequence header
+                self.clear()
+                return
+            self.packets.append(packet)
+            self.size += len(packet.data)
+
+    def clear(self):
+        self.packets = []
+        self.size = 0
+
+    def snapshot(self):
+        return b''.join(map(lambda p: p.data, self.packets))
+
+
+# One step of the output ladder of a rover, with its own encoder, GOP cache and viewers.
+# Every rendition is encoded from the same decoded frames.
+class Rendition:
+    def __init__(self, index, name, scale, bitrate, stream_data):
+        self.index = index
+        self.name = name
+        self.scale = scale
+        self.bitrate = bitrate
+        # The encoder wants even sizes for 4:2:0
+        self.width = max(2, int(stream_data.width * scale) // 2 * 2)
+        self.height = max(2, int(stream_data.height * scale) // 2 * 2)
+        self.converter = None
+        self.encoder = None
+        self.streaming_task = None
+        self.gop_cache = GopCache()
+        self.stream_clients = dict()
+        # Write times of the frames the encoder has not output yet
+        self.encoder_in_flight = collections.deque(maxlen=STREAM_CLIENT_QUEUE_SIZE)
+
+    def encoding(self):
+        return self.converter is not None or self.encoder is not None
+
+    def encoder_options(self):
+        if self.bitrate is None:
+            return '-q:v 7'
+        return f'-b:v {self.bitrate} -maxrate {self.bitrate} -bufsize {self.bitrate}'
+
+    # The same settings as encoder_options, as libav codec options
+    def av_options(self):
+        if self.bitrate is None:
+            return {'flags': '+qscale', 'global_quality': str(7 * AV_QP2LAMBDA)}
+        return {'b': self.bitrate, 'maxrate': self.bitrate, 'bufsize': self.bitrate}
+
+    def resize(self, image):
+        if image.shape[1] == self.width and image.shape[0] == self.height:
+            return image
+        return cv2.resize(image, (self.width, self.height), interpolation=cv2.INTER_AREA)
+
+    def stats(self):
+        return {'name': self.name,
+                'size': [self.width, self.height],
+                'bitrate': self.bitrate,
+                'stream_clients': len(self.stream_clients)}
+
+
+# An MPEG-1 encoder inside the proxy process, encoding numpy frames with libav on a
+# thread of its own instead of piping them to an ffmpeg process. The output of every
+# frame is a future, queued in frame order for the streaming task.
+class AvEncoder:
+    def __init__(self, width, height, options):
+        self.codec = av.CodecContext.create('mpeg1video', 'w')
+        self.codec.width = width
+        self.codec.height = height
+        self.codec.pix_fmt = 'yuv420p'
+        self.codec.framerate = AV_ENCODER_FRAMERATE
+        self.codec.time_base = Fraction(1, AV_ENCODER_FRAMERATE)
+        self.codec.options = options
+        self.codec.open()
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.thread_id = None
+        self.pts = 0
+        # Futures of the encoded output in frame order, None once closed
+        self.output = asyncio.Queue()
+        self.pending = collections.deque()
+
+    # Runs on the encoder thread, None flushes the frames the codec still holds
+    def encode(self, frame):
+        self.thread_id = threading.get_native_id()
+        if frame is not None:
+            frame = frame.reformat(format='yuv420p')
+        return b''.join(map(bytes, self.codec.encode(frame)))
+
+    def submit(self, frame):
+        future = asyncio.wrap_future(self.executor.submit(self.encode, frame))
+        self.output.put_nowait(future)
+        self.pending.append(future)
+
+    def write(self, image):
+        # Copies the image, the pooled frame can be released right after
+        frame = av.VideoFrame.from_ndarray(image, format='bgr24')
+        frame.pts = self.pts
+        self.pts += 1
+        self.submit(frame)
+
+    # Holds the pipeline back while the encoder is behind, as a full pipe would
+    async def drain(self):
+        while self.pending and self.pending[0].done():
+            self.pending.popleft()
+        while len(self.pending) > AV_ENCODER_QUEUE_SIZE:
+            await self.pending.popleft()
+
+    def close(self):
+        self.submit(None)
+        self.output.put_nowait(None)
+
+    # The output of the next frame, possibly empty while the codec holds it, None at the end
+    async def read(self):
+        future = await self.output.get()
+        if future is None:
+            self.executor.shutdown(wait=False)
+            return None
+        return await future
+
+
+# A cumulative latency histogram with fixed buckets, cheap enough to observe every
+# frame. Quantiles are estimated as the upper bound of the bucket they fall in, those in
+# the overflow bucket as the last bound, so that they stay valid JSON.
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        # The largest value seen, the best estimate there is for the overflow bucket
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    # The upper bound of the bucket the quantile falls in, or the largest value seen if
+    # that is lower, which is also the value for the overflow bucket
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'count': self.count, 'total': self.total, 'max': self.max}
+
+    def load(self, snapshot):
+        self.counts = list(snapshot['counts'])
+        self.count = snapshot['count']
+        self.total = snapshot['total']
+        self.max = snapshot['max']
+
+    def stats(self):
+        return {'count': self.count,
+                'avg_ms': self.total / max(self.count, 1) * 1000.0,
+                'p50_ms': self.quantile(0.5) * 1000.0,
+                'p95_ms': self.quantile(0.95) * 1000.0,
+                'p99_ms': self.quantile(0.99) * 1000.0,
+                'max_ms': self.max * 1000.0}
+
+    def prometheus(self, name, labels):
+        lines = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {seen}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+# The latency histograms of the pipeline stages of a rover and its event counters
+class PipelineMetrics:
+    def __init__(self):
+        self.stages = dict()
+        self.counters = dict()
+
+    def stage(self, name):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = Histogram()
+        return histogram
+
+    def observe(self, name, seconds):
+        self.stage(name).observe(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        return {'stages': {name: h.snapshot() for name, h in self.stages.items()},
+                'counters': dict(self.counters)}
+
+    def load(self, snapshot):
+        for name, histogram in snapshot['stages'].items():
+            self.stage(name).load(histogram)
+        self.counters = dict(snapshot['counters'])
+
+    def stats(self):
+        return {'stages': {name: h.stats() for name, h in self.stages.items()},
+                'counters': dict(self.counters)}
+
+    def prometheus_stages(self, labels):
+        lines = []
+        for name, histogram in sorted(self.stages.items()):
+            lines += histogram.prometheus('proxy_stage_seconds', f'{labels},stage="{name}"')
+        return lines
+
+    def prometheus_counters(self, labels):
+        return list(f'proxy_events_total{{{labels},event="{name}"}} {value}'
+                    for name, value in sorted(self.counters.items()))
+
+
+# Measures by how much the loop oversleeps a short timer, which is how long ready
+# callbacks had to wait for the loop
+async def monitor_loop_lag(histogram, interval=LOOP_LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - start - interval))
+
+
+# A single producer, single consumer ring of fixed size slots in shared memory, used to
+# move media between processes without pickling. The header holds the write and read
+# counters, which only ever grow: the producer owns the first, the consumer the second,
+# so no lock is needed across the processes. Every slot starts with the payload length
+# and a flags word.
+class SharedMemoryRing:
+    slot_header = Struct('<II')
+
+    def __init__(self, name=None, slots=WORKER_RING_SLOTS, slot_size=WORKER_RING_SLOT_SIZE):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = self.slot_header.size + slot_size
+
+        size = 16 + slots * self.stride
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.owner = name is None
+
+        # Aligned 64 bit stores, a counter is never seen half written
+        self.counters = np.ndarray((2,), dtype=np.uint64, buffer=self.shm.buf)
+        if self.owner:
+            self.counters[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def slot_offset(self, seq):
+        return 16 + (seq % self.slots) * self.stride
+
+    # Returns False when the ring is full or the payload does not fit in a slot
+    def write(self, data, flags=0):
+        write_seq = int(self.counters[0])
+        if write_seq - int(self.counters[1]) >= self.slots or len(data) > self.slot_size:
+            return False
+
+        offset = self.slot_offset(write_seq)
+        self.slot_header.pack_into(self.shm.buf, offset, len(data), flags)
+        start = offset + self.slot_header.size
+        self.shm.buf[start:start + len(data)] = data
+
+        self.counters[0] = write_seq + 1
+        return True
+
+    # A view of the oldest unread payload and its flags, valid until advance() is called
+    def peek(self):
+        read_seq = int(self.counters[1])
+        if read_seq == int(self.counters[0]):
+            return None
+
+        offset = self.slot_offset(read_seq)
+        length, flags = self.slot_header.unpack_from(self.shm.buf, offset)
+        start = offset + self.slot_header.size
+        return self.shm.buf[start:start + length], flags
+
+    def advance(self):
+        self.counters[1] = int(self.counters[1]) + 1
+
+    def read(self):
+        item = self.peek()
+        if item is None:
+            return None
+
+        view, flags = item
+        data = bytes(view)
+        view.release()
+        self.advance()
+        return data, flags
+
+    def pending(self):
+        return int(self.counters[0]) - int(self.counters[1])
+
+    def close(self):
+        del self.counters
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# A stream viewer with its own bounded send queue and writer task, so that a slow
+# websocket only ever delays itself. When the queue overflows the backlog is thrown
+# away and the client is skipped ahead to the next keyframe.
+class StreamClient:
+    def __init__(self, client_id, websocket, primer=b'', queue_size=STREAM_CLIENT_QUEUE_SIZE, metrics=None):
+        self.client_id = client_id
+        self.websocket = websocket
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+        self.primer = primer
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.writer_task = None
+        self.waiting_keyframe = False
+        # Without a primer the decoder has not seen a sequence header yet
+        self.waiting_sequence_header = not primer
+        self.closed = False
+
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.skips = 0
+
+    def start(self):
+        self.writer_task = asyncio.create_task(self.write_loop())
+        return self
+
+    def stop(self):
+        self.closed = True
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+
+    def push(self, packet):
+        if self.closed:
+            return
+
+        if self.waiting_sequence_header:
+            if not packet.has_sequence_header:
+                return
+            self.waiting_sequence_header = False
+
+        if self.waiting_keyframe:
+            if not packet.keyframe:
+                self.dropped += 1
+                return
+            self.waiting_keyframe = False
+
+        try:
+            self.queue.put_nowait(packet.data)
+        except asyncio.QueueFull:
+            self.skips += 1
+            self.dropped += self.clear_queue()
+
+            if packet.keyframe:
+                self.queue.put_nowait(packet.data)
+            else:
+                self.dropped += 1
+                self.waiting_keyframe = True
+
+    def clear_queue(self):
+        cleared = 0
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            cleared += 1
+        return cleared
+
+    async def write_loop(self):
+        try:
+            if self.primer:
+                await self.websocket.send(self.primer)
+                self.sent += 1
+                self.sent_bytes += len(self.primer)
+                self.primer = b''
+
+            while True:
+                buf = await self.queue.get()
+                start = time.perf_counter()
+                await self.websocket.send(buf)
+                self.metrics.observe('fanout_send', time.perf_counter() - start)
+                self.sent += 1
+                self.sent_bytes += len(buf)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            print(f'Stream client {self.client_id} send failed')
+        finally:
+            self.closed = True
+
+    def stats(self):
+        return {'client_id': self.client_id,
+                'queue_depth': self.queue.qsize(),
+                'sent': self.sent,
+                'sent_bytes': self.sent_bytes,
+                'dropped': self.dropped,
+                'skips': self.skips}
+
+
+# The outbound side of the TCP link to a rover. Messages are queued without waiting
+# and a writer task sends everything queued during one loop tick with a single write
+# and a single drain, in order. A COALESCED_COMMANDS message still waiting to be sent
+# is replaced in place by a newer one of the same kind if nothing was queued after it,
+# so the rover still gets the kinds in the order they were sent. Client messages get a
+# future of the answer of the rover.
+#
+# Every message carries a sequence number the rover puts in its answer, so answers are
+# matched by it. The rover answers in order, messages sent before the one answered are
+# given up on. An answer without a number, from an older rover or to a message it could
+# not read, is the answer to the oldest message waiting.
+class RoverCommandChannel:
+    def __init__(self, writer, metrics=None, codec=None):
+        self.writer = writer
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+        self.codec = codec if codec is not None else JsonCodec()
+        self.pending = []
+        self.ready = asyncio.Event()
+        self.writer_task = None
+        self.next_seq = 1
+        # Sequence number to the write time and answer future of the messages the rover
+        # has not answered yet, oldest first
+        self.in_flight = collections.OrderedDict()
+
+        self.messages = 0
+        self.replaced = 0
+        self.batches = 0
+        self.written_bytes = 0
+        self.lost = 0
+        # The serial link and sensor state of the last status response of the rover
+        self.rover_serial = None
+        self.rover_sensors = None
+
+    def start(self):
+        if self.writer_task is None:
+            self.writer_task = asyncio.create_task(self.write_loop())
+        return self
+
+    def stop(self):
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+
+    # The message, given as dictionary, numbered and in the encoding of the link
+    def encode(self, message):
+        seq = self.next_seq
+        self.next_seq = self.next_seq % 0xFFFFFFFF + 1
+        return seq, self.codec.encode(dict(message, seq=seq))
+
+    # Queues a message of the follow logic, given as dictionary
+    def send(self, message):
+        cmd = message['cmd']
+        seq, data = self.encode(message)
+
+        if cmd in COALESCED_COMMANDS and self.pending and self.pending[-1][0] == cmd:
+            self.pending[-1][1] = data
+            self.pending[-1][3] = seq
+            self.replaced += 1
+            return
+
+        self.queue(cmd, data, None, seq)
+
+    # Queues a message of a client, given as dictionary, it is never coalesced. Returns a
+    # future of the answer of the rover.
+    def forward(self, message):
+        seq, data = self.encode(message)
+        response = asyncio.get_running_loop().create_future()
+        self.queue(None, data, response, seq)
+        return response
+
+    def queue(self, cmd, data, response, seq):
+        self.pending.append([cmd, data, response, seq])
+        self.messages += 1
+        self.ready.set()
+        self.start()
+
+    async def write_loop(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+
+            entries = self.pending
+            batch = b''.join(map(lambda entry: entry[1], entries))
+            self.pending = []
+
+            try:
+                self.writer.write(batch)
+                now = time.perf_counter()
+                for cmd, data, response, seq in entries:
+                    self.in_flight[seq] = (now, response)
+                # A rover that stopped answering, the oldest messages are given up on
+                while len(self.in_flight) > CONTROL_IN_FLIGHT_MAX:
+                    self.give_up(self.in_flight.popitem(last=False)[1])
+                await self.writer.drain()
+                self.batches += 1
+                self.written_bytes += len(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(e)
+
+    def give_up(self, waiting):
+        sent, future = waiting
+        self.lost += 1
+        self.metrics.count('control_lost')
+        if future is not None and not future.done():
+            future.set_result({'msg': 'failed', 'info': 'rover_no_response'})
+
+    # Called for every message the rover sends back
+    def on_response(self, response):
+        seq = response.pop('seq', None)
+        if seq is None and self.in_flight:
+            seq = next(iter(self.in_flight))
+
+        if seq in self.in_flight:
+            while True:
+                answered, waiting = self.in_flight.popitem(last=False)
+                if answered == seq:
+                    break
+                self.give_up(waiting)
+
+            sent, future = waiting
+            self.metrics.observe('control_rtt', time.perf_counter() - sent)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+        self.metrics.count('control_responses')
+        if response.get('msg') != 'ok':
+            self.metrics.count('control_failures')
+        if 'serial' in response:
+            self.rover_serial = response['serial']
+        if 'sensors' in response:
+            self.rover_sensors = response['sensors']
+
+    # Called for every answer of the rover that cannot be read, it is taken to be the
+    # one to the oldest message waiting
+    def on_bad_response(self):
+        if self.in_flight:
+            self.give_up(self.in_flight.popitem(last=False)[1])
+
+    def stats(self):
+        return {'queued': len(self.pending),
+                'in_flight': len(self.in_flight),
+                'channel_messages': self.messages,
+                'channel_replaced': self.replaced,
+                'channel_batches': self.batches,
+                'channel_bytes': self.written_bytes,
+                'channel_lost': self.lost,
+                'rover_serial': self.rover_serial,
+                'rover_sensors': self.rover_sensors}
+
+
+# Stands in for the command channel inside a worker process, whatever the follow logic
+# sends to the rover is handed to the front process, whose channel numbers, coalesces
+# and writes it on the TCP link
+class PipeCommandChannel:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send(self, message):
+        self.conn.send(('rover', message))
+
+    def stats(self):
+        return {}
+
+
+CASCADE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'haarcascades')
+
+# The target classes a rover can track, with their cascade and the smallest object
+# size worth reporting at full resolution
+TARGET_CLASSES = {
+    'face': ('haarcascade_frontalface_alt.xml', (30, 30)),
+    'face_default': ('haarcascade_frontalface_default.xml', (30, 30)),
+    'profile_face': ('haarcascade_profileface.xml', (30, 30)),
+    'upper_body': ('haarcascade_upperbody.xml', (60, 60)),
+    'lower_body': ('haarcascade_lowerbody.xml', (40, 60)),
+    'full_body': ('haarcascade_fullbody.xml', (30, 60)),
+    'cat_face': ('haarcascade_frontalcatface.xml', (30, 30))
+}
+
+
+# Loads every cascade the first time it is asked for. detectMultiScale changes the state
+# of the classifier, so every CV thread gets an instance of its own, shared among all
+# rovers. Load and detection times are recorded per cascade, so the cheapest one that
+# works for a deployment can be picked.
+class CascadeRegistry:
+    def __init__(self, cascade_dir=CASCADE_DIR):
+        self.cascade_dir = cascade_dir
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.timings = dict()
+
+    def get(self, target_class):
+        cascades = getattr(self.local, 'cascades', None)
+        if cascades is None:
+            cascades = self.local.cascades = dict()
+
+        if target_class not in cascades:
+            file_name = TARGET_CLASSES[target_class][0]
+
+            start = time.perf_counter()
+            cascade = cv2.CascadeClassifier(os.path.join(self.cascade_dir, file_name))
+            if cascade.empty():
+                raise IOError(f'Could not load cascade {file_name}')
+            load_ms = 1000.0 * (time.perf_counter() - start)
+
+            cascades[target_class] = cascade
+            with self.lock:
+                if target_class not in self.timings:
+                    self.timings[target_class] = {'load_ms': load_ms, 'detections': 0, 'detect_ms': 0.0}
+                    print(f'Loaded cascade {file_name}')
+
+        return cascades[target_class]
+
+    def record(self, target_class, elapsed):
+        with self.lock:
+            timing = self.timings[target_class]
+            timing['detections'] += 1
+            timing['detect_ms'] += 1000.0 * elapsed
+
+    def stats(self):
+        with self.lock:
+            return dict((target_class, {'load_ms': t['load_ms'],
+                                        'detections': t['detections'],
+                                        'avg_detect_ms': t['detect_ms'] / max(t['detections'], 1)})
+                        for target_class, t in self.timings.items())
+
+
 class CVHelper(object):
 
     def __init__(self):
-        cascade_path = './haarcascades/haarcascade_frontalface_alt.xml'
-        self.face_cascade = cv2.CascadeClassifier(cascade_path)
+        self.cascades = CascadeRegistry()
 
         self.object_trackers = {
             "csrt": cv2.TrackerCSRT_create,
@@ -80,36 +927,380 @@ class CVHelper(object):
             "mosse": cv2.TrackerMOSSE_create
         }
 
-    def detect_faces(self, frame):
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    def detect_faces(self, frame, scale=1.0, search_box=None, padding=0.5):
+        return list(map(lambda d: d[0], self.detect(frame, ['face'], scale, search_box, padding)))
 
-        faces = self.face_cascade.detectMultiScale(
-            gray,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(30, 30),
-            flags=cv2.CASCADE_SCALE_IMAGE
-        )
+    # Runs the cascades of target_classes on a gray copy scaled by scale, optionally
+    # restricted to search_box grown by padding times its size on every side. Returns
+    # (box, target_class) pairs with the boxes in full resolution frame coordinates.
+    def detect(self, frame, target_classes, scale=1.0, search_box=None, padding=0.5):
+        x0, y0 = 0, 0
+        region = frame
 
-        for (x, y, w, h) in faces:
-            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+        if search_box is not None:
+            x0, y0, x1, y1 = self.padded_window(search_box, padding, frame.shape)
+            region = frame[y0:y1, x0:x1]
 
-        return faces
+        gray = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+
+        if scale != 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        detections = []
+        for target_class in target_classes:
+            cascade = self.cascades.get(target_class)
+            min_size = TARGET_CLASSES[target_class][1]
+
+            start = time.perf_counter()
+            boxes = cascade.detectMultiScale(
+                gray,
+                scaleFactor=1.1,
+                minNeighbors=5,
+                minSize=(max(int(min_size[0] * scale), 1), max(int(min_size[1] * scale), 1)),
+                flags=cv2.CASCADE_SCALE_IMAGE
+            )
+            self.cascades.record(target_class, time.perf_counter() - start)
+
+            if len(boxes) == 0:
+                continue
+
+            boxes = np.asarray(boxes, dtype=np.float64) / scale
+            boxes[:, 0] += x0
+            boxes[:, 1] += y0
+            detections.extend((tuple(box), target_class) for box in boxes.round().astype(np.int32))
+
+        return detections
+
+    @staticmethod
+    def padded_window(box, padding, shape):
+        (x, y, w, h) = box
+        pad_x = w * padding
+        pad_y = h * padding
+
+        x0 = int(max(x - pad_x, 0))
+        y0 = int(max(y - pad_y, 0))
+        x1 = int(min(x + w + pad_x, shape[1]))
+        y1 = int(min(y + h + pad_y, shape[0]))
+        return x0, y0, x1, y1
+
+    @staticmethod
+    def draw_box(frame, box, colour=(0, 255, 0)):
+        (x, y, w, h) = [int(v) for v in box]
+        cv2.rectangle(frame, (x, y), (x + w, y + h), colour, 2)
 
 
 shared_cv_helper = CVHelper()
 
+# OpenCV releases the GIL while detecting and tracking, so the heavy work of every
+# rover runs here and the event loop only applies the results
+cv_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix=CV_THREAD_PREFIX)
+
+
+# Decides when the tracked targets have to be checked against the detector. The
+# trackers run on every frame, a verification detection runs every verify_frames frames
+# or verify_ms milliseconds, whichever comes first. Every missed verification decays
+# the confidence in a target, below min_confidence (or when its tracker reports a
+# failure) the target counts as lost. With no targets left a full detection over the
+# whole frame takes over.
+class TrackingScheduler:
+    def __init__(self, verify_frames=15, verify_ms=500, miss_decay=0.5, min_confidence=0.3):
+        self.verify_frames = verify_frames
+        self.verify_ms = verify_ms
+        self.miss_decay = miss_decay
+        self.min_confidence = min_confidence
+
+        self.frames_since_verification = 0
+        self.last_verification = time.time()
+
+        self.tracked_frames = 0
+        self.verifications = 0
+        self.verification_misses = 0
+        self.losses = 0
+
+    def reset(self):
+        self.frames_since_verification = 0
+        self.last_verification = time.time()
+
+    def on_tracked(self):
+        self.tracked_frames += 1
+        self.frames_since_verification += 1
+
+    def verification_due(self):
+        return self.frames_since_verification >= self.verify_frames or \
+               (time.time() - self.last_verification) * 1000.0 >= self.verify_ms
+
+    def on_verification(self, misses):
+        self.verifications += 1
+        self.verification_misses += misses
+        self.frames_since_verification = 0
+        self.last_verification = time.time()
+
+    def decay(self, confidence):
+        return confidence * self.miss_decay
+
+    def lost(self, confidence):
+        return confidence < self.min_confidence
+
+    def on_lost(self):
+        self.losses += 1
+
+    def stats(self):
+        return {'tracked_frames': self.tracked_frames,
+                'verifications': self.verifications,
+                'verification_misses': self.verification_misses,
+                'losses': self.losses}
+
+
+# Remembers the last state commanded to each motor group of a rover so that the follow
+# controller only sends changes. Speeds are quantized to FOLLOW_SPEED_STEPS and a new
+# speed is only taken once it moves hysteresis steps past the edge of the current one,
+# so values hovering on a step boundary do not flip back and forth. An unknown state,
+# as after invalidate(), is always sent.
+class FollowCommandFilter:
+    motor_groups = {'move_cam': 'camera', 'move': 'wheels'}
+
+    def __init__(self, steps=FOLLOW_SPEED_STEPS, hysteresis=FOLLOW_SPEED_HYSTERESIS):
+        self.steps = steps
+        self.hysteresis = hysteresis
+        self.speeds = dict()
+        self.directions = dict()
+
+        self.sent = 0
+        self.suppressed = 0
+        self.window_start = time.time()
+        self.window_sent = 0
+        self.messages_per_second = 0.0
+
+    def invalidate(self):
+        self.speeds.clear()
+        self.directions.clear()
+
+    def quantize(self, cmd, value, last):
+        step = self.steps[cmd]
+        if last is not None and abs(value - last) < step * (0.5 + self.hysteresis):
+            return last
+        return round(max(step, round(value / step) * step), 6)
+
+    # Returns the message to send, with its speeds quantized, or None when it would not
+    # change anything on the rover
+    def filter(self, msg):
+        cmd = msg['cmd']
+        params = msg['params']
+
+        if cmd in self.steps:
+            last = self.speeds.get(cmd)
+            if isinstance(params['speed'], list):
+                speed = list(map(lambda v, l: self.quantize(cmd, v, l), params['speed'],
+                                 last if last is not None else [None] * len(params['speed'])))
+            else:
+                speed = self.quantize(cmd, params['speed'], last)
+
+            if speed == last:
+                return self.suppress()
+            msg = {'cmd': cmd, 'params': {'speed': speed}}
+
+        elif cmd in self.motor_groups:
+            if self.directions.get(self.motor_groups[cmd]) == params['direction']:
+                return self.suppress()
+
+        elif cmd == 'move_stop':
+            if all(map(lambda m: self.directions.get(m, False) is None, params['motors'])):
+                return self.suppress()
+
+        self.record(msg)
+        return msg
+
+    # Takes a message as sent, whether it went through filter() or not
+    def record(self, msg):
+        cmd = msg['cmd']
+        params = msg['params']
+
+        if cmd in self.steps:
+            self.speeds[cmd] = params['speed']
+        elif cmd in self.motor_groups:
+            self.directions[self.motor_groups[cmd]] = list(params['direction'])
+        elif cmd == 'move_stop':
+            for motor in params['motors']:
+                self.directions[motor] = None
+
+        self.sent += 1
+        self.window_sent += 1
+        self.roll_window()
+
+    def suppress(self):
+        self.suppressed += 1
+        self.roll_window()
+        return None
+
+    def roll_window(self):
+        elapsed = time.time() - self.window_start
+        if elapsed >= 1.0:
+            self.messages_per_second = self.window_sent / elapsed
+            self.window_start = time.time()
+            self.window_sent = 0
+
+    def stats(self):
+        self.roll_window()
+        return {'sent': self.sent,
+                'suppressed': self.suppressed,
+                'messages_per_second': self.messages_per_second}
+
+
+# A textbook PID controller over a normalized error, with the integral clamped so that
+# the integral term alone never exceeds the output limit. The proportional term can be
+# shaped by an exponent on the size of the error, above 1 it reacts gently to small
+# errors and hard to large ones.
+class PIDController:
+    def __init__(self, kp, ki=0.0, kd=0.0, exponent=1.0, limit=None):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.exponent = exponent
+        self.limit = limit
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.last_error = None
+
+    def clamp(self, value, limit):
+        return max(-limit, min(limit, value)) if limit is not None else value
+
+    def update(self, error, dt):
+        derivative = 0.0
+        if dt > 0:
+            self.integral += error * dt
+            if self.ki and self.limit is not None:
+                self.integral = self.clamp(self.integral, self.limit / self.ki)
+            if self.last_error is not None:
+                derivative = (error - self.last_error) / dt
+        self.last_error = error
+
+        proportional = math.copysign(abs(error) ** self.exponent, error)
+        return self.clamp(self.kp * proportional + self.ki * self.integral + self.kd * derivative, self.limit)
+
+
+# Where the followed target was in a frame, handed from the frame loop to the control loop
+class TrackingObservation:
+    def __init__(self, seq, timestamp, success, box):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.success = success
+        self.box = box
+
+
+# One of the targets tracked on a rover. The id stays the same for as long as the
+# target is tracked, detections matching it only re-anchor its tracker.
+class TrackedTarget:
+    def __init__(self, target_id, box, tracker, target_class=None):
+        self.target_id = target_id
+        self.target_class = target_class
+        self.box = box
+        self.tracker = tracker
+        self.pending_tracker = None
+        self.success = True
+        self.confidence = 1.0
+        self.created_at = time.time()
+
+        self.updates = 0
+        self.update_time = 0.0
+
+    def stats(self):
+        return {'id': self.target_id,
+                'class': self.target_class,
+                'box': list(map(int, self.box)),
+                'confidence': self.confidence,
+                'updates': self.updates,
+                'update_ms': 1000.0 * self.update_time / max(self.updates, 1)}
+
+
+# A preallocated frame buffer lent out by a FramePool. Every holder takes its own
+# reference and releases it when done, the buffer is reused once the last one does.
+class PooledFrame:
+    def __init__(self, pool, image):
+        self.pool = pool
+        self.image = image
+        self.refs = 0
+        self.seq = 0
+        self.timestamp = 0.0
+
+    def retain(self):
+        self.pool.retain(self)
+        return self
+
+    def release(self):
+        self.pool.release(self)
 
+
+class FramePool:
+    def __init__(self, shape, size=FRAME_POOL_SIZE):
+        self.shape = tuple(shape)
+        self.lock = threading.Lock()
+        self.free = list(PooledFrame(self, np.empty(self.shape, np.uint8)) for i in range(size))
+        self.allocations = size
+        self.acquired = 0
+        self.started_at = time.time()
+
+    def acquire(self):
+        with self.lock:
+            self.acquired += 1
+            if self.free:
+                frame = self.free.pop()
+            else:
+                frame = PooledFrame(self, np.empty(self.shape, np.uint8))
+                self.allocations += 1
+            frame.refs = 1
+            return frame
+
+    # Used when the decoder hands back a buffer of a different size than expected,
+    # the pool switches to that size and adopts the new buffer
+    def adopt(self, frame, image):
+        with self.lock:
+            self.shape = image.shape
+            self.free = list(f for f in self.free if f.image.shape == self.shape)
+            self.allocations += 1
+            frame.image = image
+
+    def retain(self, frame):
+        with self.lock:
+            frame.refs += 1
+
+    def release(self, frame):
+        with self.lock:
+            frame.refs -= 1
+            if frame.refs == 0 and frame.image.shape == self.shape:
+                self.free.append(frame)
+
+    def stats(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started_at, 1e-6)
+            return {'free': len(self.free),
+                    'frames': self.acquired,
+                    'allocations': self.allocations,
+                    'allocation_rate': self.allocations / elapsed}
+
+
+# Drains the decoder on its own thread and publishes the newest frame as a mailbox
+# carrying a sequence number and timestamp. Every frame is grabbed so that no backlog
+# builds up in the RTP source, but it is only retrieved (decoded to BGR) into a pooled
+# buffer while a consumer is waiting for one. Consumers get a retained PooledFrame and
+# must release it when done.
 class VideoCaptureTreading:
     def __init__(self, src, stream_data):
         self.src = src
         self.cap = cv2.VideoCapture(self.src)
-        self.grabbed, self.frame = self.cap.read()
         self.started = False
         self.thread = None
-        self.read_lock = threading.Lock()
-        self.read_next = True
         self.stream_data = stream_data
+        self.pool = FramePool((stream_data.height, stream_data.width, 3))
+
+        self.frame_ready = threading.Condition()
+        self.frame = None
+        self.seq = 0
+        self.grabs = 0
+
+        self.sync_waiters = 0
+        self.async_waiters = []
 
     def start(self):
         print(f'Starting to capture from {self.src}')
@@ -122,29 +1313,105 @@ class VideoCaptureTreading:
         atexit.register(self.stop)
         return self
 
+    def wanted(self):
+        return self.sync_waiters > 0 or len(self.async_waiters) > 0
+
+    def grab(self):
+        return self.cap.grab()
+
     def update(self):
         while self.started:
-            time.sleep(1.0 / (self.stream_data.framerate / 1.2))
-            grabbed, frame = self.cap.read()
+            if not self.grab():
+                time.sleep(1.0 / self.stream_data.framerate)
+                continue
 
-            if self.read_next:
-                with self.read_lock:
-                    self.grabbed = grabbed
-                    self.frame = frame
-                    self.read_next = False
+            timestamp = time.time()
+            self.grabs += 1
 
-    def read(self):
-        if not self.read_next:
-            with self.read_lock:
-                frame = self.frame.copy()
-                grabbed = self.grabbed
-                self.read_next = True
-            return grabbed, frame
-        return False, None
+            if self.wanted():
+                frame = self.pool.acquire()
+                grabbed, image = self.cap.retrieve(frame.image)
+
+                if not grabbed:
+                    frame.release()
+                    continue
+
+                if image is not frame.image:
+                    self.pool.adopt(frame, image)
+
+                self.publish(frame, timestamp)
+
+    def publish(self, frame, timestamp):
+        with self.frame_ready:
+            self.seq += 1
+            frame.seq = self.seq
+            frame.timestamp = timestamp
+
+            previous = self.frame
+            self.frame = frame
+
+            self.frame_ready.notify_all()
+            waiters = self.async_waiters
+            self.async_waiters = []
+            for waiter in waiters:
+                frame.retain()
+
+        if previous is not None:
+            previous.release()
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.resolve_waiter, future, frame)
+
+    @staticmethod
+    def resolve_waiter(future, frame):
+        if future.done():
+            frame.release()
+        else:
+            future.set_result(frame)
+
+    # Blocks until a frame newer than after_seq is published, returns None on timeout
+    def wait_frame(self, after_seq=0, timeout=None):
+        with self.frame_ready:
+            self.sync_waiters += 1
+            try:
+                if not self.frame_ready.wait_for(lambda: self.seq > after_seq, timeout):
+                    return None
+                return self.frame.retain()
+            finally:
+                self.sync_waiters -= 1
+
+    async def next_frame(self, after_seq=0):
+        loop = asyncio.get_running_loop()
+
+        with self.frame_ready:
+            if self.seq > after_seq:
+                return self.frame.retain()
+
+            waiter = (loop, loop.create_future())
+            self.async_waiters.append(waiter)
+
+        try:
+            return await waiter[1]
+        except asyncio.CancelledError:
+            if waiter[1].done() and not waiter[1].cancelled():
+                waiter[1].result().release()
+            raise
+        finally:
+            with self.frame_ready:
+                if waiter in self.async_waiters:
+                    self.async_waiters.remove(waiter)
 
     def stop(self):
+        if not self.started:
+            return
         self.started = False
         self.thread.join()
+        self.cap.release()
+
+        with self.frame_ready:
+            if self.frame is not None:
+                self.frame.release()
+                self.frame = None
 
     def __exit__(self, exec_type, exc_value, traceback):
         self.cap.release()
@@ -153,6 +1420,7 @@ class VideoCaptureTreading:
 class RoverHandler:
 
     def __init__(self, hello_cmd, cv_helper, reader, writer, tracker_name='medianflow'):
+        self.hello_cmd = hello_cmd
         self.rover_id = hello_cmd['rover_id']
         self.rover_data = hello_cmd['rover_data']
         self.description = self.rover_data['description']
@@ -167,12 +1435,29 @@ class RoverHandler:
         self.stream_data.height = self.rover_data['stream_size'][1]
 
         self.cap = None
-        self.converter = None
+        self.encoded_frames = 0
+        self.copied_bytes = 0
         self.cv_helper = cv_helper
         self.reader = reader
         self.writer = writer
+        self.metrics = PipelineMetrics()
+        # The rover picks the same encoding from the encodings of its hello
+        self.link_encoding = negotiate_encoding(hello_cmd.get('encodings', []))
+        self.codec = control_codec(self.link_encoding)
+        self.command_channel = RoverCommandChannel(writer, self.metrics, self.codec)
+        # 'pipeline' decodes every frame for the CV and encodes it again, 'passthrough'
+        # leaves the whole transcode to ffmpeg while nothing is tracked
+        self.mode = None
+        self.passthrough = server_data.passthrough
+        self.mode_changed = asyncio.Event()
+        self.encoder_backend = server_data.rover_encoders.get(self.rover_id, server_data.encoder)
+        if self.encoder_backend == 'pyav' and av is None:
+            print(f'PyAV is not installed, rover {self.rover_id} falls back to the ffmpeg encoder')
+            self.encoder_backend = 'ffmpeg'
         self.rover_clients = dict()
-        self.stream_clients = dict()
+        self.client_codecs = dict()
+        self.renditions = dict((name, Rendition(index, name, scale, bitrate, self.stream_data))
+                               for index, (name, scale, bitrate) in enumerate(RENDITIONS))
 
         self.server_commands = {
             'track_custom': self.cmd_track_custom,
@@ -181,10 +1466,28 @@ class RoverHandler:
             'follow': self.cmd_follow
         }
 
+        # Server side commands that are answered right away with their own response
+        self.server_queries = {
+            'list_faces': self.query_list_faces,
+            'track': self.query_track,
+            'untrack': self.query_untrack
+        }
+
         self.init_bb = None
         self.initial_area_percent = 0.0
-        self.tracker = None
         self.tracking_initialized = False
+        # Bumped whenever the tracking target changes, results of older CV jobs are discarded
+        self.tracking_generation = 0
+        self.detection_future = None
+        self.detection_scale = server_data.detection_scale
+        self.detection_window_padding = server_data.detection_window_padding
+        self.detection_window_missed = False
+        self.scheduler = TrackingScheduler()
+        self.target_classes = ['face']
+        self.targets = dict()
+        self.next_target_id = 0
+        self.selected_target_id = None
+        self.followed_target_id = None
 
         self.camera_follow_x_threshold = 5.0
         self.camera_follow_y_threshold = 5.0
@@ -194,12 +1497,29 @@ class RoverHandler:
         self.last_areas = RingBuffer(5, 99999)
         self.distance_threshold = 0.0
         self.target_area_increase = 1.15
-        self.stop_sent = False
+        self.command_filter = FollowCommandFilter()
         self.camera_wiggle_dampener = 20.0
         self.follow_area_threshold = -0.01
         self.movement_wiggle_dampener = 0.02
         self.rotational_dampener = 50
 
+        # The follow controller runs on its own task at control_rate, on the latest observation
+        self.control_rate = server_data.control_rate
+        self.control_task = None
+        self.observation = None
+        self.control_seq = None
+        self.control_timestamp = None
+        self.control_updates = 0
+        self.control_overruns = 0
+        # Camera outputs are in degrees per second and wheel outputs are added to a base speed
+        gains = server_data.follow_gains
+        self.pan_controller = PIDController(*gains['camera'], limit=FOLLOW_CAMERA_SPEED_LIMIT)
+        self.tilt_controller = PIDController(*gains['camera'], limit=FOLLOW_CAMERA_SPEED_LIMIT)
+        self.approach_speed = FOLLOW_APPROACH_SPEED
+        self.approach_controller = PIDController(*gains['approach'])
+        self.turn_speed = FOLLOW_TURN_SPEED
+        self.turn_controller = PIDController(*gains['turn'])
+
         self.tracking_custom = False
         self.tracking_face = False
         self.following_wheels = False
@@ -220,28 +1540,234 @@ class RoverHandler:
         self.cap.start()
 
     def set_obj_tracker(self, tracker_name):
+        if tracker_name not in self.cv_helper.object_trackers:
+            raise KeyError(tracker_name)
         self.tracker_name = tracker_name
-        self.tracker = self.cv_helper.object_trackers[self.tracker_name]()
 
-    def init_tracking_roi(self, frame):
-        if self.tracker is not None:
-            self.tracker.clear()
+    # Runs on the cv executor
+    def create_tracker(self, frame, bb):
+        tracker = self.cv_helper.object_trackers[self.tracker_name]()
+        tracker.init(frame, bb)
+        return tracker
+
+    # Runs on the cv executor
+    def detect_and_init(self, frame, search_box):
+        start = time.perf_counter()
+        detections = self.cv_helper.detect(frame, self.target_classes, self.detection_scale, search_box,
+                                           self.detection_window_padding)
+        self.metrics.observe('detection', time.perf_counter() - start)
+        return list((box, self.create_tracker(frame, box), target_class) for box, target_class in detections)
+
+    # Runs on the cv executor. All the trackers of a rover are updated in one job, so a
+    # frame costs a single hand-off to the pool and a single wake-up of the loop no
+    # matter how many targets there are.
+    @staticmethod
+    def update_trackers(frame, trackers):
+        results = []
+        for tracker in trackers:
+            start = time.perf_counter()
+            success, box = tracker.update(frame)
+            results.append((success, box, time.perf_counter() - start))
+        return results
 
-        self.tracker = self.cv_helper.object_trackers[self.tracker_name]()
-        self.tracker.init(frame, self.init_bb)
+    @staticmethod
+    def box_iou(a, b):
+        x0 = max(a[0], b[0])
+        y0 = max(a[1], b[1])
+        x1 = min(a[0] + a[2], b[0] + b[2])
+        y1 = min(a[1] + a[3], b[1] + b[3])
+
+        inter = max(x1 - x0, 0) * max(y1 - y0, 0)
+        union = a[2] * a[3] + b[2] * b[3] - inter
+        return inter / union if union > 0 else 0.0
+
+    def add_target(self, box, tracker, target_class=None):
+        self.next_target_id += 1
+        target = TrackedTarget(str(self.next_target_id), box, tracker, target_class)
+        self.targets[target.target_id] = target
         self.tracking_initialized = True
+        print(f'Tracking target {target.target_id} on rover {self.rover_id}')
+        return target
 
-    def track_roi(self, frame):
+    def remove_target(self, target_id):
+        target = self.targets.pop(target_id, None)
+        if target is None:
+            return
 
+        print(f'Target {target_id} lost on rover {self.rover_id}')
+        self.scheduler.on_lost()
 
-        self.success, newBox = self.tracker.update(frame)
+        if target_id == self.selected_target_id:
+            self.selected_target_id = None
+            self.select_target()
 
-        # check to see if the tracking was a success
-        if self.success:
-            self.box = newBox
-            (x, y, w, h) = [int(v) for v in self.box]
-            cv2.rectangle(frame, (x, y), (x + w, y + h),
-                          (0, 255, 0), 2)
+        if not self.targets:
+            # Nothing left to follow, look over the whole frame again
+            self.tracking_initialized = False
+            self.detection_window_missed = True
+
+    def clear_targets(self):
+        self.targets.clear()
+        self.selected_target_id = None
+        self.followed_target_id = None
+        self.tracking_initialized = False
+        self.observation = None
+
+    # The target the follow logic drives, the one picked by a client or else the oldest
+    def followed_target(self):
+        if self.selected_target_id in self.targets:
+            return self.targets[self.selected_target_id]
+        if self.targets:
+            return self.targets[min(self.targets, key=int)]
+        return None
+
+    def select_target(self, target_id=None):
+        self.selected_target_id = target_id
+        target = self.followed_target()
+
+        if target is not None and target.target_id != self.followed_target_id:
+            self.initialize_bb(tuple(target.box))
+            self.reset_distance()
+            self.reset_area()
+
+        self.followed_target_id = target.target_id if target is not None else None
+
+    # Matches the detected faces to the tracked targets by overlap. Matched targets are
+    # re-anchored on the detection, the rest are new targets when add_new is set.
+    # Returns the targets that had no matching detection.
+    def associate(self, detections, add_new):
+        unmatched = dict(self.targets)
+
+        for bb, tracker, target_class in detections:
+            candidates = list(filter(lambda t: t.target_class == target_class, unmatched.values()))
+            best = max(candidates, key=lambda t: self.box_iou(t.box, bb), default=None)
+
+            if best is not None and self.box_iou(best.box, bb) > 0.3:
+                # The swap happens between two tracker updates
+                best.pending_tracker = tracker
+                best.confidence = 1.0
+                del unmatched[best.target_id]
+            elif add_new:
+                self.add_target(bb, tracker, target_class)
+
+        return list(unmatched.values())
+
+    def start_detection(self, frame):
+        generation = self.tracking_generation
+
+        # Look around the last known target first, and over the whole frame if that missed
+        search_box = None
+        if self.detection_window_padding > 0 and self.box is not None and not self.detection_window_missed:
+            search_box = self.box
+
+        # The pooled buffer must not be recycled while the detection reads it
+        frame.retain()
+        self.detection_future = asyncio.get_running_loop().run_in_executor(cv_executor, self.detect_and_init,
+                                                                           frame.image, search_box)
+        self.detection_future.add_done_callback(lambda f: self.on_detection_done(f, generation, frame, search_box))
+
+    def on_detection_done(self, future, generation, frame, search_box):
+        self.detection_future = None
+        frame.release()
+
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(future.exception())
+            return
+
+        detections = future.result()
+        self.detection_window_missed = not detections and search_box is not None
+
+        if not detections or generation != self.tracking_generation or not self.tracking_face:
+            return
+
+        print(f'Initializing ')
+        self.associate(detections, True)
+        self.select_target(self.selected_target_id)
+        self.scheduler.reset()
+
+    def start_verification(self, frame):
+        generation = self.tracking_generation
+
+        # A single target is verified in a window around it, several over the whole
+        # frame, which also picks up faces that walked in
+        search_box = None
+        if len(self.targets) == 1:
+            search_box = next(iter(self.targets.values())).box
+
+        # The tracking boxes are drawn on the frame while this runs, the cascade and the
+        # trackers it creates get a clean copy
+        image = frame.image.copy()
+        self.detection_future = asyncio.get_running_loop().run_in_executor(cv_executor, self.detect_and_init,
+                                                                           image, search_box)
+        self.detection_future.add_done_callback(lambda f: self.on_verification_done(f, generation, search_box))
+
+    def on_verification_done(self, future, generation, search_box):
+        self.detection_future = None
+
+        if future.cancelled() or generation != self.tracking_generation or not self.tracking_initialized:
+            return
+        if future.exception() is not None:
+            print(future.exception())
+            return
+
+        missed = self.associate(future.result(), search_box is None)
+        self.scheduler.on_verification(len(missed))
+
+        for target in missed:
+            target.confidence = self.scheduler.decay(target.confidence)
+            if self.scheduler.lost(target.confidence):
+                self.remove_target(target.target_id)
+
+    async def init_tracking_roi(self, frame):
+        generation = self.tracking_generation
+        tracker = await asyncio.get_running_loop().run_in_executor(cv_executor, self.create_tracker,
+                                                                   frame, self.init_bb)
+        if generation == self.tracking_generation:
+            self.clear_targets()
+            self.add_target(self.init_bb, tracker)
+            self.select_target()
+
+    async def track_targets(self, frame):
+        generation = self.tracking_generation
+
+        for target in self.targets.values():
+            if target.pending_tracker is not None:
+                target.tracker = target.pending_tracker
+                target.pending_tracker = None
+
+        targets = list(self.targets.values())
+        results = await asyncio.get_running_loop().run_in_executor(cv_executor, self.update_trackers, frame,
+                                                                   list(map(lambda t: t.tracker, targets)))
+
+        if generation != self.tracking_generation:
+            return
+
+        for target, (success, box, elapsed) in zip(targets, results):
+            self.metrics.observe('tracker_update', elapsed)
+            target.updates += 1
+            target.update_time += elapsed
+            target.success = success
+
+            if success:
+                target.box = box
+            elif self.tracking_face and target.target_id in self.targets:
+                self.remove_target(target.target_id)
+
+        followed = self.followed_target()
+        if followed is not None and followed.target_id != self.followed_target_id:
+            self.select_target(self.selected_target_id)
+
+        self.success = followed is not None and followed.success
+        if followed is not None:
+            self.box = followed.box
+
+    def draw_targets(self, image):
+        followed = self.followed_target()
+        for target in self.targets.values():
+            colour = (0, 255, 0) if target is followed else (0, 200, 255)
+            self.cv_helper.draw_box(image, target.box, colour)
 
     def initialize_bb(self, bb):
         self.init_bb = bb
@@ -260,31 +1786,45 @@ class RoverHandler:
     def reset_area(self):
         self.last_areas.set_all(9999)
 
-    async def follow_move_camera(self):
+    def reset_history(self):
+        self.reset_distance()
+        self.reset_area()
+        # A client may have moved the rover itself
+        self.command_filter.invalidate()
+
+    async def send_follow_command(self, msg):
+        msg = self.command_filter.filter(msg)
+        if msg is not None:
+            print(msg)
+            self.command_channel.send(msg)
+
+    def send_reset_command(self, msg):
+        self.command_filter.record(msg)
+        self.command_channel.send(msg)
+
+    def reset_controllers(self):
+        self.pan_controller.reset()
+        self.tilt_controller.reset()
+        self.approach_controller.reset()
+        self.turn_controller.reset()
+
+    async def follow_move_camera(self, dt):
         move_cam = []
 
         move_x = abs(self.delta_x) > self.camera_follow_x_threshold
         move_y = abs(self.delta_y) > self.camera_follow_y_threshold
 
-        adj_speed_x = round(90.0 * (abs(self.delta_x) / self.stream_data.width) ** 1.2, 2)
-        adj_speed_y = round(90.0 * (abs(self.delta_y) / self.stream_data.height) ** 1.2, 2)
+        adj_speed_x = round(abs(self.pan_controller.update(self.delta_x / self.stream_data.width, dt)), 2)
+        adj_speed_y = round(abs(self.tilt_controller.update(self.delta_y / self.stream_data.height, dt)), 2)
 
         if self.dist > self.distance_threshold:
             self.last_distances.append(self.dist)
 
-            if np.average(self.last_distances.data) < self.camera_wiggle_dampener:
-                if not self.stop_sent:
-                    msg = {'cmd': 'move_stop', 'params': {'motors': ['camera']}}
-                    print(msg)
-                    self.stop_sent = True
-                    await send_socket_message(msg, self.writer)
+            if self.last_distances.mean < self.camera_wiggle_dampener:
+                await self.send_follow_command({'cmd': 'move_stop', 'params': {'motors': ['camera']}})
             else:
-                self.stop_sent = False
-
                 if adj_speed_y > 0.2 and adj_speed_x > 0.2:
-                    msg = {'cmd': 'set_cam_speed', 'params': {'speed': [adj_speed_x, adj_speed_y]}}
-                    print(msg)
-                    await send_socket_message(msg, self.writer)
+                    await self.send_follow_command({'cmd': 'set_cam_speed', 'params': {'speed': [adj_speed_x, adj_speed_y]}})
 
                 if move_x:
                     if self.delta_x > 0:
@@ -298,11 +1838,9 @@ class RoverHandler:
                         move_cam.append('up')
 
                 if move_cam:
-                    msg = {'cmd': 'move_cam', 'params': {'direction': move_cam}}
-                    print(msg)
-                    await send_socket_message(msg, self.writer)
+                    await self.send_follow_command({'cmd': 'move_cam', 'params': {'direction': move_cam}})
 
-    async def follow_move_wheels(self):
+    async def follow_move_wheels(self, dt):
         move_cmd = []
 
         move_x = abs(self.delta_x) > self.movement_follow_x_threshold
@@ -315,21 +1853,14 @@ class RoverHandler:
         if delta_area < self.follow_area_threshold:
             self.last_areas.append(abs(delta_area))
 
-            if np.average(self.last_areas.data) < self.movement_wiggle_dampener:
-                if not self.stop_sent:
-                    msg = {'cmd': 'move_stop', 'params': {'motors': ['wheels']}}
-                    print(msg)
-                    self.stop_sent = True
-                    await send_socket_message(msg, self.writer)
+            if self.last_areas.mean < self.movement_wiggle_dampener:
+                await self.send_follow_command({'cmd': 'move_stop', 'params': {'motors': ['wheels']}})
             else:
                 move_cmd.append('forward')
-                self.stop_sent = False
-                adj_speed = round(0.1 * (1 + abs(delta_area)), 2)
+                adj_speed = round(self.approach_speed + abs(self.approach_controller.update(delta_area, dt)), 2)
 
                 if adj_speed > 0.04:
-                    msg = {'cmd': 'set_speed', 'params': {'speed': adj_speed}}
-                    print(msg)
-                    await send_socket_message(msg, self.writer)
+                    await self.send_follow_command({'cmd': 'set_speed', 'params': {'speed': adj_speed}})
 
                 if move_x:
                     if self.delta_x > 0:
@@ -337,68 +1868,101 @@ class RoverHandler:
                     else:
                         move_cmd.append('left')
 
-                msg = {'cmd': 'move', 'params': {'direction': move_cmd}}
-                print(msg)
-                await send_socket_message(msg, self.writer)
+                await self.send_follow_command({'cmd': 'move', 'params': {'direction': move_cmd}})
         else:
             if move_x:
                 self.last_distances.append(abs(self.delta_x))
 
-                if np.average(self.last_distances.data) < self.rotational_dampener:
-                    if not self.stop_sent:
-                        msg = {'cmd': 'move_stop', 'params': {'motors': ['camera']}}
-                        print(msg)
-                        self.stop_sent = True
-                        await send_socket_message(msg, self.writer)
+                if self.last_distances.mean < self.rotational_dampener:
+                    await self.send_follow_command({'cmd': 'move_stop', 'params': {'motors': ['camera']}})
                 else:
-                    adj_speed = round(0.005 * (1 + (abs(self.delta_x) / self.stream_data.width) ** 3), 10)
+                    turn = self.turn_controller.update(self.delta_x / self.stream_data.width, dt)
+                    adj_speed = round(self.turn_speed + abs(turn), 10)
 
                     if adj_speed > 0:
-                        msg = {'cmd': 'set_speed', 'params': {'speed': adj_speed}}
-                        print(msg)
-                        await send_socket_message(msg, self.writer)
+                        await self.send_follow_command({'cmd': 'set_speed', 'params': {'speed': adj_speed}})
 
                     if self.delta_x > 0:
                         move_cmd.append('right')
                     else:
                         move_cmd.append('left')
 
-                    self.stop_sent = False
-                    msg = {'cmd': 'move', 'params': {'direction': move_cmd}}
-                    print(msg)
-                    await send_socket_message(msg, self.writer)
+                    await self.send_follow_command({'cmd': 'move', 'params': {'direction': move_cmd}})
 
             else:
-                if not self.stop_sent:
-                    msg = {'cmd': 'move_stop', 'params': {'motors': ['wheels']}}
-                    print(msg)
-                    self.stop_sent = True
-                    await send_socket_message(msg, self.writer)
+                await self.send_follow_command({'cmd': 'move_stop', 'params': {'motors': ['wheels']}})
 
-    async def follow_roi(self):
+    async def follow_roi(self, observation, dt):
         if self.following_wheels or self.following_camera:
-            if self.success:
+            if observation.success:
 
-                self.centre = self.box_centre(self.box)
+                self.centre = self.box_centre(observation.box)
                 self.delta_x = self.centre[0] - self.stream_data.width / 2
                 self.delta_y = self.centre[1] - self.stream_data.height / 2
                 self.dist = math.sqrt(self.delta_x ** 2 + self.delta_y ** 2)
-                self.current_area_percent = self.area_percent(self.box)
+                self.current_area_percent = self.area_percent(observation.box)
 
                 # print(f'Dist: {dist}')
-                # print(f'Avg : {np.average(self.last_distances.data)}')
-                # print(f'Stop sent at last cycle: {self.stop_sent}')
+                # print(f'Avg : {self.last_distances.mean}')
                 # print(f'following dx: {delta_x} dy:{delta_y}')
 
                 if self.following_camera and not self.following_wheels:
-                    await self.follow_move_camera()
+                    await self.follow_move_camera(dt)
                 elif self.following_wheels and not self.following_camera:
-                    await self.follow_move_wheels()
+                    await self.follow_move_wheels(dt)
                 elif self.following_wheels and self.following_camera:
-                    await self.follow_move_wheels()
+                    await self.follow_move_wheels(dt)
+
+    # Runs the follow controller control_rate times a second, whatever the frame rate.
+    # Ticks that fall behind are skipped rather than run back to back.
+    async def control_loop(self):
+        loop = asyncio.get_running_loop()
+        period = 1.0 / self.control_rate
+        next_tick = loop.time()
+
+        while True:
+            next_tick += period
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            if loop.time() - next_tick > period:
+                self.control_overruns += 1
+                next_tick = loop.time()
+
+            try:
+                await self.control_step(period)
+            except Exception as e:
+                print(e)
+
+    async def control_step(self, period):
+        observation = self.observation
+
+        if not (self.following_wheels or self.following_camera) or observation is None:
+            self.control_seq = None
+            return
+
+        if time.time() - observation.timestamp > CONTROL_TIMEOUT:
+            # No fresh frames, do not keep driving on an old position
+            if self.following_camera:
+                await self.send_follow_command({'cmd': 'move_stop', 'params': {'motors': ['camera']}})
+            if self.following_wheels:
+                await self.send_follow_command({'cmd': 'move_stop', 'params': {'motors': ['wheels']}})
+            self.reset_controllers()
+            self.control_seq = None
+            return
+
+        if observation.seq == self.control_seq:
+            return
+
+        dt = observation.timestamp - self.control_timestamp if self.control_seq is not None else period
+        self.control_seq = observation.seq
+        self.control_timestamp = observation.timestamp
+        self.control_updates += 1
+
+        await self.follow_roi(observation, dt)
 
     async def stop_tracking_roi(self):
         if self.tracking_custom or self.tracking_face:
+            self.tracking_generation += 1
+            self.clear_targets()
             await self.reset_follow()
             self.tracking_face = False
             self.tracking_custom = False
@@ -406,22 +1970,29 @@ class RoverHandler:
             self.following_camera = False
             self.init_bb = None
             self.initial_area_percent = 0.0
+            self.mode_changed.set()
 
     async def stop_tracking_custom(self):
+        self.tracking_generation += 1
+        self.clear_targets()
         await self.reset_follow()
         self.tracking_custom = False
         self.following_wheels = False
         self.following_camera = False
         self.init_bb = None
         self.initial_area_percent = 0.0
+        self.mode_changed.set()
 
     async def stop_tracking_face(self):
+        self.tracking_generation += 1
+        self.clear_targets()
         await self.reset_follow()
         self.tracking_face = False
         self.following_wheels = False
         self.following_camera = False
         self.init_bb = None
         self.initial_area_percent = 0.0
+        self.mode_changed.set()
 
     async def follow(self, wheels=False, camera=False):
         if self.has_wheels:
@@ -429,20 +2000,22 @@ class RoverHandler:
         if self.has_gimbal:
             self.following_camera = camera
 
+        self.reset_controllers()
+
         await self.reset_follow()
 
     async def reset_follow(self):
         if not self.following_camera:
             stop_msg = {'cmd': 'move_stop', 'params': {'motors': ['camera']}}
             speed_msg = {'cmd': 'set_cam_speed', 'params': {'speed': [20.0, 20.0]}}
-            await asyncio.gather(send_socket_message(stop_msg, self.writer),
-                                 send_socket_message(speed_msg, self.writer))
+            self.send_reset_command(stop_msg)
+            self.send_reset_command(speed_msg)
 
         if not self.following_wheels:
             stop_msg = {'cmd': 'move_stop', 'params': {'motors': ['wheels']}}
             speed_msg = {'cmd': 'set_speed', 'params': {'speed': 0.3}}
-            await asyncio.gather(send_socket_message(stop_msg, self.writer),
-                                 send_socket_message(speed_msg, self.writer))
+            self.send_reset_command(stop_msg)
+            self.send_reset_command(speed_msg)
 
     async def cmd_track_custom(self, cmd):
         params = cmd['params']
@@ -450,9 +2023,12 @@ class RoverHandler:
 
         if roi[0] > 0 and roi[1] > 0 and roi[2] > 0 and roi[3] > 0:
             self.initialize_bb(tuple(roi))
+            self.tracking_generation += 1
+            self.clear_targets()
             self.tracking_face = False
             self.tracking_custom = True
             self.tracking_initialized = False
+            self.mode_changed.set()
 
     async def cmd_stop_tracking(self, cmd):
         if self.tracking_custom:
@@ -461,81 +2037,356 @@ class RoverHandler:
             await self.stop_tracking_face()
 
     async def cmd_track_faces(self, cmd):
+        target_classes = (cmd.get('params') or {}).get('targets', ['face'])
+        self.target_classes = list(filter(lambda c: c in TARGET_CLASSES, target_classes)) or ['face']
+
+        self.tracking_generation += 1
+        self.box = None
+        self.clear_targets()
+        self.scheduler.reset()
         self.tracking_face = True
         self.tracking_custom = False
         self.tracking_initialized = False
+        self.mode_changed.set()
 
     async def cmd_follow(self, cmd):
         params = cmd['params']
         await self.follow(params['wheels'], params['cam'])
 
+    def query_list_faces(self, cmd):
+        followed = self.followed_target()
+        return {'rover_id': self.rover_id, 'msg': 'ok',
+                'faces': list(map(lambda t: t.stats(), self.targets.values())),
+                'selected': followed.target_id if followed is not None else None}
+
+    def query_track(self, cmd):
+        params = cmd['params']
+
+        if 'roi' in params:
+            asyncio.create_task(self.cmd_track_custom(cmd))
+            return {'rover_id': self.rover_id, 'msg': 'ok'}
+
+        target_id = str(params.get('id'))
+
+        if target_id not in self.targets:
+            return {'rover_id': self.rover_id, 'msg': 'failed', 'info': 'unknown_id'}
+
+        self.select_target(target_id)
+        return {'rover_id': self.rover_id, 'msg': 'ok'}
+
+    def query_untrack(self, cmd):
+        params = cmd['params']
+        target_id = str(params.get('id'))
+
+        if target_id not in self.targets:
+            return {'rover_id': self.rover_id, 'msg': 'failed', 'info': 'unknown_id'}
+
+        del self.targets[target_id]
+        if not self.targets:
+            self.tracking_initialized = False
+        self.select_target(None if target_id == self.selected_target_id else self.selected_target_id)
+        return {'rover_id': self.rover_id, 'msg': 'ok'}
+
     async def do_tracking(self, frame):
         if (self.tracking_face or self.tracking_custom) and self.tracking_initialized:
-            self.track_roi(frame)
-            await self.follow_roi()
+            await self.track_targets(frame.image)
+
+            if self.tracking_face and self.targets:
+                self.scheduler.on_tracked()
+                if self.detection_future is None and self.scheduler.verification_due():
+                    self.start_verification(frame)
+
+            # Only once verification has its clean copy
+            self.draw_targets(frame.image)
+
+            self.observation = TrackingObservation(frame.seq, frame.timestamp, self.success, self.box)
         else:
             if self.tracking_face:
-                faces = self.cv_helper.detect_faces(frame)
-                if len(faces) > 0:
-                    print(f'Initializing ')
-                    self.initialize_bb(tuple(faces[0]))
-                    self.init_tracking_roi(frame)
+                # Frames keep flowing to the encoder while the detection runs
+                if self.detection_future is None:
+                    self.start_detection(frame)
             elif self.tracking_custom:
                 print(f'Initializing ROI')
-                self.init_tracking_roi(frame)
+                await self.init_tracking_roi(frame.image)
 
-    async def start_conversion(self):
-        print('Spawning background conversion process')
-        try:
+    def cv_active(self):
+        return self.tracking_face or self.tracking_custom
 
-            command = f'ffmpeg -f rawvideo -pix_fmt bgr24 -s {self.stream_data.width}x{self.stream_data.height} -i - \
-            -threads 8 -q:v 7 -an -f mpeg1video -'
+    def rendition_active(self, rendition):
+        return bool(rendition.stream_clients)
 
-            self.converter = await asyncio.create_subprocess_shell(command,
-                                                                   stdin=asyncio.subprocess.PIPE,
-                                                                   stdout=asyncio.subprocess.PIPE,
-                                                                   stderr=asyncio.subprocess.DEVNULL,
-                                                                   close_fds=False, shell=True)
-            atexit.register(lambda: self.converter.kill())
-            asyncio.create_task(self.start_streaming())
+    def active_renditions(self):
+        return list(filter(self.rendition_active, self.renditions.values()))
 
+    # Called when a rendition gains its first viewer or loses its last one
+    def on_renditions_changed(self):
+        self.mode_changed.set()
+
+    def wanted_mode(self):
+        # ffmpeg can only transcode the rover stream to one rendition by itself
+        if self.cv_active() or not self.passthrough or len(self.active_renditions()) > 1:
+            return 'pipeline'
+        return 'passthrough'
+
+    # Runs the stream in whichever mode the tracking state asks for, switching whenever
+    # it changes. Every encoder start clears the GOP cache of its rendition.
+    async def start_conversion(self):
+        atexit.register(self.kill_converters)
+        self.control_task = asyncio.create_task(self.control_loop())
+
+        try:
             while True:
-                await asyncio.sleep(1.0 / self.stream_data.framerate)
-                grabbed, frame = self.cap.read()
-                if grabbed:
-                    await self.do_tracking(frame)
-                    self.converter.stdin.write(frame.tostring())
-                    await self.converter.stdin.drain()
+                mode = self.wanted_mode()
+                self.mode_changed.clear()
+                if mode != self.mode:
+                    self.mode = mode
+                    self.metrics.count('mode_switches')
+                    print(f'Rover {self.rover_id} streaming in {self.mode} mode')
+
+                if self.mode == 'pipeline':
+                    await self.run_pipeline()
+                else:
+                    await self.run_passthrough()
 
         except Exception as inst:
             print(type(inst))  # the exception instance
             print(inst.args)  # arguments stored in .args
             print(inst)
 
-    async def start_streaming(self):
-        print('Starting streaming')
-        closed_sockets = set()
-
+    def kill_converters(self):
+        for rendition in self.renditions.values():
+            if rendition.converter is not None and rendition.converter.returncode is None:
+                rendition.converter.kill()
+
+    async def start_encoder(self, rendition, command, stdin=asyncio.subprocess.PIPE):
+        print(f'Spawning {rendition.name} encoder for rover {self.rover_id}')
+        rendition.converter = await asyncio.create_subprocess_shell(command,
+                                                                    stdin=stdin,
+                                                                    stdout=asyncio.subprocess.PIPE,
+                                                                    stderr=asyncio.subprocess.DEVNULL,
+                                                                    close_fds=False, shell=True)
+        rendition.gop_cache.clear()
+        rendition.encoder_in_flight.clear()
+        rendition.streaming_task = asyncio.create_task(self.start_streaming(rendition.converter, rendition))
+        return rendition.converter
+
+    def start_av_encoder(self, rendition):
+        print(f'Starting in-process {rendition.name} encoder for rover {self.rover_id}')
+        rendition.encoder = AvEncoder(rendition.width, rendition.height, rendition.av_options())
+        rendition.gop_cache.clear()
+        rendition.encoder_in_flight.clear()
+        rendition.streaming_task = asyncio.create_task(self.start_streaming(rendition.encoder, rendition))
+
+    # Closes the input of the encoder of the rendition, it then flushes what it holds
+    @staticmethod
+    def close_encoder(rendition):
+        if rendition.encoder is not None:
+            rendition.encoder.close()
+        else:
+            rendition.converter.stdin.close()
+
+    # Nobody watches the rendition any more, its last pictures are dropped. So is its GOP,
+    # a viewer joining before the next encoder starts must not be primed with it.
+    def release_encoder(self, rendition):
+        print(f'Stopping {rendition.name} encoder for rover {self.rover_id}')
+        self.close_encoder(rendition)
+        rendition.converter = None
+        rendition.encoder = None
+        rendition.gop_cache.clear()
+
+    # Decode, CV and encode, until passthrough can take over
+    async def run_pipeline(self):
+        if self.cap is None:
+            self.start_capture()
+
+        mode_task = asyncio.create_task(self.mode_changed.wait())
+        frame_task = None
         try:
+            seq = 0
             while True:
-                buf = await self.converter.stdout.read(STREAM_BLOCKSIZE)
-                if buf:
-                    for client_id, ws in self.stream_clients.items():
-                        try:
-                            await ws.send(buf)
-                        except:
-                            print('Removing stream socket from rover')
-                            closed_sockets.add(client_id)
-
-                for client_id in closed_sockets:
-                    try:
-                        del self.stream_clients[client_id]
-                    except:
-                        pass
-
-                closed_sockets.clear()
+                # A stalled stream must not hold up a switch to passthrough
+                if frame_task is None:
+                    frame_task = asyncio.ensure_future(self.cap.next_frame(seq))
+                await asyncio.wait([frame_task, mode_task], return_when=asyncio.FIRST_COMPLETED)
+
+                if mode_task.done():
+                    if self.wanted_mode() != 'pipeline':
+                        break
+                    self.mode_changed.clear()
+                    mode_task = asyncio.create_task(self.mode_changed.wait())
+
+                if not frame_task.done():
+                    continue
+
+                frame = frame_task.result()
+                frame_task = None
+                seq = frame.seq
+                self.metrics.observe('capture', time.time() - frame.timestamp)
+                try:
+                    await self.do_tracking(frame)
+                    await self.encode_frame(frame)
+                finally:
+                    frame.release()
+        finally:
+            mode_task.cancel()
+            if frame_task is not None:
+                if frame_task.done() and not frame_task.cancelled() and frame_task.exception() is None:
+                    frame_task.result().release()
+                frame_task.cancel()
+
+            # The passthrough ffmpeg needs the RTP port the capture holds
+            self.cap.stop()
+            self.cap = None
+
+            # Let the encoders flush what they have, the viewers get every last picture
+            encoding = list(filter(lambda r: r.encoding(), self.renditions.values()))
+            for rendition in encoding:
+                self.close_encoder(rendition)
+            for rendition in encoding:
+                await rendition.streaming_task
+                rendition.converter = None
+                rendition.encoder = None
+
+    # Hands the frame to the encoder of every rendition somebody watches, starting and
+    # stopping encoders as viewers come and go
+    async def encode_frame(self, frame):
+        self.encoded_frames += 1
+        encoding = []
+        for rendition in self.renditions.values():
+            active = self.rendition_active(rendition)
+            if active and not rendition.encoding():
+                if self.encoder_backend == 'pyav':
+                    self.start_av_encoder(rendition)
+                else:
+                    command = f'ffmpeg -f rawvideo -pix_fmt bgr24 -s {rendition.width}x{rendition.height} -i - \
+                    -threads 8 {rendition.encoder_options()} -an -f mpeg1video -'
+                    await self.start_encoder(rendition, command)
+            elif not active and rendition.encoding():
+                self.release_encoder(rendition)
+
+            if rendition.encoding():
+                encoding.append(rendition)
+
+        start = time.perf_counter()
+        for rendition in encoding:
+            if rendition.encoder is not None:
+                rendition.encoder.write(rendition.resize(frame.image))
+            else:
+                rendition.converter.stdin.write(self.encoder_buffer(rendition.resize(frame.image)))
+            rendition.encoder_in_flight.append(start)
+        for rendition in encoding:
+            if rendition.encoder is not None:
+                await rendition.encoder.drain()
+            else:
+                await rendition.converter.stdin.drain()
+        if encoding:
+            self.metrics.observe('encoder_write', time.perf_counter() - start)
+
+    # ffmpeg reads the rover stream itself and transcodes it to MPEG-1, no frame goes
+    # through Python, until the CV or a second rendition is needed
+    async def run_passthrough(self):
+        active = self.active_renditions()
+        if not active:
+            # Nobody is watching, there is nothing to transcode
+            await self.mode_changed.wait()
+            return
+
+        rendition = active[0]
+        command = f'ffmpeg -protocol_whitelist file,rtp,udp -fflags nobuffer -i {self.stream_path} \
+        -threads 8 -s {rendition.width}x{rendition.height} {rendition.encoder_options()} -an -f mpeg1video -'
+        converter = await self.start_encoder(rendition, command, stdin=None)
+
+        try:
+            mode_task = asyncio.create_task(self.mode_changed.wait())
+            await asyncio.wait([mode_task, rendition.streaming_task], return_when=asyncio.FIRST_COMPLETED)
+            mode_task.cancel()
         finally:
-            self.converter.stdout.close()
+            if converter.returncode is None:
+                converter.terminate()
+            await rendition.streaming_task
+            rendition.converter = None
+
+        # ffmpeg gave up on the stream, wait a little before trying again
+        if not self.mode_changed.is_set():
+            try:
+                await asyncio.wait_for(self.mode_changed.wait(), PASSTHROUGH_RESTART_DELAY)
+            except asyncio.TimeoutError:
+                pass
+
+    # The raw bytes of a frame for the encoder pipe, as a view whenever the layout allows
+    def encoder_buffer(self, image):
+        if not image.flags['C_CONTIGUOUS']:
+            image = np.ascontiguousarray(image)
+            self.copied_bytes += image.nbytes
+        return memoryview(image).cast('B')
+
+    def frame_stats(self):
+        stats = self.cap.pool.stats() if self.cap is not None else {}
+        stats['copied_bytes_per_frame'] = self.copied_bytes / max(self.encoded_frames, 1)
+        stats['mode'] = self.mode
+        stats['encoder_backend'] = self.encoder_backend
+        stats['encoders'] = list(map(lambda r: r.name,
+                                     filter(lambda r: r.encoding(), self.renditions.values())))
+        return stats
+
+    # Reads the output of the encoder of the rendition, either an ffmpeg process or an
+    # AvEncoder, and publishes it picture by picture
+    async def start_streaming(self, converter, rendition):
+        print(f'Starting {rendition.name} streaming')
+        packetizer = Mpeg1Packetizer()
+        in_process = isinstance(converter, AvEncoder)
+
+        try:
+            while True:
+                if in_process:
+                    buf = await converter.read()
+                    if buf is None:
+                        break
+                else:
+                    buf = await converter.stdout.read(STREAM_READ_SIZE)
+                    if not buf:
+                        break
+
+                packets = packetizer.feed(buf)
+                if in_process:
+                    # Every output ends on a picture boundary, nothing has to wait for the next one
+                    packets += packetizer.flush()
+
+                for packet in packets:
+                    # A released encoder is only drained
+                    if converter not in (rendition.converter, rendition.encoder):
+                        continue
+
+                    # The encoder outputs one picture per frame, in order
+                    if rendition.encoder_in_flight:
+                        self.metrics.observe('encoder_output',
+                                             time.perf_counter() - rendition.encoder_in_flight.popleft())
+                    self.publish_packet(packet, rendition)
+
+            if converter in (rendition.converter, rendition.encoder):
+                for packet in packetizer.flush():
+                    self.publish_packet(packet, rendition)
+            if not in_process:
+                await converter.wait()
+        except Exception as e:
+            print(e)
+
+    def publish_packet(self, packet, rendition):
+        closed_clients = []
+        rendition.gop_cache.add(packet)
+        self.metrics.count('packets')
+        self.metrics.count('packet_bytes', len(packet.data))
+
+        # Only enqueue here, every client drains its own queue
+        for client_id, client in rendition.stream_clients.items():
+            if client.closed:
+                closed_clients.append(client_id)
+            else:
+                client.push(packet)
+
+        for client_id in closed_clients:
+            print('Removing stream socket from rover')
+            self.remove_stream_client(client_id)
 
     async def process_server_command(self, message):
         print(f'Received server command')
@@ -543,29 +2394,38 @@ class RoverHandler:
 
     async def forward_client_cmds(self, client_id):
         ws = self.rover_clients[client_id]
+        codec = self.client_codecs[client_id]
         print(f'Forwarding commands from Client: {client_id}, ws: {ws}')
 
+        # The answers go out in the order of the commands, those of the rover once it sends them
+        responses = asyncio.Queue()
+        responder = asyncio.create_task(self.send_responses(responses, ws, codec))
+
         try:
             async for message in ws:
                 print(repr(message))
-                msg = json.loads(message)
+                # Text messages are always JSON, binary ones use the encoding of the client
+                msg = json.loads(message) if isinstance(message, str) else codec.decode(message)
 
-                self.reset_distance()
-                self.reset_area()
+                self.reset_history()
 
                 if msg['cmd'] in self.server_commands:
                     asyncio.create_task(self.process_server_command(msg))
-                    await send_websocket_message({'msg': 'ok'}, ws)
+                    responses.put_nowait({'msg': 'ok'})
                     continue
 
-                self.writer.write(message.encode())
-                await self.writer.drain()
-                await send_websocket_message({'msg': 'ok'}, ws)
+                if msg['cmd'] in self.server_queries:
+                    responses.put_nowait(self.server_queries[msg['cmd']](msg))
+                    continue
+
+                responses.put_nowait(self.command_channel.forward(msg))
             await asyncio.sleep(0.001)
 
         except:
             print('Removing ctrl socket from rover')
             del self.rover_clients[client_id]
+        finally:
+            responder.cancel()
 
         try:
             print('Removing ctrl socket from rover')
@@ -573,20 +2433,331 @@ class RoverHandler:
         except:
             pass
 
-    def add_rover_client(self, client_id, websocket):
+    async def send_responses(self, responses, ws, codec):
+        while True:
+            response = await responses.get()
+            if isinstance(response, asyncio.Future):
+                try:
+                    response = await asyncio.wait_for(response, CONTROL_RESPONSE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    response = {'msg': 'failed', 'info': 'rover_timeout'}
+            await send_websocket_message(response, ws, codec)
+
+    def add_rover_client(self, client_id, websocket, codec=None):
         print(f'Rover client {client_id} added to rover {self.rover_id}')
         self.rover_clients[client_id] = websocket
+        self.client_codecs[client_id] = codec if codec is not None else JsonCodec()
         print(self.rover_clients.items())
 
-    def add_stream_client(self, client_id, websocket):
-        print(f'Stream client {client_id} added to rover {self.rover_id}')
-        self.stream_clients[client_id] = websocket
+    def add_stream_client(self, client_id, websocket, rendition=DEFAULT_RENDITION):
+        print(f'Stream client {client_id} added to rover {self.rover_id}, {rendition} rendition')
+        self.remove_stream_client(client_id)
+        rendition = self.renditions[rendition]
+        was_active = self.rendition_active(rendition)
+        # Taking the snapshot and registering happen without yielding to the loop, so the
+        # client gets the cached GOP followed by exactly the packets published after it
+        primer = rendition.gop_cache.snapshot()
+        rendition.stream_clients[client_id] = StreamClient(client_id, websocket, primer, metrics=self.metrics).start()
+
+        if not was_active:
+            self.on_renditions_changed()
+
+    def remove_stream_client(self, client_id, websocket=None):
+        for rendition in self.renditions.values():
+            client = rendition.stream_clients.get(client_id)
+            if client is None or (websocket is not None and client.websocket is not websocket):
+                continue
+
+            del rendition.stream_clients[client_id]
+            client.stop()
+
+            if not self.rendition_active(rendition):
+                self.on_renditions_changed()
+
+    def stream_stats(self):
+        return list(dict(client.stats(), rendition=rendition.name)
+                    for rendition in self.renditions.values() for client in rendition.stream_clients.values())
+
+    def rendition_stats(self):
+        return list(map(lambda r: r.stats(), self.renditions.values()))
+
+    def tracking_stats(self):
+        return self.scheduler.stats()
+
+    def pipeline_metrics(self):
+        return [self.metrics]
+
+    def metrics_stats(self):
+        stats = {'stages': {}, 'counters': {}}
+        for metrics in self.pipeline_metrics():
+            metrics_stats = metrics.stats()
+            stats['stages'].update(metrics_stats['stages'])
+            stats['counters'].update(metrics_stats['counters'])
+        return stats
+
+    # Reads the answers of the rover to the commands sent on the channel
+    async def read_responses(self):
+        poller = asyncio.create_task(self.poll_status())
+        try:
+            while True:
+                try:
+                    response = await self.codec.read(self.reader)
+                except ValueError as e:
+                    print(f'Bad response from rover {self.rover_id}: {e}')
+                    self.command_channel.on_bad_response()
+                    continue
+                if response is None:
+                    break
+
+                self.command_channel.on_response(response)
+        except Exception as e:
+            print(e)
+
+        poller.cancel()
+        print(f'Rover {self.rover_id} disconnected')
+
+    # The channel keeps the state of the last answer, for the list response and the
+    # metrics. A rover that does not know the command is not asked again.
+    async def poll_status(self):
+        while True:
+            await asyncio.sleep(STATUS_POLL_INTERVAL)
+            try:
+                response = await asyncio.wait_for(self.command_channel.forward({'cmd': 'status'}),
+                                                  CONTROL_RESPONSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                continue
+
+            if response.get('msg') != 'ok':
+                print(f'Rover {self.rover_id} does not report its status')
+                break
+
+    def command_stats(self):
+        stats = dict(self.command_filter.stats(), **self.command_channel.stats())
+        stats['control_updates'] = self.control_updates
+        stats['control_overruns'] = self.control_overruns
+        return stats
+
+
+# The media pipeline of a rover (capture, CV, follow logic and encoder) running in
+# its own process. Encoded pictures go to the front process through a shared memory
+# ring, the pipe only carries commands and state snapshots.
+class WorkerRoverHandler(RoverHandler):
+    def __init__(self, hello_cmd, conn, ring):
+        super().__init__(hello_cmd, shared_cv_helper, None, None)
+        self.command_channel = PipeCommandChannel(conn)
+        self.conn = conn
+        self.ring = ring
+        self.ring_drops = 0
+        # Renditions that lost a packet to a full ring
+        self.ring_waiting_keyframe = set()
+        # The viewers are in the front process, it says which renditions have any
+        self.subscribed_renditions = set()
+
+    def rendition_active(self, rendition):
+        return rendition.name in self.subscribed_renditions
+
+    def publish_packet(self, packet, rendition):
+        # A full ring means the front process is behind, resume it on a keyframe
+        if rendition.name in self.ring_waiting_keyframe and not packet.keyframe:
+            self.ring_drops += 1
+            return
+
+        flags = packet.picture_type | (PACKET_SEQUENCE_HEADER_FLAG if packet.has_sequence_header else 0) | \
+            (rendition.index << PACKET_RENDITION_SHIFT)
+        if self.ring.write(packet.data, flags):
+            self.ring_waiting_keyframe.discard(rendition.name)
+            self.conn.send(('packets',))
+        else:
+            self.ring_drops += 1
+            self.ring_waiting_keyframe.add(rendition.name)
+
+    # The front process keeps the GOP cache the viewers are primed with, it drops it too
+    def release_encoder(self, rendition):
+        super().release_encoder(rendition)
+        self.conn.send(('release', rendition.name))
+
+    def on_message(self):
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+
+                if message[0] == 'cmd':
+                    asyncio.create_task(self.process_server_command(message[1]))
+                elif message[0] == 'query':
+                    self.server_queries[message[1]['cmd']](message[1])
+                elif message[0] == 'reset':
+                    self.reset_history()
+                elif message[0] == 'renditions':
+                    self.subscribed_renditions = set(message[1])
+                    self.mode_changed.set()
+        except EOFError:
+            # The front process is gone
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            os._exit(0)
+
+    def state(self):
+        faces = self.query_list_faces(None)
+        frames = self.frame_stats()
+        frames['ring_drops'] = self.ring_drops
+        return {'faces': faces['faces'], 'selected': faces['selected'],
+                'frames': frames, 'tracking': self.tracking_stats(), 'commands': self.command_stats(),
+                'metrics': self.metrics.snapshot()}
+
+    async def send_state(self):
+        while True:
+            await asyncio.sleep(WORKER_STATE_INTERVAL)
+            self.conn.send(('state', self.state()))
+
+    async def run(self):
+        asyncio.get_running_loop().add_reader(self.conn.fileno(), self.on_message)
+        asyncio.create_task(self.send_state())
+        asyncio.create_task(monitor_loop_lag(self.metrics.stage('worker_loop_lag')))
+        await self.start_conversion()
+
+
+def run_rover_worker(hello_cmd, conn, ring_name, settings):
+    server_data.__dict__.update(settings)
+    ring = SharedMemoryRing(ring_name)
+
+    try:
+        asyncio.run(WorkerRoverHandler(hello_cmd, conn, ring).run())
+    finally:
+        ring.close()
+
+
+# The front process side of a rover whose media pipeline runs in a worker process. It
+# keeps the rover link and every client socket, and fans out the pictures the worker
+# puts in the ring. Tracking commands are forwarded to the worker, queries are answered
+# from the last state snapshot it sent.
+class RemoteRoverHandler(RoverHandler):
+    def __init__(self, hello_cmd, cv_helper, reader, writer):
+        super().__init__(hello_cmd, cv_helper, reader, writer)
+        self.process = None
+        self.conn = None
+        self.ring = None
+        self.worker_state = {'faces': [], 'selected': None, 'frames': {}, 'tracking': {}, 'commands': {}}
+        self.worker_metrics = PipelineMetrics()
+
+    def start_capture(self):
+        pass
+
+    async def start_conversion(self):
+        print(f'Spawning worker process for rover {self.rover_id}')
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context('spawn')
+
+        self.ring = SharedMemoryRing()
+        self.conn, worker_conn = context.Pipe()
+        settings = {'detection_scale': server_data.detection_scale,
+                    'detection_window_padding': server_data.detection_window_padding,
+                    'control_rate': server_data.control_rate,
+                    'follow_gains': server_data.follow_gains,
+                    'passthrough': server_data.passthrough,
+                    'encoder': server_data.encoder,
+                    'rover_encoders': server_data.rover_encoders}
+
+        self.process = context.Process(target=run_rover_worker,
+                                       args=(self.hello_cmd, worker_conn, self.ring.name, settings), daemon=True)
+        self.process.start()
+        worker_conn.close()
+        atexit.register(self.process.kill)
+        self.on_renditions_changed()
+
+        loop.add_reader(self.conn.fileno(), self.on_worker_message)
+        try:
+            await loop.run_in_executor(None, self.process.join)
+        finally:
+            loop.remove_reader(self.conn.fileno())
+            self.conn.close()
+            self.ring.close()
+            print(f'Worker process for rover {self.rover_id} exited')
+
+    def on_worker_message(self):
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+
+                if message[0] == 'packets':
+                    self.read_packets()
+                elif message[0] == 'rover':
+                    self.command_channel.send(message[1])
+                elif message[0] == 'release':
+                    self.renditions[message[1]].gop_cache.clear()
+                elif message[0] == 'state':
+                    self.worker_state = message[1]
+                    self.worker_metrics.load(message[1]['metrics'])
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+
+    def read_packets(self):
+        while True:
+            item = self.ring.read()
+            if item is None:
+                break
+
+            data, flags = item
+            rendition = list(self.renditions.values())[flags >> PACKET_RENDITION_SHIFT]
+            self.publish_packet(StreamPacket(data, flags & PACKET_TYPE_MASK,
+                                             bool(flags & PACKET_SEQUENCE_HEADER_FLAG)), rendition)
+
+    def send_worker(self, message):
+        try:
+            self.conn.send(message)
+        except (OSError, AttributeError):
+            print(f'Worker process for rover {self.rover_id} is not running')
+
+    async def process_server_command(self, message):
+        print(f'Forwarding server command to worker')
+        self.send_worker(('cmd', message))
+
+    def reset_history(self):
+        self.send_worker(('reset',))
+
+    def on_renditions_changed(self):
+        if self.process is not None:
+            self.send_worker(('renditions', list(map(lambda r: r.name, self.active_renditions()))))
+
+    def known_target(self, cmd):
+        target_id = str(cmd['params'].get('id'))
+        return any(map(lambda f: f['id'] == target_id, self.worker_state['faces']))
+
+    def query_list_faces(self, cmd):
+        return {'rover_id': self.rover_id, 'msg': 'ok',
+                'faces': self.worker_state['faces'], 'selected': self.worker_state['selected']}
+
+    def query_track(self, cmd):
+        if 'roi' not in cmd['params'] and not self.known_target(cmd):
+            return {'rover_id': self.rover_id, 'msg': 'failed', 'info': 'unknown_id'}
+
+        self.send_worker(('query', cmd))
+        return {'rover_id': self.rover_id, 'msg': 'ok'}
+
+    def query_untrack(self, cmd):
+        if not self.known_target(cmd):
+            return {'rover_id': self.rover_id, 'msg': 'failed', 'info': 'unknown_id'}
+
+        self.send_worker(('query', cmd))
+        return {'rover_id': self.rover_id, 'msg': 'ok'}
+
+    def frame_stats(self):
+        return self.worker_state['frames']
+
+    def tracking_stats(self):
+        return self.worker_state['tracking']
+
+    def pipeline_metrics(self):
+        return [self.metrics, self.worker_metrics]
+
+    def command_stats(self):
+        # The worker filters the follow commands, the rover link is written from here
+        return dict(self.worker_state['commands'], **self.command_channel.stats())
 
 
 class ProxyServer(object):
     def __init__(self):
         self.id = uuid.uuid1()
         self.rover_handlers = dict()
+        self.loop_lag = Histogram()
 
     async def greet_rover(self, reader, writer):
         print('Rover connected')
@@ -596,17 +2767,25 @@ class ProxyServer(object):
 
         print(hello_msg)
 
-        self.rover_handlers[hello_cmd['rover_id']] = RoverHandler(hello_cmd, shared_cv_helper, reader, writer)
+        handler_class = RemoteRoverHandler if server_data.rover_processes else RoverHandler
+        self.rover_handlers[hello_cmd['rover_id']] = handler_class(hello_cmd, shared_cv_helper, reader, writer)
+
+        # Only rovers offering encodings wait for the answer, the others get JSON
+        if 'encodings' in hello_cmd:
+            hello_response = {'server_id': str(self.id), 'msg': 'ack',
+                              'encoding': self.rover_handlers[hello_cmd['rover_id']].link_encoding}
+            writer.write((json.dumps(hello_response) + '\n').encode())
+            await writer.drain()
 
         stream_set_msg = await reader.readline()
         stream_set_cmd = json.loads(stream_set_msg.decode())
         print(stream_set_cmd)
 
+        asyncio.create_task(self.rover_handlers[hello_cmd['rover_id']].read_responses())
+
         with open(f'{hello_cmd["rover_id"]}.sdp', 'w') as f:
             f.write(stream_set_cmd['conf'])
 
-        self.rover_handlers[hello_cmd['rover_id']].start_capture()
-
         await self.rover_handlers[hello_cmd['rover_id']].start_conversion()
 
     async def greet_rover_client(self, websocket, path):
@@ -615,9 +2794,12 @@ class ProxyServer(object):
         hello_msg = await websocket.recv()
         print(hello_msg)
 
-        # hello_cmd = json.loads(hello_msg)
+        hello_cmd = json.loads(hello_msg)
+        encoding = negotiate_encoding(hello_cmd.get('encodings', []))
 
         hello_response = {'server_id': str(self.id), 'msg': 'ack'}
+        if 'encodings' in hello_cmd:
+            hello_response['encoding'] = encoding
 
         await send_websocket_message(hello_response, websocket)
 
@@ -633,7 +2815,8 @@ class ProxyServer(object):
 
         print(connect_msg)
 
-        self.rover_handlers[connect_cmd['rover_id']].add_rover_client(connect_cmd['client_id'], websocket)
+        self.rover_handlers[connect_cmd['rover_id']].add_rover_client(connect_cmd['client_id'], websocket,
+                                                                      control_codec(encoding))
 
         connect_response = {'server_id': str(self.id), 'client_id': connect_cmd['client_id'],
                             'rover_id': connect_cmd['rover_id'], 'msg': 'ok'}
@@ -646,9 +2829,17 @@ class ProxyServer(object):
 
     async def do_list_command(self, websocket):
         rovers_list = list(
-            map(lambda r: {'rover_id': r.rover_id, 'rover_data': r.rover_data}, self.rover_handlers.values()))
-
-        list_response = {'server_id': str(self.id), 'rovers': rovers_list}
+            map(lambda r: {'rover_id': r.rover_id, 'rover_data': r.rover_data,
+                           'stream_clients': r.stream_stats(),
+                           'renditions': r.rendition_stats(),
+                           'frames': r.frame_stats(),
+                           'tracking': r.tracking_stats(),
+                           'commands': r.command_stats(),
+                           'metrics': r.metrics_stats()}, self.rover_handlers.values()))
+
+        list_response = {'server_id': str(self.id), 'rovers': rovers_list,
+                         'cascades': shared_cv_helper.cascades.stats(),
+                         'loop_lag': self.loop_lag.stats()}
 
         await send_websocket_message(list_response, websocket)
 
@@ -658,23 +2849,27 @@ class ProxyServer(object):
         connect_msg = await websocket.recv()
         connect_cmd = json.loads(connect_msg)
 
+        rover = self.rover_handlers[connect_cmd['rover_id']]
+        rendition = connect_cmd.get('rendition', DEFAULT_RENDITION)
+        if rendition not in rover.renditions:
+            rendition = DEFAULT_RENDITION
+
         connect_response = {'server_id': str(self.id), 'client_id': connect_cmd['client_id'],
-                            'rover_id': connect_cmd['rover_id'], 'msg': 'ok'}
+                            'rover_id': connect_cmd['rover_id'], 'rendition': rendition, 'msg': 'ok'}
 
         await send_websocket_message(connect_response, websocket)
         start_msg = await websocket.recv()
 
         print(start_msg)
 
-        rover = self.rover_handlers[connect_cmd['rover_id']]
-
         await websocket.send(
-            rover.stream_data.jsmpeg_header.pack(rover.stream_data.jsmpeg_magic, rover.stream_data.width,
-                                                 rover.stream_data.height))
+            rover.stream_data.jsmpeg_header.pack(rover.stream_data.jsmpeg_magic, rover.renditions[rendition].width,
+                                                 rover.renditions[rendition].height))
 
-        self.rover_handlers[connect_cmd['rover_id']].add_stream_client(connect_cmd['client_id'], websocket)
+        rover.add_stream_client(connect_cmd['client_id'], websocket, rendition)
 
         await websocket.wait_closed()
+        rover.remove_stream_client(connect_cmd['client_id'], websocket)
         print('Stream client disconnected')
 
     async def serve_rovers(self):
@@ -694,25 +2889,98 @@ class ProxyServer(object):
         conn = websockets.serve(self.greet_stream_client, '0.0.0.0', server_data.stream_port)
         return conn
 
+    def metrics_text(self):
+        lines = ['# TYPE proxy_stage_seconds histogram']
+        for rover in self.rover_handlers.values():
+            for metrics in rover.pipeline_metrics():
+                lines += metrics.prometheus_stages(f'rover_id="{rover.rover_id}"')
+
+        lines.append('# TYPE proxy_events_total counter')
+        for rover in self.rover_handlers.values():
+            for metrics in rover.pipeline_metrics():
+                lines += metrics.prometheus_counters(f'rover_id="{rover.rover_id}"')
+
+        lines.append('# TYPE proxy_stream_clients gauge')
+        for rover in self.rover_handlers.values():
+            for rendition in rover.renditions.values():
+                lines.append(f'proxy_stream_clients{{rover_id="{rover.rover_id}",rendition="{rendition.name}"}} '
+                             f'{len(rendition.stream_clients)}')
+
+        # The state of the last status answer of every rover
+        lines.append('# TYPE proxy_rover_sensor gauge')
+        for rover in self.rover_handlers.values():
+            sensors = rover.command_channel.rover_sensors or {}
+            for name in ('distance_cm', 'blocked', 'cam_top_limit', 'cam_bottom_limit'):
+                if sensors.get(name) is not None:
+                    lines.append(f'proxy_rover_sensor{{rover_id="{rover.rover_id}",sensor="{name}"}} '
+                                 f'{float(sensors[name])}')
+
+        lines.append('# TYPE proxy_rover_serial gauge')
+        for rover in self.rover_handlers.values():
+            serial = rover.command_channel.rover_serial or {}
+            for name, value in serial.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'proxy_rover_serial{{rover_id="{rover.rover_id}",field="{name}"}} {float(value)}')
+
+        lines.append('# TYPE proxy_loop_lag_seconds histogram')
+        lines += self.loop_lag.prometheus('proxy_loop_lag_seconds', 'process="proxy"')
+        return '\n'.join(lines) + '\n'
+
+    # A bare HTTP/1.0 responder, enough for a Prometheus scraper or curl
+    async def serve_metrics_request(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request.decode(errors='replace').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                body = self.metrics_text().encode()
+                status = '200 OK'
+            else:
+                body = b'Not found\n'
+                status = '404 Not Found'
+
+            writer.write(f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except Exception as e:
+            print(e)
+        finally:
+            writer.close()
+
+    # The metrics are optional, a port already in use must not keep the proxy from starting
+    async def serve_metrics(self):
+        print('Starting metrics server')
+        try:
+            server = await asyncio.start_server(
+                self.serve_metrics_request, '127.0.0.1', server_data.metrics_port)
+        except OSError as e:
+            print(f'Could not serve the metrics on port {server_data.metrics_port}: {e}')
+            return None
+
+        return server.serve_forever()
+
     async def start_all(self):
-        await asyncio.gather(await self.serve_rovers(),
-                             await self.server_rover_clients(),
-                             await self.serve_stream_clients())
+        asyncio.create_task(monitor_loop_lag(self.loop_lag))
+        servers = [await self.serve_rovers(),
+                   await self.server_rover_clients(),
+                   await self.serve_stream_clients()]
 
+        if server_data.metrics_port is not None:
+            metrics_server = await self.serve_metrics()
+            if metrics_server is not None:
+                servers.append(metrics_server)
 
-# Send the message, given as dictionary, to the socket, encoded as json
-async def send_socket_message(message, writer):
-    try:
-        encoded_msg = json.dumps(message) + '\n'
-        writer.write(encoded_msg.encode())
-        await writer.drain()
-    except Exception as e:
-        print(e)
+        await asyncio.gather(*servers)
 
 
 # Send the message, given as dictionary, to the socket, encoded as json
-async def send_websocket_message(message, websocket):
+async def send_websocket_message(message, websocket, codec=None):
     try:
+        if codec is not None and codec.name != 'json':
+            await websocket.send(codec.encode(message))
+            return
         encoded_msg = json.dumps(message) + '\n'
         await websocket.send(encoded_msg)
     except Exception as e:
@@ -728,6 +2996,28 @@ async def main():
     parser.add_argument('-ctrl', '--external_control_port', default=8888, type=int, help='The external ctrl port')
 
     parser.add_argument('-t', '--stream_port', default=8889, type=int, help='The external stream port')
+    parser.add_argument('--detection_scale', default=0.5, type=float,
+                        help='The scale of the frame copy the face detection runs on')
+    parser.add_argument('--detection_window', default=0.5, type=float,
+                        help='The padding of the window around the last target to search first, 0 to disable')
+    parser.add_argument('--control_rate', default=20.0, type=float,
+                        help='How many times a second the follow controller runs')
+    parser.add_argument('--camera_gains', default=FOLLOW_GAINS['camera'], nargs=4, type=float,
+                        metavar=('KP', 'KI', 'KD', 'EXPONENT'), help='The gains of the camera pan and tilt controller')
+    parser.add_argument('--approach_gains', default=FOLLOW_GAINS['approach'], nargs=4, type=float,
+                        metavar=('KP', 'KI', 'KD', 'EXPONENT'), help='The gains of the wheel approach controller')
+    parser.add_argument('--turn_gains', default=FOLLOW_GAINS['turn'], nargs=4, type=float,
+                        metavar=('KP', 'KI', 'KD', 'EXPONENT'), help='The gains of the wheel turn controller')
+    parser.add_argument('--metrics_port', default=None, type=int,
+                        help='The local port serving the /metrics endpoint, not served if not given')
+    parser.add_argument('--passthrough', action='store_true',
+                        help='Let ffmpeg transcode the rover streams directly while nothing is tracked')
+    parser.add_argument('--rover_processes', action='store_true',
+                        help='Run the media pipeline of every rover in its own process')
+    parser.add_argument('--encoder', default='ffmpeg', choices=ENCODER_BACKENDS,
+                        help='How the rover streams are encoded, pyav encodes inside the proxy')
+    parser.add_argument('--rover_encoder', default=[], nargs=2, action='append', metavar=('ROVER_ID', 'ENCODER'),
+                        help='The encoder of a single rover, overriding --encoder')
 
     args = parser.parse_args()
 
@@ -735,6 +3025,19 @@ async def main():
     server_data.e_ctrl_port = args.external_control_port
 
     server_data.stream_port = args.stream_port
+    server_data.detection_scale = args.detection_scale
+    server_data.detection_window_padding = args.detection_window
+    server_data.rover_processes = args.rover_processes
+    server_data.control_rate = args.control_rate
+    server_data.follow_gains = {'camera': tuple(args.camera_gains), 'approach': tuple(args.approach_gains),
+                                'turn': tuple(args.turn_gains)}
+    server_data.metrics_port = args.metrics_port
+    server_data.passthrough = args.passthrough
+    server_data.encoder = args.encoder
+    server_data.rover_encoders = dict(args.rover_encoder)
+    for rover_id, encoder in server_data.rover_encoders.items():
+        if encoder not in ENCODER_BACKENDS:
+            parser.error(f'unknown encoder {encoder} for rover {rover_id}')
 
     # Move script to http folder
     os.environ['OPENCV_FFMPEG_CAPTURE_OPTIONS'] = 'protocol_whitelist;file,rtp,udp'
@@ -0,0 +1,228 @@
+import json
+import asyncio
+
+import server_proxy
+from server_proxy import CONTROL_IN_FLIGHT_MAX, RoverCommandChannel, RoverHandler, shared_cv_helper
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def messages(self):
+        return list(map(json.loads, self.data.splitlines()))
+
+
+def run(test):
+    async def with_channel():
+        writer = FakeWriter()
+        channel = RoverCommandChannel(writer)
+        try:
+            await test(channel, writer)
+        finally:
+            channel.stop()
+
+    asyncio.run(with_channel())
+
+
+async def written():
+    # One loop tick for the writer task to pick up the batch
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+def test_answers_matched_by_seq():
+    async def test(channel, writer):
+        futures = [channel.forward({'cmd': 'status', 'n': n}) for n in range(3)]
+        await written()
+        seqs = list(map(lambda message: message['seq'], writer.messages()))
+        assert len(set(seqs)) == 3
+
+        # The rover answers in order, the first command will not get an answer any more
+        channel.on_response({'msg': 'ok', 'n': 1, 'seq': seqs[1]})
+        assert futures[0].result() == {'msg': 'failed', 'info': 'rover_no_response'}
+        assert futures[1].result() == {'msg': 'ok', 'n': 1}
+        assert not futures[2].done()
+
+        channel.on_response({'msg': 'ok', 'n': 2, 'seq': seqs[2]})
+        assert futures[2].result() == {'msg': 'ok', 'n': 2}
+        assert channel.stats()['in_flight'] == 0
+        assert channel.stats()['channel_lost'] == 1
+
+    run(test)
+
+
+def test_answer_to_unknown_seq_is_ignored():
+    async def test(channel, writer):
+        future = channel.forward({'cmd': 'status'})
+        await written()
+
+        channel.on_response({'msg': 'ok', 'seq': writer.messages()[0]['seq'] + 100})
+        assert not future.done()
+
+    run(test)
+
+
+def test_answer_without_seq_is_for_the_oldest():
+    async def test(channel, writer):
+        futures = [channel.forward({'cmd': 'status'}) for n in range(2)]
+        await written()
+
+        channel.on_response({'msg': 'ok', 'n': 0})
+        assert futures[0].result() == {'msg': 'ok', 'n': 0}
+        assert not futures[1].done()
+
+    run(test)
+
+
+def test_bad_response_gives_up_the_oldest():
+    async def test(channel, writer):
+        futures = [channel.forward({'cmd': 'status'}) for n in range(2)]
+        await written()
+
+        channel.on_bad_response()
+        assert futures[0].result()['info'] == 'rover_no_response'
+
+        # An older rover, without seq, stays in step
+        channel.on_response({'msg': 'ok', 'n': 1})
+        assert futures[1].result() == {'msg': 'ok', 'n': 1}
+
+    run(test)
+
+
+def test_in_flight_is_bounded():
+    async def test(channel, writer):
+        futures = [channel.forward({'cmd': 'status', 'n': n}) for n in range(CONTROL_IN_FLIGHT_MAX + 5)]
+        await written()
+        assert channel.stats()['in_flight'] == CONTROL_IN_FLIGHT_MAX
+        assert all(map(lambda future: future.result()['info'] == 'rover_no_response', futures[:5]))
+
+        # The answers still find their command
+        last = writer.messages()[-1]
+        channel.on_response({'msg': 'ok', 'n': last['n'], 'seq': last['seq']})
+        assert futures[-1].result() == {'msg': 'ok', 'n': last['n']}
+
+    run(test)
+
+
+def test_status_is_kept():
+    async def test(channel, writer):
+        channel.forward({'cmd': 'status'})
+        await written()
+
+        channel.on_response({'msg': 'ok', 'serial': {'acks': True}, 'sensors': {'blocked': False},
+                             'seq': writer.messages()[0]['seq']})
+        assert channel.stats()['rover_serial'] == {'acks': True}
+        assert channel.stats()['rover_sensors'] == {'blocked': False}
+
+    run(test)
+
+
+def test_coalescing_keeps_the_order_of_kinds():
+    async def test(channel, writer):
+        channel.send({'cmd': 'set_speed', 'params': {'speed': 0.1}})
+        channel.send({'cmd': 'set_speed', 'params': {'speed': 0.2}})
+        channel.send({'cmd': 'set_cam_speed', 'params': {'speed': [1.0, 1.0]}})
+        # Not merged with the first set_speed, it would jump ahead of set_cam_speed
+        channel.send({'cmd': 'set_speed', 'params': {'speed': 0.3}})
+        channel.send({'cmd': 'move_stop', 'params': {'motors': ['wheels']}})
+        channel.send({'cmd': 'set_speed', 'params': {'speed': 0.4}})
+        await written()
+
+        sent = list(map(lambda message: (message['cmd'], message['params']), writer.messages()))
+        assert sent == [('set_speed', {'speed': 0.2}), ('set_cam_speed', {'speed': [1.0, 1.0]}),
+                        ('set_speed', {'speed': 0.3}), ('move_stop', {'motors': ['wheels']}),
+                        ('set_speed', {'speed': 0.4})]
+        assert channel.stats()['channel_replaced'] == 1
+
+    run(test)
+
+
+def test_client_messages_are_not_coalesced():
+    async def test(channel, writer):
+        channel.send({'cmd': 'set_speed', 'params': {'speed': 0.1}})
+        channel.forward({'cmd': 'set_speed', 'params': {'speed': 0.2}})
+        channel.send({'cmd': 'set_speed', 'params': {'speed': 0.3}})
+        await written()
+
+        assert list(map(lambda message: message['params']['speed'], writer.messages())) == [0.1, 0.2, 0.3]
+
+    run(test)
+
+
+HELLO = {'rover_id': 'rover', 'cmd': 'hello',
+         'rover_data': {'name': 'Test', 'description': 'test', 'fov': 60, 'stream_size': [64, 48],
+                        'mobility': ['gimbal', 'wheels']}}
+
+
+# A client socket that sends the given messages and stays connected until closed
+class FakeClient:
+    def __init__(self, messages):
+        self.messages = list(map(json.dumps, messages))
+        self.closed = asyncio.Event()
+        self.received = asyncio.Queue()
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for message in self.messages:
+            yield message
+        await self.closed.wait()
+
+    async def send(self, message):
+        await self.received.put(json.loads(message))
+
+    async def next_answer(self):
+        return await asyncio.wait_for(self.received.get(), 1.0)
+
+
+def run_client(messages, test):
+    async def with_client():
+        writer = FakeWriter()
+        handler = RoverHandler(HELLO, shared_cv_helper, None, writer)
+        client = FakeClient(messages)
+        handler.add_rover_client('client', client)
+        task = asyncio.create_task(handler.forward_client_cmds('client'))
+        try:
+            await test(handler, client, writer)
+        finally:
+            client.closed.set()
+            await task
+            handler.command_channel.stop()
+
+    asyncio.run(with_client())
+
+
+def test_client_gets_the_rover_answers_in_order():
+    async def test(handler, client, writer):
+        await written()
+        await written()
+        forwarded = writer.messages()
+        assert list(map(lambda message: message['cmd'], forwarded)) == ['move', 'status']
+
+        # list_faces is answered by the proxy, it still waits for the answer to the move
+        assert client.received.empty()
+        handler.command_channel.on_response({'msg': 'failed', 'info': 'blocked', 'seq': forwarded[0]['seq']})
+        handler.command_channel.on_response({'msg': 'ok', 'seq': forwarded[1]['seq']})
+
+        assert await client.next_answer() == {'msg': 'failed', 'info': 'blocked'}
+        assert (await client.next_answer())['faces'] == []
+        assert await client.next_answer() == {'msg': 'ok'}
+
+    run_client([{'cmd': 'move', 'params': {'direction': ['forward']}}, {'cmd': 'list_faces'}, {'cmd': 'status'}], test)
+
+
+def test_rover_that_does_not_answer_times_out(monkeypatch):
+    monkeypatch.setattr(server_proxy, 'CONTROL_RESPONSE_TIMEOUT', 0.05)
+
+    async def test(handler, client, writer):
+        assert await client.next_answer() == {'msg': 'failed', 'info': 'rover_timeout'}
+
+    run_client([{'cmd': 'status'}], test)
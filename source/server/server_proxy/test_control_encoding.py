@@ -0,0 +1,98 @@
+import os
+import asyncio
+import pytest
+
+import control_encoding
+from control_encoding import FRAME_MESSAGE, FRAME_MOVE, FRAME_OK, BinaryCodec, JsonCodec, control_codec, \
+    negotiate_encoding, supported_encodings
+
+MESSAGES = [
+    {'client_id': 'c', 'rover_id': 'r', 'timestamp': 1700000000.125, 'cmd': 'move',
+     'params': {'direction': ['forward', 'left']}},
+    {'cmd': 'move', 'params': {'direction': []}},
+    {'cmd': 'move_cam', 'params': {'direction': ['up', 'ccw']}, 'timestamp': 12.5},
+    {'cmd': 'set_cam_speed', 'params': {'speed': [12.0, 4.5]}},
+    {'cmd': 'set_speed', 'params': {'speed': 0.125}},
+    {'cmd': 'move_stop', 'params': {'motors': ['wheels', 'camera']}},
+    {'msg': 'ok'},
+    {'msg': 'failed', 'info': 'blocked'},
+    {'msg': 'ok', 'serial': {'acks': True}, 'sensors': {'distance_cm': 40}},
+    {'cmd': 'move', 'params': {'direction': ['back']}, 'seq': 7},
+    {'cmd': 'set_cam_speed', 'params': {'speed': [1.0, 2.0]}, 'timestamp': 1.5, 'seq': 9},
+    {'cmd': 'status', 'seq': 12},
+    {'msg': 'ok', 'seq': 3},
+    {'msg': 'failed', 'info': 'blocked', 'seq': 0xFFFFFFFF},
+]
+
+
+def read_all(codec, data):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        messages = []
+        while True:
+            message = await codec.read(reader)
+            if message is None:
+                return messages
+            messages.append(message)
+
+    return asyncio.run(read())
+
+
+def expected(message, encoding):
+    # The fixed layouts drop the ids, the connection implies them
+    if encoding != 'json' and message.get('cmd') == 'move' and 'client_id' in message:
+        return {k: v for k, v in message.items() if k not in ('client_id', 'rover_id')}
+    return message
+
+
+@pytest.mark.parametrize('encoding', supported_encodings())
+@pytest.mark.parametrize('message', MESSAGES)
+def test_round_trip(encoding, message):
+    codec = control_codec(encoding)
+    assert codec.decode(codec.encode(message)) == expected(message, encoding)
+
+
+@pytest.mark.parametrize('encoding', supported_encodings())
+def test_stream_of_messages(encoding):
+    codec = control_codec(encoding)
+    data = b''.join(map(codec.encode, MESSAGES))
+    assert read_all(codec, data) == list(map(lambda message: expected(message, encoding), MESSAGES))
+
+
+def test_fixed_layouts():
+    codec = BinaryCodec('struct')
+    assert codec.encode(MESSAGES[0])[0] == FRAME_MOVE
+    assert codec.encode({'msg': 'ok'})[0] == FRAME_OK
+    assert codec.encode({'msg': 'ok', 'seq': 3})[0] == FRAME_OK
+    # So does a sequence number that does not fit
+    assert codec.encode({'msg': 'ok', 'seq': 1 << 32})[0] == FRAME_MESSAGE
+    assert codec.encode({'msg': 'ok', 'seq': '3'})[0] == FRAME_MESSAGE
+    # A field the layout has no room for makes it a plain message
+    assert codec.encode(dict(MESSAGES[0], extra=1))[0] == FRAME_MESSAGE
+    assert codec.encode({'cmd': 'move', 'params': {'direction': ['forward', 'forward']}})[0] == FRAME_MESSAGE
+
+
+def test_json_is_one_message_per_line():
+    assert JsonCodec().encode({'msg': 'ok'}) == b'{"msg": "ok"}\n'
+
+
+def test_bad_frame():
+    codec = BinaryCodec('struct')
+    with pytest.raises(ValueError):
+        codec.decode(codec.frame_header.pack(99, 0))
+    with pytest.raises(ValueError):
+        codec.decode(codec.frame_header.pack(FRAME_MOVE, 2) + b'\x00\x00')
+
+
+def test_negotiation():
+    assert negotiate_encoding(['xml', 'struct', 'json']) == 'struct'
+    assert negotiate_encoding(['xml']) == 'json'
+    assert negotiate_encoding([]) == 'json'
+
+
+def test_rover_links_this_module():
+    rover_module = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                'server_rover', 'raspberry_server', 'control_encoding.py')
+    assert os.path.samefile(rover_module, control_encoding.__file__)
@@ -0,0 +1,60 @@
+import pytest
+
+from server_proxy import FOLLOW_GAINS, FollowCommandFilter, PIDController
+
+
+@pytest.mark.parametrize('error', [-0.45, -0.08, 0.0, 0.01, 0.2, 0.5])
+def test_default_gains_keep_the_original_curves(error):
+    pan = PIDController(*FOLLOW_GAINS['camera'], limit=90.0)
+    assert abs(pan.update(error, 0.05)) == pytest.approx(90.0 * abs(error) ** 1.2)
+
+    turn = PIDController(*FOLLOW_GAINS['turn'])
+    assert abs(turn.update(error, 0.05)) == pytest.approx(0.005 * abs(error) ** 3)
+
+    approach = PIDController(*FOLLOW_GAINS['approach'])
+    assert abs(approach.update(error * 4, 0.05)) == pytest.approx(0.1 * abs(error * 4))
+
+
+def test_output_keeps_the_sign_and_limit():
+    controller = PIDController(100.0, exponent=2.0, limit=10.0)
+    assert controller.update(-0.2, 0.05) == pytest.approx(-4.0)
+    assert controller.update(0.5, 0.05) == 10.0
+
+
+def cam_speed(pan, tilt):
+    return {'cmd': 'set_cam_speed', 'params': {'speed': [pan, tilt]}}
+
+
+def test_speeds_are_quantized_with_hysteresis():
+    command_filter = FollowCommandFilter()
+    assert command_filter.filter(cam_speed(10.2, 0.3))['params']['speed'] == [10.0, 1.0]
+    # Within three quarters of a step of the last speed, nothing changes
+    assert command_filter.filter(cam_speed(10.7, 0.6)) is None
+    assert command_filter.filter(cam_speed(9.3, 1.7)) is None
+    assert command_filter.filter(cam_speed(10.8, 1.2))['params']['speed'] == [11.0, 1.0]
+    assert command_filter.filter({'cmd': 'set_speed', 'params': {'speed': 0.0071}})['params']['speed'] == 0.005
+
+
+def test_repeated_directions_and_stops_are_suppressed():
+    command_filter = FollowCommandFilter()
+    move = {'cmd': 'move', 'params': {'direction': ['forward', 'cw']}}
+    stop = {'cmd': 'move_stop', 'params': {'motors': ['wheels']}}
+
+    assert command_filter.filter(move) == move
+    assert command_filter.filter(dict(move)) is None
+    assert command_filter.filter({'cmd': 'move_cam', 'params': {'direction': ['up', 'cw']}}) is not None
+    assert command_filter.filter(stop) == stop
+    assert command_filter.filter(stop) is None
+    assert command_filter.filter(move) == move
+
+    command_filter.invalidate()
+    assert command_filter.filter(move) == move
+    assert command_filter.stats()['sent'] == 5
+    assert command_filter.stats()['suppressed'] == 2
+
+
+def test_recorded_messages_count_as_sent():
+    command_filter = FollowCommandFilter()
+    command_filter.record({'cmd': 'move_stop', 'params': {'motors': ['camera', 'wheels']}})
+    assert command_filter.filter({'cmd': 'move_stop', 'params': {'motors': ['wheels']}}) is None
+    assert command_filter.filter({'cmd': 'move_cam', 'params': {'direction': ['up']}}) is not None
@@ -0,0 +1,55 @@
+import math
+import pytest
+
+from server_proxy import Histogram, PipelineMetrics
+
+
+def test_quantiles_are_bucket_bounds():
+    histogram = Histogram(buckets=(0.01, 0.1, 1.0))
+    for value in [0.005] * 50 + [0.05] * 45 + [0.5] * 5:
+        histogram.observe(value)
+
+    assert histogram.quantile(0.5) == 0.01
+    assert histogram.quantile(0.95) == 0.1
+    assert histogram.quantile(0.99) == 0.5
+    assert histogram.stats()['avg_ms'] == pytest.approx((0.25 + 2.25 + 2.5) / 100 * 1000.0)
+
+
+def test_overflow_reports_the_largest_value():
+    histogram = Histogram()
+    for n in range(90):
+        histogram.observe(10.0)
+    histogram.observe(0.001)
+
+    stats = histogram.stats()
+    assert stats['p50_ms'] == stats['p95_ms'] == stats['max_ms'] == 10000.0
+    assert all(map(math.isfinite, stats.values()))
+
+
+def test_empty():
+    assert Histogram().stats() == {'count': 0, 'avg_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0,
+                                   'max_ms': 0.0}
+
+
+def test_prometheus_buckets_are_cumulative():
+    histogram = Histogram(buckets=(0.01, 0.1))
+    for value in (0.005, 0.05, 0.05, 3.0):
+        histogram.observe(value)
+
+    assert histogram.prometheus('latency', 'rover="r"') == [
+        'latency_bucket{rover="r",le="0.01"} 1',
+        'latency_bucket{rover="r",le="0.1"} 3',
+        'latency_bucket{rover="r",le="+Inf"} 4',
+        'latency_sum{rover="r"} 3.105',
+        'latency_count{rover="r"} 4']
+
+
+def test_snapshot_round_trip():
+    metrics = PipelineMetrics()
+    metrics.observe('encode', 0.004)
+    metrics.observe('encode', 7.0)
+    metrics.count('packets', 3)
+
+    copy = PipelineMetrics()
+    copy.load(metrics.snapshot())
+    assert copy.stats() == metrics.stats()
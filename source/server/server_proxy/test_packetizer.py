@@ -0,0 +1,47 @@
+import pytest
+
+from server_proxy import MPEG1_B_PICTURE, MPEG1_I_PICTURE, MPEG1_P_PICTURE, Mpeg1Packetizer
+
+SEQUENCE_HEADER = b'\x00\x00\x01\xb3\x28\x01\x68\x13\xff\xff\xe0\x18'
+GOP_HEADER = b'\x00\x00\x01\xb8\x00\x08\x00\x00'
+
+
+def picture(picture_type, size=40):
+    # 10 bits of temporal reference, 3 bits of coding type, then one slice
+    header = b'\x00\x00\x01\x00\x00' + bytes([picture_type << 3]) + b'\xff\xf8'
+    return header + b'\x00\x00\x01\x01' + bytes(range(1, size + 1))
+
+
+PICTURES = [SEQUENCE_HEADER + GOP_HEADER + picture(MPEG1_I_PICTURE, 200),
+            picture(MPEG1_P_PICTURE), picture(MPEG1_B_PICTURE),
+            GOP_HEADER + picture(MPEG1_I_PICTURE, 100), picture(MPEG1_P_PICTURE, 5)]
+STREAM = b''.join(PICTURES)
+
+
+def packetize(chunk_size):
+    packetizer = Mpeg1Packetizer()
+    packets = []
+    for start in range(0, len(STREAM), chunk_size):
+        packets += packetizer.feed(STREAM[start:start + chunk_size])
+    # Every picture but the last is out before the end of the stream
+    assert len(packets) == len(PICTURES) - 1
+    return packets + packetizer.flush()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, len(STREAM)])
+def test_packets_are_whole_pictures(chunk_size):
+    packets = packetize(chunk_size)
+
+    assert list(map(lambda p: p.data, packets)) == PICTURES
+    assert list(map(lambda p: p.picture_type, packets)) == \
+        [MPEG1_I_PICTURE, MPEG1_P_PICTURE, MPEG1_B_PICTURE, MPEG1_I_PICTURE, MPEG1_P_PICTURE]
+    assert list(map(lambda p: p.has_sequence_header, packets)) == [True, False, False, False, False]
+    assert list(map(lambda p: p.keyframe, packets)) == [True, False, False, True, False]
+
+
+def test_flush_without_a_picture_drops_the_bytes():
+    packetizer = Mpeg1Packetizer()
+    assert packetizer.feed(SEQUENCE_HEADER) == []
+    assert packetizer.flush() == []
+    assert packetizer.feed(picture(MPEG1_P_PICTURE)) == []
+    assert list(map(lambda p: p.data, packetizer.flush())) == [picture(MPEG1_P_PICTURE)]
@@ -0,0 +1,45 @@
+import random
+
+import numpy as np
+import pytest
+
+from server_proxy import RingBuffer
+
+
+def test_items_are_relative_to_the_oldest():
+    ring = RingBuffer(4)
+    for value in range(6):
+        ring.append(value)
+
+    assert len(ring) == 4
+    assert [ring[i] for i in range(4)] == [2.0, 3.0, 4.0, 5.0]
+    assert ring[-1] == 5.0
+
+
+@pytest.mark.parametrize('recompute_interval', [1, 7, 1024])
+def test_running_statistics_match_the_window(recompute_interval):
+    rng = random.Random(42)
+    ring = RingBuffer(30, initializer=1.5, recompute_interval=recompute_interval)
+    assert ring.mean == 1.5 and ring.variance == 0.0
+
+    for _ in range(500):
+        ring.append(rng.uniform(-1000.0, 1000.0))
+        window = np.array([ring[i] for i in range(len(ring))])
+        assert ring.total == pytest.approx(window.sum(), abs=1e-6)
+        assert ring.mean == pytest.approx(window.mean(), abs=1e-6)
+        assert ring.variance == pytest.approx(window.var(), rel=1e-6)
+        assert ring.std == pytest.approx(window.std(), rel=1e-6)
+
+
+def test_set_all_resets_the_statistics():
+    ring = RingBuffer(8)
+    for value in range(20):
+        ring.append(value)
+
+    ring.set_all(3.0)
+    assert ring.total == 24.0
+    assert ring.mean == 3.0
+    assert ring.variance == 0.0
+    ring.append(11.0)
+    assert ring.mean == pytest.approx(4.0)
+    assert ring.variance == pytest.approx(np.var([3.0] * 7 + [11.0]))
@@ -0,0 +1,21 @@
+import asyncio
+import multiprocessing
+
+from server_proxy import RemoteRoverHandler, StreamPacket, shared_cv_helper
+from test_command_channel import HELLO, FakeWriter
+
+
+def test_release_in_worker_clears_the_front_gop_cache():
+    async def test():
+        handler = RemoteRoverHandler(HELLO, shared_cv_helper, None, FakeWriter())
+        handler.conn, worker_conn = multiprocessing.Pipe()
+        rendition = next(iter(handler.renditions.values()))
+        rendition.gop_cache.add(StreamPacket(b'\x00\x00\x01\xb3', 1, True))
+        assert rendition.gop_cache.snapshot()
+
+        worker_conn.send(('release', rendition.name))
+        handler.on_worker_message()
+        assert rendition.gop_cache.snapshot() == b''
+        handler.command_channel.stop()
+
+    asyncio.run(test())
@@ -89,6 +89,9 @@ class rover_HAL {
     ROVER_DIRECTION last_rover_direction = ROVER_DIRECTION::STOP;
     ROVER_DIRECTION current_rover_direction = ROVER_DIRECTION::STOP;
 
+    // Set while the distance sensor sees an obstacle, forward movements are refused
+    bool blocked = false;
+
     movement_controller() {};
 
     movement_controller(int* pins) {
@@ -209,6 +212,10 @@ class rover_HAL {
       this->current_rover_direction = ROVER_DIRECTION::STOP;
       this->current_speed = 0;
     }
+
+    static bool is_forward(ROVER_DIRECTION dir) {
+      return dir == ROVER_DIRECTION::FORWARD || dir == ROVER_DIRECTION::FORWARD_LEFT || dir == ROVER_DIRECTION::FORWARD_RIGHT;
+    }
   };
 
   class camera_controller {
@@ -224,6 +231,9 @@ class rover_HAL {
     float angular_velocity_x = 30 / 1000.0;
     float angular_velocity_z = 30 / 1000.0;
 
+    // The tilt limit switches close to ground, -1 when not fitted
+    int top_limit_pin = -1, bottom_limit_pin = -1;
+
     camera_controller() {};
 
     camera_controller(int* pins) {
@@ -236,6 +246,25 @@ class rover_HAL {
       this->z_motor.attach_constrained_rotation();
     }
 
+    void attach_limit_switches(int top_pin, int bottom_pin) {
+      this->top_limit_pin = top_pin;
+      this->bottom_limit_pin = bottom_pin;
+
+      pinMode(this->top_limit_pin, INPUT_PULLUP);
+      pinMode(this->bottom_limit_pin, INPUT_PULLUP);
+    }
+
+    // Up lowers xAngle, the top is either the switch or the lower angle limit
+    bool at_top() {
+      return (this->top_limit_pin >= 0 && digitalRead(this->top_limit_pin) == LOW) ||
+        this->xAngle <= this->xAngle_lower_limit;
+    }
+
+    bool at_bottom() {
+      return (this->bottom_limit_pin >= 0 && digitalRead(this->bottom_limit_pin) == LOW) ||
+        this->xAngle >= this->xAngle_upper_limit;
+    }
+
     void update_limits() {
       this->x_motor.angle_upper_limit = this->xAngle_upper_limit;
       this->x_motor.angle_lower_limit = this->xAngle_lower_limit;
@@ -275,11 +304,15 @@ class rover_HAL {
         //Serial.println(delta_angle);
 
         if ((this->current_camera_direction & CAM_DIRECTION::UP) != CAM_DIRECTION::STOP) {
-          this->xAngle -= delta_angle_x;
+          if (!this->at_top()) {
+            this->xAngle -= delta_angle_x;
+          }
           //Serial.println("Moving up");
         }
         else if ((this->current_camera_direction & CAM_DIRECTION::DOWN) != CAM_DIRECTION::STOP) {
-          this->xAngle += delta_angle_x;
+          if (!this->at_bottom()) {
+            this->xAngle += delta_angle_x;
+          }
           //Serial.println("Moving down");
         }
 
@@ -319,7 +352,8 @@ class rover_HAL {
       delayMicroseconds(10);
       digitalWrite(this->sensor_pins[0], LOW);
 
-      unsigned long duration = pulseIn(this->sensor_pins[1], HIGH);
+      // Give up after about 5m worth of echo, 0 means nothing in range
+      unsigned long duration = pulseIn(this->sensor_pins[1], HIGH, 30000UL);
 
       return (duration / 2.0) / 29.1;
     }
@@ -408,6 +442,10 @@ public:
   light_controller laser;
   light_controller lights;
 
+  // The latest distance sensor reading in cm, 0 when nothing is in range
+  unsigned long front_distance = 0;
+  unsigned long obstacle_distance = 20;
+
   rover_HAL() {}
 
   void init_motor_controllers(int* motor_pins, int* camera_motor_pins) {
@@ -419,6 +457,36 @@ public:
     this->distance_sensor = distance_sensor_controller(distance_sensor_pins);
   }
 
+  void init_camera_limit_switches(int top_pin, int bottom_pin) {
+    this->cam_controller.attach_limit_switches(top_pin, bottom_pin);
+  }
+
+  // Reads the distance sensor, stopping a forward movement if an obstacle is too close
+  void update_sensors() {
+    this->front_distance = this->distance_sensor.get_distance();
+    this->move_controller.blocked = this->front_distance > 0 && this->front_distance < this->obstacle_distance;
+
+    if (this->move_controller.blocked && movement_controller::is_forward(this->move_controller.current_rover_direction)) {
+      this->move_controller.current_rover_direction = ROVER_DIRECTION::STOP;
+    }
+  }
+
+  // The sensor state as the bits of the status line, see docs/protocol
+  int status_flags() {
+    int flags = 0;
+
+    if (this->move_controller.blocked) {
+      flags |= 1;
+    }
+    if (this->cam_controller.at_top()) {
+      flags |= 2;
+    }
+    if (this->cam_controller.at_bottom()) {
+      flags |= 4;
+    }
+    return flags;
+  }
+
   void init_laser(int laser_pin) {
     this->laser = light_controller(laser_pin);
   }
@@ -483,6 +551,10 @@ public:
         return ROVER_STATUS::ERR;
       }
 
+      if (this->move_controller.blocked && movement_controller::is_forward(dir)) {
+        return ROVER_STATUS::BLOCKED;
+      }
+
       this->move_controller.current_rover_direction = dir;
       this->move_controller.update_movement();
 
@@ -564,6 +636,13 @@ public:
       //Serial.print("Cam direction:");
       //Serial.println(static_cast<int>(dir));
 
+      if ((dir & CAM_DIRECTION::UP) != CAM_DIRECTION::STOP && this->cam_controller.at_top()) {
+        return ROVER_STATUS::CAM_TOP_LIMIT;
+      }
+      if ((dir & CAM_DIRECTION::DOWN) != CAM_DIRECTION::STOP && this->cam_controller.at_bottom()) {
+        return ROVER_STATUS::CAM_BOTTOM_LIMIT;
+      }
+
       // Check if it's a free movement
       this->cam_controller.current_camera_direction = dir;
     }
@@ -771,12 +850,14 @@ void setup() {
   int wheels_motors_pins[2] = { 7, 8 };
   int camera_motors_pins[2] = { 12, 17 };
   int distance_sensor_pins[2] = { 14, 15 };
+  int camera_limit_pins[2] = { 2, 3 };
   int laser_pin = 5;
   int light_pin = 6;
 
   // Init controllers
   g_rover_hal.init_motor_controllers(wheels_motors_pins, camera_motors_pins);
   g_rover_hal.init_distance_sensor(distance_sensor_pins);
+  g_rover_hal.init_camera_limit_switches(camera_limit_pins[0], camera_limit_pins[1]);
   g_rover_hal.init_laser(laser_pin);
   g_rover_hal.init_lights(light_pin);
 
@@ -809,7 +890,11 @@ void setup() {
   g_rover_hal.cam_controller.update_movement();
 }
 
+// How often the sensors are read and reported with a status line, in ms
+#define STATUS_INTERVAL 200
+
 unsigned long last_tick = millis();
+unsigned long last_status = 0;
 
 void loop() {
 
@@ -819,10 +904,41 @@ void loop() {
   if (Serial.available()) {
     String cmd = Serial.readStringUntil('\n');
     g_command_parser.parse_string(cmd);
-    g_rover_hal.execute_command( g_command_parser.current_command, g_command_parser.argcount);
+
+    // A command prefixed by #<seq> is answered with ack <seq> <status>
+    String* command = g_command_parser.current_command;
+    unsigned int argcount = g_command_parser.argcount;
+    long seq = -1;
+
+    if (argcount > 1 && command[0].startsWith("#")) {
+      seq = command[0].substring(1).toInt();
+      command++;
+      argcount--;
+    }
+
+    ROVER_STATUS status = g_rover_hal.execute_command(command, argcount);
+
+    if (seq >= 0) {
+      Serial.print("ack ");
+      Serial.print(seq);
+      Serial.print(" ");
+      Serial.println(static_cast<int>(status));
+    }
+
     g_command_parser.reset();
     ex_cmd = true;
   }
+
+    // Report the sensors as status <distance> <flags>
+    if (millis() - last_status >= STATUS_INTERVAL) {
+      g_rover_hal.update_sensors();
+
+      Serial.print("status ");
+      Serial.print(g_rover_hal.front_distance);
+      Serial.print(" ");
+      Serial.println(g_rover_hal.status_flags());
+      last_status = millis();
+    }
     
     // Perform the updates
     unsigned long now = millis();
@@ -62,7 +62,9 @@ enum class LIGHT_ACTION {
 enum class ROVER_STATUS {
 	OK,
 	ERR,
-	BLOCKED
+	BLOCKED,
+	CAM_TOP_LIMIT,
+	CAM_BOTTOM_LIMIT
 };
 
 #endif
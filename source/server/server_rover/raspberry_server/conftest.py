@@ -0,0 +1,2 @@
+# test_client.py is a manual client that connects to a rover when imported
+collect_ignore = ['test_client.py']
@@ -0,0 +1 @@
+../../server_proxy/control_encoding.py
\ No newline at end of file
@@ -5,9 +5,32 @@ import serial
 import cv2
 import atexit
 import uuid
+import time
+import threading
+import collections
+import contextvars
 import numpy as np
 from enum import Flag
 
+from control_encoding import JsonCodec, control_codec, supported_encodings
+
+# How long to wait for the dispatcher to answer the hello, an older one never does
+HELLO_ACK_TIMEOUT = 2.0
+
+# Serial commands where only the latest value matters, a queued one is overwritten by a
+# newer one of the same kind
+SERIAL_COALESCED_COMMANDS = {'move', 'move_cam', 'speed', 'cam_speed'}
+SERIAL_LATENCY_WINDOW = 100
+# How long a command waits for its ack before it counts as failed, and how often the
+# reader wakes up to check for that
+SERIAL_ACK_TIMEOUT = 0.5
+SERIAL_READ_TIMEOUT = 0.1
+
+# The previous response to wait for, the future to set once the response of the command
+# the task runs is sent and the sequence number of the command, see
+# RoverRequestHandler.dispatch
+response_turn = contextvars.ContextVar('response_turn', default=None)
+
 
 # The enum of the possible directions the rover can move
 class ROVER_DIRECTION(Flag):
@@ -56,6 +79,12 @@ class ROVER_STATUS(Flag):
     BLOCKED = 1
     CAM_TOP_LIMIT = 2
     CAM_BOTTOM_LIMIT = 4
+    ERR = 8
+
+
+# The status codes of the arduino acks, in the order of its ROVER_STATUS
+ACK_STATUSES = (ROVER_STATUS.OK, ROVER_STATUS.ERR, ROVER_STATUS.BLOCKED,
+                ROVER_STATUS.CAM_TOP_LIMIT, ROVER_STATUS.CAM_BOTTOM_LIMIT)
 
 
 # A class holding all data that is common to the rover and can be accessed by any other
@@ -73,25 +102,235 @@ class RoverData:
         self.data = None
 
 
+# Writes the serial commands on a thread of its own, so that a slow or full UART never
+# blocks the event loop. A SERIAL_COALESCED_COMMANDS command still waiting is replaced in
+# place by a newer one of the same kind if nothing was queued after it, so a move never
+# runs at a speed sent after it. Everything else is always written, in order.
+#
+# Every command gets a future with its ROVER_STATUS. Once the arduino is known to ack,
+# commands are written as #<seq> <command> and stay outstanding until the ack with that
+# sequence number comes in, so several can be in flight at once. A replaced command
+# shares the fate of the one that replaced it. With an older arduino, that never acks,
+# a command is OK as soon as it is written.
+class SerialWriter:
+    def __init__(self):
+        self.ser = None
+        self.thread = None
+        self.loop = None
+        self.pending = []
+        self.condition = threading.Condition()
+
+        self.acks = False
+        self.next_seq = 0
+        # Sequence number to the futures waiting for it and the time it was queued
+        self.outstanding = dict()
+
+        self.queued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.acked = 0
+        self.ack_timeouts = 0
+        self.max_depth = 0
+        # Seconds spent in write, from queueing to written and from queueing to acked,
+        # of the latest commands
+        self.write_times = collections.deque(maxlen=SERIAL_LATENCY_WINDOW)
+        self.latencies = collections.deque(maxlen=SERIAL_LATENCY_WINDOW)
+        self.ack_latencies = collections.deque(maxlen=SERIAL_LATENCY_WINDOW)
+
+    def start(self, ser):
+        self.ser = ser
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Queues the command, the returned future is resolved from the serial threads
+    def send(self, command):
+        if self.thread is None:
+            raise serial.SerialException('The serial port is not open')
+
+        self.loop = asyncio.get_running_loop()
+        future = self.loop.create_future()
+
+        kind = command.split(b' ', 1)[0].strip().decode()
+        with self.condition:
+            self.queued += 1
+            if kind in SERIAL_COALESCED_COMMANDS and self.pending and self.pending[-1][0] == kind:
+                self.pending[-1][1] = command
+                self.pending[-1][3].append(future)
+                self.coalesced += 1
+                return future
+
+            self.pending.append([kind, command, time.perf_counter(), [future]])
+            self.max_depth = max(self.max_depth, len(self.pending))
+            self.condition.notify()
+        return future
+
+    def resolve(self, futures, status):
+        def set_status():
+            for future in futures:
+                if not future.done():
+                    future.set_result(status)
+
+        self.loop.call_soon_threadsafe(set_status)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                kind, command, queued_at, futures = self.pending.pop(0)
+
+                # The reader may flip acks at any time, this command sticks to what it saw here
+                seq = None
+                if self.acks:
+                    seq = self.next_seq
+                    self.next_seq += 1
+                    self.outstanding[seq] = (futures, queued_at)
+                    command = b'#%d ' % seq + command
+
+            print(f'sending {command}')
+            start = time.perf_counter()
+            try:
+                self.ser.write(command)
+            except serial.SerialException as e:
+                print(f'Serial write failed: {e}')
+                if seq is not None:
+                    with self.condition:
+                        self.outstanding.pop(seq, None)
+                self.resolve(futures, ROVER_STATUS.ERR)
+                continue
+
+            now = time.perf_counter()
+            self.write_times.append(now - start)
+            self.latencies.append(now - queued_at)
+            self.written += 1
+
+            if seq is None:
+                self.resolve(futures, ROVER_STATUS.OK)
+
+    # Called by the reader with every ack of the arduino
+    def on_ack(self, seq, status):
+        with self.condition:
+            waiting = self.outstanding.pop(seq, None)
+        if waiting is None:
+            return
+
+        futures, queued_at = waiting
+        self.acked += 1
+        self.ack_latencies.append(time.perf_counter() - queued_at)
+        self.resolve(futures, status)
+
+    # Fails the commands that waited too long for their ack
+    def expire(self):
+        deadline = time.perf_counter() - SERIAL_ACK_TIMEOUT
+        with self.condition:
+            expired = [seq for seq, (futures, queued_at) in self.outstanding.items() if queued_at < deadline]
+            waiting = [self.outstanding.pop(seq) for seq in expired]
+
+        for futures, queued_at in waiting:
+            self.ack_timeouts += 1
+            self.resolve(futures, ROVER_STATUS.ERR)
+
+    def stats(self):
+        with self.condition:
+            depth = len(self.pending)
+            in_flight = len(self.outstanding)
+        write_times = list(self.write_times)
+        latencies = list(self.latencies)
+        ack_latencies = list(self.ack_latencies)
+
+        return {'queue_depth': depth,
+                'max_queue_depth': self.max_depth,
+                'queued': self.queued,
+                'coalesced': self.coalesced,
+                'written': self.written,
+                'acks': self.acks,
+                'in_flight': in_flight,
+                'acked': self.acked,
+                'ack_timeouts': self.ack_timeouts,
+                'write_ms_avg': sum(write_times) / max(len(write_times), 1) * 1000.0,
+                'write_ms_max': max(write_times, default=0.0) * 1000.0,
+                'latency_ms_avg': sum(latencies) / max(len(latencies), 1) * 1000.0,
+                'latency_ms_max': max(latencies, default=0.0) * 1000.0,
+                'ack_ms_avg': sum(ack_latencies) / max(len(ack_latencies), 1) * 1000.0,
+                'ack_ms_max': max(ack_latencies, default=0.0) * 1000.0}
+
+
+# Reads the lines of the arduino on a thread of its own. Acks go to the writer, status
+# lines update the cached sensor state, which is all status queries ever look at.
+class SerialReader:
+    def __init__(self, writer):
+        self.ser = None
+        self.thread = None
+        self.writer = writer
+        self.sensors = {'distance_cm': None, 'blocked': False,
+                        'cam_top_limit': False, 'cam_bottom_limit': False, 'updated': None}
+
+    def start(self, ser):
+        self.ser = ser
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                line = self.ser.readline()
+            except serial.SerialException as e:
+                print(f'Serial read failed: {e}')
+                time.sleep(SERIAL_READ_TIMEOUT)
+                line = b''
+
+            if line:
+                self.process(line.decode('ascii', 'replace').split())
+            self.writer.expire()
+
+    def process(self, words):
+        try:
+            if words[0] == 'ack' and len(words) == 3:
+                self.writer.acks = True
+                self.writer.on_ack(int(words[1]), ACK_STATUSES[int(words[2])])
+            elif words[0] == 'status' and len(words) == 3:
+                self.writer.acks = True
+                flags = ROVER_STATUS(int(words[2]) & 7)
+                distance = int(words[1])
+                self.sensors = {'distance_cm': distance if distance > 0 else None,
+                                'blocked': bool(flags & ROVER_STATUS.BLOCKED),
+                                'cam_top_limit': bool(flags & ROVER_STATUS.CAM_TOP_LIMIT),
+                                'cam_bottom_limit': bool(flags & ROVER_STATUS.CAM_BOTTOM_LIMIT),
+                                'updated': time.time()}
+            else:
+                print(f'arduino: {" ".join(words)}')
+        except (ValueError, IndexError):
+            print(f'Unreadable serial line: {words}')
+
+
 # The rover Hardware Abstraction Layer handles all requests that must be handled
 # by the hardware. Although not enforced, this is a singleton.
 class rover_HAL:
 
     def __init__(self):
         self.ser = None
-        pass
+        self.writer = SerialWriter()
+        self.reader = SerialReader(self.writer)
 
     def open_serial(self):
-        self.ser = serial.Serial(rover_shared_data.serial_port)
+        self.ser = serial.Serial(rover_shared_data.serial_port, timeout=SERIAL_READ_TIMEOUT)
+        self.writer.start(self.ser)
+        self.reader.start(self.ser)
 
+    # Queues the command for the writer thread, it returns right away with a future of
+    # the ROVER_STATUS reported by the arduino
     def send_serial_command(self, command):
-        print(f'sending {command}')
-        self.ser.write(command)
-        # line = self.ser.readline()
-        # print(f'Received {line}')
+        return self.writer.send(command)
+
+    def serial_stats(self):
+        return self.writer.stats()
+
+    # The latest sensor state reported by the arduino, it never touches the serial line
+    def sensor_state(self):
+        return dict(self.reader.sensors)
 
     def is_blocked(self):
-        pass
+        return self.reader.sensors['blocked']
 
     def move(self, direction):
         serial_command = 'move '
@@ -111,9 +350,7 @@ class rover_HAL:
 
         serial_command += '\n'
 
-        self.send_serial_command(bytes(serial_command, 'ascii'))
-
-        return ROVER_STATUS.OK
+        return self.send_serial_command(bytes(serial_command, 'ascii'))
 
     def move_cam(self, direction):
         serial_command = 'move_cam '
@@ -129,16 +366,14 @@ class rover_HAL:
 
         serial_command += '\n'
 
-        self.send_serial_command(bytes(serial_command, 'ascii'))
-        return ROVER_STATUS.OK
+        return self.send_serial_command(bytes(serial_command, 'ascii'))
 
     def set_cam(self, angles):
         serial_command = f'set_cam {angles[0]} {angles[1]}'
 
         serial_command += '\n'
 
-        self.send_serial_command(bytes(serial_command, 'ascii'))
-        return ROVER_STATUS.OK
+        return self.send_serial_command(bytes(serial_command, 'ascii'))
 
     def stop_motors(self, motors):
 
@@ -151,8 +386,7 @@ class rover_HAL:
 
         serial_command += '\n'
 
-        self.send_serial_command(bytes(serial_command, 'ascii'))
-        return ROVER_STATUS.OK
+        return self.send_serial_command(bytes(serial_command, 'ascii'))
 
     def laser_ctrl(self, action):
 
@@ -165,8 +399,7 @@ class rover_HAL:
 
         serial_command += '\n'
 
-        self.send_serial_command(bytes(serial_command, 'ascii'))
-        return ROVER_STATUS.OK
+        return self.send_serial_command(bytes(serial_command, 'ascii'))
 
     def light_ctrl(self, action, intensity=0):
 
@@ -181,24 +414,21 @@ class rover_HAL:
 
         serial_command += '\n'
 
-        self.send_serial_command(bytes(serial_command, 'ascii'))
-        return ROVER_STATUS.OK
+        return self.send_serial_command(bytes(serial_command, 'ascii'))
 
     def set_speed(self, speed):
         serial_command = f'speed {speed}'
 
         serial_command += '\n'
 
-        self.send_serial_command(bytes(serial_command, 'ascii'))
-        return ROVER_STATUS.OK
+        return self.send_serial_command(bytes(serial_command, 'ascii'))
 
     def set_cam_speed(self, speed):
         serial_command = f'cam_speed {speed[0]} {speed[1]}'
 
         serial_command += '\n'
 
-        self.send_serial_command(bytes(serial_command, 'ascii'))
-        return ROVER_STATUS.OK
+        return self.send_serial_command(bytes(serial_command, 'ascii'))
 
 
 # >>>>>>>>>> GLOBAL VARIABLES <<<<<<<<<<#
@@ -212,6 +442,12 @@ class RoverRequestHandler:
         self.reader = None
         self.writer = None
         self.id = uuid.uuid1()
+        # The hello and set_stream messages are always JSON, the negotiated encoding
+        # is used from then on
+        self.codec = JsonCodec()
+        self.link_encoding = 'json'
+        # Set once the response of the latest dispatched command is sent
+        self.last_response = None
 
         # Define the set of sets of allowed directions and combinations
         self.allowed_directions = {frozenset(['forward']): ROVER_DIRECTION.FORWARD,
@@ -253,17 +489,26 @@ class RoverRequestHandler:
                                  'stop_attack': self.cmd_stop_attack_person,
                                  'laser_ctrl': self.cmd_laser_ctrl,
                                  'light_ctrl': self.cmd_light_ctrl,
-                                 'list_faces': self.cmd_list_faces}
+                                 'list_faces': self.cmd_list_faces,
+                                 'status': self.cmd_status}
 
     async def connect(self):
         self.reader, self.writer = await asyncio.open_connection(rover_shared_data.server_address,
                                                                  rover_shared_data.cmd_port)
 
         hello_cmd = {'rover_id': str(self.id), 'cmd': 'hello',
-                     'rover_data': rover_shared_data.data}
+                     'rover_data': rover_shared_data.data, 'encodings': supported_encodings()}
 
         await self.send_message(hello_cmd)
 
+        try:
+            hello_response = json.loads(await asyncio.wait_for(self.reader.readline(), HELLO_ACK_TIMEOUT))
+            if hello_response.get('encoding') in supported_encodings():
+                self.link_encoding = hello_response['encoding']
+        except asyncio.TimeoutError:
+            print('No answer to hello, the dispatcher only speaks JSON')
+        print(f'Using the {self.link_encoding} encoding')
+
     async def send_stream_info(self):
         with open(rover_shared_data.stream_conf_file_name) as f:
             conf_string = f.read()
@@ -272,14 +517,22 @@ class RoverRequestHandler:
 
     async def serve(self):
         await self.send_stream_info()
+        self.codec = control_codec(self.link_encoding)
 
         try:
             while True:
-                line = await self.reader.readline()
-                line = line.decode()
-                if line:
-                    print(f'{line}')
-                    await self.process(line)
+                try:
+                    message = await self.codec.read(self.reader)
+                except ValueError:
+                    self.dispatch(self.error_response("parsing_error"))
+                    continue
+
+                if message is None:
+                    print('Dispatcher disconnected')
+                    break
+
+                print(f'{message}')
+                self.dispatch(self.process(message), message.get('seq'))
 
         except Exception as e:
             print('Error processing command')
@@ -287,9 +540,26 @@ class RoverRequestHandler:
             # print(e.args)  # arguments stored in .args
             # print(e)
 
-    async def process(self, message):
+    # Runs a command on a task of its own, so that the ones waiting for the arduino
+    # overlap. The response carries the sequence number of the command, if it had one.
+    # The dispatcher gives up on the commands before the one answered, so the response
+    # of every command waits for the one of the command before it.
+    def dispatch(self, coroutine, seq=None):
+        previous = self.last_response
+        self.last_response = asyncio.get_running_loop().create_future()
+        asyncio.create_task(self.run_command(coroutine, previous, self.last_response, seq))
+
+    async def run_command(self, coroutine, previous, sent, seq):
+        response_turn.set((previous, sent, seq))
+        try:
+            await coroutine
+        finally:
+            # A command that did not answer must not hold up the ones after it
+            if not sent.done():
+                sent.set_result(None)
+
+    async def process(self, msg):
         try:
-            msg = json.loads(message)
             cmd = msg['cmd']
 
             if cmd in self.allowed_commands.keys():
@@ -302,11 +572,18 @@ class RoverRequestHandler:
             print(e)
             await self.error_response("parsing_error")
 
-    # Send the message, given as dictionary, to the socket, encoded as json
+    # Send the message, given as dictionary, to the socket, in the encoding of the link
     async def send_message(self, message):
+        turn = response_turn.get()
+        if turn is not None:
+            response_turn.set(None)
+            if turn[0] is not None:
+                await turn[0]
+            if turn[2] is not None:
+                message = dict(message, seq=turn[2])
+
         try:
-            encoded_msg = json.dumps(message) + '\n'
-            self.writer.write(encoded_msg.encode())
+            self.writer.write(self.codec.encode(message))
             await self.writer.drain()
         except Exception as e:
             print(type(e))  # the exception instance
@@ -314,6 +591,9 @@ class RoverRequestHandler:
             print(e)
             print('Connection lost')
 
+        if turn is not None:
+            turn[1].set_result(None)
+
     # Creates a standard error response, where the info field is set as failure reason
     # it then sends the message to the socket
     async def error_response(self, failure_reason):
@@ -325,6 +605,19 @@ class RoverRequestHandler:
         ok = {"msg": "ok"}
         await self.send_message(ok)
 
+    # Answers with the status the arduino reported for the command
+    async def status_response(self, status):
+        if status == ROVER_STATUS.OK:
+            await self.success_response()
+        elif status == ROVER_STATUS.BLOCKED:
+            await self.error_response("blocked")
+        elif status == ROVER_STATUS.CAM_TOP_LIMIT:
+            await self.error_response("top_limit")
+        elif status == ROVER_STATUS.CAM_BOTTOM_LIMIT:
+            await self.error_response("bottom_limit")
+        else:
+            await self.error_response("serial_error")
+
     # Attempts to move the rover in the desired directions, failing if the rover
     # encounters an obstacle.
     async def cmd_move(self, message):
@@ -340,11 +633,11 @@ class RoverRequestHandler:
 
                 rover_dir = self.allowed_directions[direction]
 
-                r = rover_hal.move(rover_dir)
-                if r == ROVER_STATUS.OK:
-                    await self.success_response()
-                else:
+                # No need to ask the arduino while the last status line saw an obstacle
+                if rover_dir & ROVER_DIRECTION.FORWARD and rover_hal.is_blocked():
                     await self.error_response("blocked")
+                else:
+                    await self.status_response(await rover_hal.move(rover_dir))
 
             else:
                 await self.error_response("bad_direction")
@@ -363,12 +656,7 @@ class RoverRequestHandler:
 
             speed = np.clip(float(params['speed']), 0.0, 1.0)
 
-            r = rover_hal.set_speed(speed)
-            if r == ROVER_STATUS.OK:
-                await self.success_response()
-            else:
-                await self.error_response("blocked")
-
+            await self.status_response(await rover_hal.set_speed(speed))
 
         except Exception as e:
             print(type(e))  # the exception instance
@@ -384,12 +672,7 @@ class RoverRequestHandler:
 
             speed = np.clip(params['speed'], 0.0, 90.0)
 
-            r = rover_hal.set_cam_speed(speed)
-            if r == ROVER_STATUS.OK:
-                await self.success_response()
-            else:
-                await self.error_response("blocked")
-
+            await self.status_response(await rover_hal.set_cam_speed(speed))
 
         except Exception as e:
             print(type(e))  # the exception instance
@@ -410,13 +693,7 @@ class RoverRequestHandler:
             if direction in self.allowed_cam_directions.keys():
                 cam_dir = self.allowed_cam_directions[direction]
 
-                r = rover_hal.move_cam(cam_dir)
-                if r == ROVER_STATUS.OK:
-                    await self.success_response()
-                elif r == ROVER_STATUS.CAM_TOP_LIMIT:
-                    await self.error_response("top_limit")
-                elif r == ROVER_STATUS.CAM_BOTTOM_LIMIT:
-                    await self.error_response("bottom_limit")
+                await self.status_response(await rover_hal.move_cam(cam_dir))
 
             else:
                 await self.error_response("bad_direction")
@@ -432,13 +709,7 @@ class RoverRequestHandler:
             params = message['params']
             angles = params['angles']
 
-            r = rover_hal.set_cam(angles)
-            if r == ROVER_STATUS.OK:
-                await self.success_response()
-            elif r == ROVER_STATUS.CAM_TOP_LIMIT:
-                await self.error_response("top_limit")
-            elif r == ROVER_STATUS.CAM_BOTTOM_LIMIT:
-                await self.error_response("bottom_limit")
+            await self.status_response(await rover_hal.set_cam(angles))
 
         except:
             await self.error_response("bad_params")
@@ -457,26 +728,24 @@ class RoverRequestHandler:
 
                 stopped_motors = self.allowed_motors[motors]
 
-                r = rover_hal.stop_motors(stopped_motors)
-
-                if r == ROVER_STATUS.OK:
-                    await self.success_response()
+                await self.status_response(await rover_hal.stop_motors(stopped_motors))
             else:
                 await self.error_response("bad_motors")
         except:
             await self.error_response("bad_params")
 
+    # Tracking is done by the server, which answers these commands before they reach the rover
     async def cmd_track_person(self, message):
-        pass
+        await self.error_response("server_cmd")
 
     async def cmd_untrack_person(self, message):
-        pass
+        await self.error_response("server_cmd")
 
     async def cmd_attack_person(self, message):
         await self.success_response()
 
     async def cmd_stop_attack_person(self, message):
-        pass
+        await self.success_response()
 
     # Puts the laser in the desired state
     async def cmd_laser_ctrl(self, message):
@@ -497,10 +766,9 @@ class RoverRequestHandler:
                 laser_action = LASER_ACTION.BLINK
             else:
                 await self.error_response("bad_action")
+                return
 
-            r = rover_hal.laser_ctrl(laser_action)
-            if r == ROVER_STATUS.OK:
-                await self.success_response()
+            await self.status_response(await rover_hal.laser_ctrl(laser_action))
 
         except Exception as e:
             print(type(e))  # the exception instance
@@ -531,10 +799,9 @@ class RoverRequestHandler:
                 light_action = LIGHT_ACTION.DIM
             else:
                 await self.error_response("bad_action")
+                return
 
-            r = rover_hal.light_ctrl(light_action, intensity)
-            if r == ROVER_STATUS.OK:
-                await self.success_response()
+            await self.status_response(await rover_hal.light_ctrl(light_action, intensity))
 
         except Exception as e:
             print(type(e))  # the exception instance
@@ -543,7 +810,12 @@ class RoverRequestHandler:
             await self.error_response("bad_params")
 
     async def cmd_list_faces(self, message):
-        pass
+        await self.error_response("server_cmd")
+
+    # Reports the state of the serial link to the arduino and its latest sensor readings
+    async def cmd_status(self, message):
+        await self.send_message({"msg": "ok", "serial": rover_hal.serial_stats(),
+                                 "sensors": rover_hal.sensor_state()})
 
 
 class BroadcastOutput(object):
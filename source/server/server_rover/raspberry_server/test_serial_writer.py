@@ -0,0 +1,71 @@
+import asyncio
+import threading
+
+from server_rover import ROVER_STATUS, SerialWriter
+
+
+# A serial port whose writes block until released, so commands pile up behind the first
+class FakeSerial:
+    def __init__(self):
+        self.written = []
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, command):
+        self.writing.set()
+        self.release.wait()
+        self.written.append(command)
+
+
+def run(test):
+    async def with_writer():
+        ser = FakeSerial()
+        writer = SerialWriter()
+        writer.start(ser)
+        try:
+            await test(writer, ser)
+        finally:
+            ser.release.set()
+
+    asyncio.run(with_writer())
+
+
+async def blocked(writer, ser):
+    future = writer.send(b'light_ctrl i\n')
+    await asyncio.get_running_loop().run_in_executor(None, ser.writing.wait)
+    return future
+
+
+def test_coalescing_keeps_the_order_of_kinds():
+    async def test(writer, ser):
+        first = await blocked(writer, ser)
+        futures = [writer.send(command) for command in
+                   (b'speed 0.1\n', b'speed 0.2\n', b'move w\n', b'speed 0.3\n', b'move_stop w\n', b'move w\n')]
+
+        ser.release.set()
+        statuses = await asyncio.wait_for(asyncio.gather(first, *futures), 1.0)
+        assert statuses == [ROVER_STATUS.OK] * 7
+        # The second speed replaced the first, the third one stays after the move
+        assert ser.written == [b'light_ctrl i\n', b'speed 0.2\n', b'move w\n', b'speed 0.3\n',
+                               b'move_stop w\n', b'move w\n']
+        assert writer.stats()['coalesced'] == 1
+
+    run(test)
+
+
+def test_acked_commands_wait_for_their_ack():
+    async def test(writer, ser):
+        writer.acks = True
+        ser.release.set()
+        futures = [writer.send(b'move w\n'), writer.send(b'set_cam 10 10\n')]
+        await asyncio.sleep(0.05)
+
+        assert ser.written == [b'#0 move w\n', b'#1 set_cam 10 10\n']
+        assert not any(map(lambda future: future.done(), futures))
+
+        writer.on_ack(1, ROVER_STATUS.CAM_TOP_LIMIT)
+        writer.on_ack(0, ROVER_STATUS.BLOCKED)
+        assert await asyncio.wait_for(asyncio.gather(*futures), 1.0) == [ROVER_STATUS.BLOCKED,
+                                                                         ROVER_STATUS.CAM_TOP_LIMIT]
+
+    run(test)